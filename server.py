@@ -3,27 +3,48 @@ from dotenv import load_dotenv
 import uuid
 import time
 import asyncio
+import logging
+import random
 from datetime import datetime, timedelta, timezone
-from typing import Any, Dict, List, Optional, Literal
+from typing import Any, Callable, Dict, List, Optional, Literal
 import json
+import heapq
+import zlib
+from abc import ABC, abstractmethod
+import base64
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import urllib.request
-import urllib.error
+import socket
 
 from fastapi import FastAPI, Depends, HTTPException, status, Body, Path, Query, WebSocket, WebSocketDisconnect, BackgroundTasks, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 from fastapi.websockets import WebSocketState
 
-from pydantic import BaseModel, BaseSettings, Field, EmailStr
+from pydantic import BaseModel, BaseSettings, Field, EmailStr, root_validator
 import smtplib
 from email.mime.text import MIMEText
 
-from beanie import Document, Indexed, init_beanie
+from beanie import Document, Indexed, PydanticObjectId, init_beanie
+from bson import ObjectId
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING, IndexModel, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 
 from passlib.context import CryptContext
 import jwt
 
+try:  # optional: only needed for WS_BACKPLANE=redis
+    import redis.asyncio as aioredis
+except ImportError:  # pragma: no cover
+    aioredis = None
+
+try:  # optional: only needed for the smtp-selftest command
+    from aiosmtpd.controller import Controller as SMTPController
+except ImportError:  # pragma: no cover
+    SMTPController = None
+
 
 # ----------------------------------------------------------------------------
 # Settings
@@ -40,6 +61,7 @@ class Settings(BaseSettings):
     activation_fee_usd: float = 50.0
     commission_base_percent: float = 10.0  # level 1, then decays
     commission_decay_percent: float = 2.0  # per level
+    commission_max_levels: int = 10  # cap for practicality
     frontend_base_url: str = os.getenv("FRONTEND_URL", "https://www.mywebsite.com")
     email_from: str = os.getenv("EMAIL_FROM", "no-reply@mywebsite.com")
     allowed_origins: List[str] = ["*"]
@@ -50,13 +72,93 @@ class Settings(BaseSettings):
     smtp_user: Optional[str] = os.getenv("SMTP_USER")
     smtp_password: Optional[str] = os.getenv("SMTP_PASSWORD")
     smtp_starttls: bool = os.getenv("SMTP_STARTTLS", "true").lower() in ("1", "true", "yes")
+    # SMTP_ENABLED unset: on only when host and credentials are all set (see
+    # _derive_defaults); true also allows an unauthenticated relay (e.g. aiosmtpd)
+    smtp_enabled: Optional[bool] = None
+    smtp_pool_size: int = int(os.getenv("SMTP_POOL_SIZE", "4"))
+    smtp_batch_size: int = int(os.getenv("SMTP_BATCH_SIZE", "50"))
+    smtp_max_messages_per_connection: int = int(os.getenv("SMTP_MAX_MESSAGES_PER_CONNECTION", "100"))
+    smtp_rate_per_connection: float = float(os.getenv("SMTP_RATE_PER_CONNECTION", "10"))  # messages/second, 0 = unlimited
+    smtp_idle_timeout_seconds: int = int(os.getenv("SMTP_IDLE_TIMEOUT", "60"))
     # Currency rates
     currency_api_url: str = os.getenv("CURRENCY_API_URL", "https://api.exchangerate.host/latest?base=USD")
     currency_cache_ttl_seconds: int = int(os.getenv("CURRENCY_CACHE_TTL", "3600"))
+    currency_provider: str = os.getenv("CURRENCY_PROVIDER", "http")  # "http" or "static"
+    currency_static_rates: str = os.getenv("CURRENCY_STATIC_RATES", "{}")  # JSON for the static provider
+    currency_fetch_timeout_seconds: float = float(os.getenv("CURRENCY_FETCH_TIMEOUT", "10"))
+    # Admin analytics (0 disables the in-process cache)
+    analytics_cache_ttl_seconds: int = int(os.getenv("ANALYTICS_CACHE_TTL", "15"))
+    # Per-user /dashboard/summary cache (0 disables); bounds cross-worker staleness
+    summary_cache_ttl_seconds: int = int(os.getenv("SUMMARY_CACHE_TTL", "30"))
+    summary_cache_size: int = int(os.getenv("SUMMARY_CACHE_SIZE", "10000"))
+    # Authenticated-principal cache; the TTL bounds how long a suspension
+    # made on another worker can take to apply here
+    auth_cache_ttl_seconds: int = int(os.getenv("AUTH_CACHE_TTL", "15"))
+    auth_cache_size: int = int(os.getenv("AUTH_CACHE_SIZE", "50000"))
+    # Password hashing: bcrypt cost and the process pool that runs it (0 workers = threads)
+    bcrypt_rounds: int = int(os.getenv("BCRYPT_ROUNDS", "12"))
+    password_hash_workers: int = int(os.getenv("PASSWORD_HASH_WORKERS", "2"))
+    password_hash_max_in_flight: int = int(os.getenv("PASSWORD_HASH_MAX_IN_FLIGHT", "4"))
+    # Outbox dispatcher (email + websocket fan-out)
+    outbox_dispatcher_enabled: bool = os.getenv("OUTBOX_DISPATCHER_ENABLED", "true").lower() in ("1", "true", "yes")
+    outbox_concurrency: int = int(os.getenv("OUTBOX_CONCURRENCY", "8"))
+    outbox_poll_interval_seconds: float = float(os.getenv("OUTBOX_POLL_INTERVAL", "1.0"))
+    outbox_lease_seconds: int = int(os.getenv("OUTBOX_LEASE_SECONDS", "60"))
+    outbox_max_attempts: int = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+    outbox_backoff_base_seconds: float = float(os.getenv("OUTBOX_BACKOFF_BASE", "2.0"))
+    outbox_backoff_max_seconds: float = float(os.getenv("OUTBOX_BACKOFF_MAX", "900"))
+    outbox_retention_days: int = int(os.getenv("OUTBOX_RETENTION_DAYS", "7"))
+    # Payment webhook idempotency: claim lease, claim retention, per-worker recent-id LRU
+    webhook_claim_lease_seconds: int = int(os.getenv("WEBHOOK_CLAIM_LEASE_SECONDS", "120"))
+    webhook_event_retention_days: int = int(os.getenv("WEBHOOK_EVENT_RETENTION_DAYS", "30"))
+    webhook_recent_cache_size: int = int(os.getenv("WEBHOOK_RECENT_CACHE_SIZE", "10000"))
+    webhook_recent_cache_ttl_seconds: int = int(os.getenv("WEBHOOK_RECENT_CACHE_TTL", "3600"))
+    # Webhook ingestion: "sync" applies events in the request, "queue" persists and acks
+    webhook_ingest_mode: str = os.getenv("WEBHOOK_INGEST_MODE", "sync")
+    # WEBHOOK_WORKER_ENABLED unset: on only in queue mode (see _derive_defaults)
+    webhook_worker_enabled: Optional[bool] = None
+    webhook_poll_interval_seconds: float = float(os.getenv("WEBHOOK_POLL_INTERVAL", "1.0"))
+    webhook_backoff_base_seconds: float = float(os.getenv("WEBHOOK_BACKOFF_BASE", "5.0"))
+    webhook_backoff_max_seconds: float = float(os.getenv("WEBHOOK_BACKOFF_MAX", "1800"))
+    webhook_worker_concurrency: int = int(os.getenv("WEBHOOK_WORKER_CONCURRENCY", "4"))
+    webhook_partitions: int = int(os.getenv("WEBHOOK_PARTITIONS", "32"))
+    webhook_partition_lease_seconds: int = int(os.getenv("WEBHOOK_PARTITION_LEASE_SECONDS", "60"))
+    webhook_max_attempts: int = int(os.getenv("WEBHOOK_MAX_ATTEMPTS", "10"))
+    # Activation-expiry job: built-in scheduler interval (0 = only CLI/HTTP) and chunking
+    expire_accounts_interval_seconds: int = int(os.getenv("EXPIRE_ACCOUNTS_INTERVAL", "0"))
+    expire_accounts_chunk_size: int = int(os.getenv("EXPIRE_ACCOUNTS_CHUNK_SIZE", "500"))
+    job_lease_seconds: int = int(os.getenv("JOB_LEASE_SECONDS", "300"))
+    # Binary placement: how long a claimed open slot is held before it can be reclaimed
+    binary_slot_claim_seconds: int = int(os.getenv("BINARY_SLOT_CLAIM_SECONDS", "30"))
+    # WebSocket fan-out across workers: "memory" (single process), "redis" or "mongo" (change streams)
+    ws_backplane: str = os.getenv("WS_BACKPLANE", "memory")
+    redis_url: str = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+    ws_presence_ttl_seconds: int = int(os.getenv("WS_PRESENCE_TTL", "90"))
+    # Per-connection send queue; a client that lets it fill (or stalls a send) is evicted
+    ws_send_queue_size: int = int(os.getenv("WS_SEND_QUEUE_SIZE", "64"))
+    ws_send_timeout_seconds: float = float(os.getenv("WS_SEND_TIMEOUT", "10"))
+    # Sockets opened with ?heartbeat=1 get an app-level ping every interval and are
+    # reaped after the idle timeout without an inbound frame. Other clients rely on
+    # the protocol-level ping/pong (uvicorn --ws-ping-interval/--ws-ping-timeout).
+    ws_heartbeat_interval_seconds: float = float(os.getenv("WS_HEARTBEAT_INTERVAL", "25"))
+    ws_idle_timeout_seconds: float = float(os.getenv("WS_IDLE_TIMEOUT", "75"))
+    # Most notifications replayed to a reconnecting socket before it is told to resync over REST
+    ws_replay_limit: int = int(os.getenv("WS_REPLAY_LIMIT", "500"))
+
+    # Defaults that depend on other fields are resolved here, after the
+    # environment (including .env) has been read, not in the class body.
+    @root_validator(skip_on_failure=True)
+    def _derive_defaults(cls, values: Dict[str, Any]) -> Dict[str, Any]:
+        if values.get("smtp_enabled") is None:
+            values["smtp_enabled"] = bool(values.get("smtp_host") and values.get("smtp_user") and values.get("smtp_password"))
+        if values.get("webhook_worker_enabled") is None:
+            values["webhook_worker_enabled"] = values.get("webhook_ingest_mode") == "queue"
+        return values
 
 
 load_dotenv()
 settings = Settings()
+logger = logging.getLogger("affiliate")
 
 
 # ----------------------------------------------------------------------------
@@ -79,12 +181,149 @@ def make_response(success: bool, code: str, message: str, data: Any = None, trac
     return JSONResponse(status_code=http_status, content=env.dict())
 
 
+# ----------------------------------------------------------------------------
+# Utilities: in-process cache
+# ----------------------------------------------------------------------------
+
+
+class TTLCache:
+    # Bounded LRU with per-entry expiry; per worker process, not shared.
+    def __init__(self, maxsize: int = 1024, ttl_seconds: float = 60.0) -> None:
+        self.maxsize = maxsize
+        self.ttl_seconds = ttl_seconds
+        self._data: "OrderedDict[Any, tuple]" = OrderedDict()
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        item = self._data.get(key)
+        if item is None:
+            return default
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            self._data.pop(key, None)
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: Any, value: Any, ttl_seconds: Optional[float] = None) -> None:
+        ttl = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+        if ttl <= 0 or self.maxsize <= 0:
+            return
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key: Any) -> None:
+        self._data.pop(key, None)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class LocalEvents:
+    # In-process pub/sub used to fan cache invalidations out to subscribers
+    def __init__(self) -> None:
+        self._subscribers: Dict[str, List[Callable[[Any], None]]] = {}
+
+    def subscribe(self, topic: str, handler: Callable[[Any], None]) -> None:
+        self._subscribers.setdefault(topic, []).append(handler)
+
+    def publish(self, topic: str, payload: Any = None) -> None:
+        for handler in self._subscribers.get(topic, []):
+            try:
+                handler(payload)
+            except Exception:  # noqa: BLE001
+                logger.exception("event handler for %s failed", topic)
+
+
+events = LocalEvents()
+USER_CHANGED = "user.changed"  # payload: user id whose status/role/profile changed
+
+
+# Assembled /dashboard/summary payloads keyed by user id. Commission,
+# submission, payout and referral writes invalidate the affected users.
+_summary_cache = TTLCache(maxsize=settings.summary_cache_size, ttl_seconds=settings.summary_cache_ttl_seconds)
+# Platform-wide values shared by every summary (e.g. tasks available)
+_summary_shared_cache = TTLCache(maxsize=8, ttl_seconds=settings.summary_cache_ttl_seconds)
+
+
+def invalidate_user_summary(*user_ids: Optional[str]) -> None:
+    for uid in user_ids:
+        if uid:
+            _summary_cache.invalidate(uid)
+
+
+# ----------------------------------------------------------------------------
+# Utilities: keyset pagination
+# ----------------------------------------------------------------------------
+
+
+# Newest first; _id breaks ties between rows sharing a created_at
+KEYSET_SORT = [("created_at", DESCENDING), ("_id", DESCENDING)]
+
+
+def encode_cursor(created_at: datetime, doc_id: Any) -> str:
+    raw = json.dumps({"t": created_at.isoformat(), "id": str(doc_id)}).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(token: str) -> tuple:
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        payload = json.loads(raw)
+        created_at = datetime.fromisoformat(payload["t"])
+        if created_at.tzinfo is not None:
+            created_at = created_at.astimezone(timezone.utc).replace(tzinfo=None)
+        return created_at, ObjectId(payload["id"])
+    except Exception:  # noqa: BLE001
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def keyset_query(query: Dict[str, Any], cursor: Optional[str]) -> Dict[str, Any]:
+    if not cursor:
+        return query
+    created_at, oid = decode_cursor(cursor)
+    after = {"$or": [{"created_at": {"$lt": created_at}}, {"created_at": created_at, "_id": {"$lt": oid}}]}
+    return {"$and": [query, after]} if query else after
+
+
+async def keyset_page(model, query: Dict[str, Any], cursor: Optional[str], skip: int, limit: int) -> tuple:
+    # Returns (items, next_cursor). Offset paging (skip) still works when no
+    # cursor is given, for older clients.
+    find = model.find(keyset_query(query, cursor)).sort(KEYSET_SORT)
+    if skip and not cursor:
+        find = find.skip(skip)
+    items = await find.limit(limit + 1).to_list()
+    next_cursor = None
+    if len(items) > limit and limit > 0:
+        items = items[:limit]
+        next_cursor = encode_cursor(items[-1].created_at, items[-1].id)
+    return items, next_cursor
+
+
+def with_next_cursor(response: JSONResponse, next_cursor: Optional[str]) -> JSONResponse:
+    # List payloads stay plain arrays; the cursor for the next page travels in a header
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return response
+
+
 # ----------------------------------------------------------------------------
 # Passwords & JWT
 # ----------------------------------------------------------------------------
 
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# min == max == default, so hashes made with any other cost report needs_update
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__default_rounds=settings.bcrypt_rounds,
+    bcrypt__min_rounds=settings.bcrypt_rounds,
+    bcrypt__max_rounds=settings.bcrypt_rounds,
+)
 
 
 def hash_password(password: str) -> str:
@@ -95,6 +334,71 @@ def verify_password(password: str, password_hash: str) -> bool:
     return pwd_context.verify(password, password_hash)
 
 
+def verify_and_update_password(password: str, password_hash: str) -> tuple:
+    # (valid, replacement hash or None when the stored cost is current)
+    return pwd_context.verify_and_update(password, password_hash)
+
+
+class PasswordHasher:
+    # Runs bcrypt off the event loop in a bounded process pool. The in-flight
+    # cap keeps a login burst from queueing unbounded work in the pool.
+    def __init__(self, workers: int, max_in_flight: int) -> None:
+        self.workers = workers
+        self.max_in_flight = max(1, max_in_flight)
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self.waiting = 0
+        self.in_flight = 0
+        self.completed = 0
+        self.rehashed = 0
+        self.max_waiting_seen = 0
+
+    async def _run(self, fn: Callable, *args: Any) -> Any:
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_in_flight)
+            if self.workers > 0:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        self.waiting += 1
+        self.max_waiting_seen = max(self.max_waiting_seen, self.waiting)
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+        self.in_flight += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+        finally:
+            self.in_flight -= 1
+            self.completed += 1
+            self._slots.release()
+
+    async def hash(self, password: str) -> str:
+        return await self._run(hash_password, password)
+
+    async def verify_and_update(self, password: str, password_hash: str) -> tuple:
+        return await self._run(verify_and_update_password, password, password_hash)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": self.workers,
+            "max_in_flight": self.max_in_flight,
+            "in_flight": self.in_flight,
+            "queue_depth": self.waiting,
+            "max_queue_depth": self.max_waiting_seen,
+            "completed": self.completed,
+            "rehashed": self.rehashed,
+            "bcrypt_rounds": settings.bcrypt_rounds,
+        }
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+password_hasher = PasswordHasher(settings.password_hash_workers, settings.password_hash_max_in_flight)
+
+
 def create_jwt_token(subject: str, token_type: Literal["access", "refresh"], expires_delta: Optional[timedelta] = None) -> str:
     now = datetime.now(timezone.utc)
     if expires_delta is None:
@@ -138,6 +442,14 @@ class User(Document):
     binary_parent: Optional[str] = None  # user id
     left_child: Optional[str] = None  # user id
     right_child: Optional[str] = None  # user id
+    # Materialized path of the binary tree: root-first list of binary
+    # ancestor ids, so binary_depth == len(binary_ancestors).
+    binary_ancestors: List[str] = Field(default_factory=list)
+    binary_depth: int = 0
+    binary_path: str = ""  # root-relative "L"/"R" steps
+    # Sponsor chain (parent_referrer upwards), nearest first, capped at
+    # settings.commission_max_levels; lets commissions resolve in one query.
+    referral_ancestors: List[str] = Field(default_factory=list)
     status: Literal["pending", "active", "suspended"] = "pending"
     activation_expires_at: Optional[datetime] = None
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
@@ -145,6 +457,13 @@ class User(Document):
 
     class Settings:
         name = "users"
+        indexes = [
+            IndexModel([("binary_ancestors", ASCENDING), ("binary_depth", ASCENDING)]),
+            IndexModel([("binary_parent", ASCENDING)]),
+            IndexModel([("parent_referrer", ASCENDING), ("status", ASCENDING)]),
+            IndexModel([("status", ASCENDING), ("activation_expires_at", ASCENDING)]),
+            IndexModel([("phone", ASCENDING)], sparse=True),
+        ]
 
 
 class Payment(Document):
@@ -160,6 +479,13 @@ class Payment(Document):
 
     class Settings:
         name = "payments"
+        indexes = [
+            IndexModel([("user_id", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)]),
+            IndexModel([("user_id", ASCENDING), ("status", ASCENDING), ("created_at", DESCENDING)]),
+            IndexModel([("reference", ASCENDING)], sparse=True),
+            IndexModel([("webhook_event_id", ASCENDING)], sparse=True),
+            IndexModel([("status", ASCENDING), ("gateway", ASCENDING)]),
+        ]
 
 
 class Commission(Document):
@@ -169,11 +495,17 @@ class Commission(Document):
     amount_usd: float
     percent: float
     description: Optional[str] = None
-    transaction_id: Optional[str] = None
+    transaction_id: Optional[str] = None  # payment webhook event id for referral commissions
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
     class Settings:
         name = "commissions"
+        indexes = [
+            IndexModel([("user_id", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)]),
+            # one commission per earner and level for a transaction, so a retried webhook cannot pay twice
+            IndexModel([("transaction_id", ASCENDING), ("user_id", ASCENDING), ("level", ASCENDING)], unique=True,
+                       partialFilterExpression={"transaction_id": {"$type": "string"}}),
+        ]
 
 
 class Notification(Document):
@@ -184,10 +516,22 @@ class Notification(Document):
     data: Dict[str, Any] = Field(default_factory=dict)
     is_read: bool = False
     channels: List[Literal["email", "dashboard", "websocket"]] = Field(default_factory=lambda: ["email", "dashboard", "websocket"])
+    seq: Optional[int] = None  # per-user, monotonically increasing (see allocate_notification_seqs)
+    # Broadcasts are stored once (user_id None) and merged into feeds at read
+    # time; bseq numbers them per audience for the read watermarks.
+    audience: Literal["user", "all", "admins"] = "user"
+    bseq: Optional[int] = None
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
     class Settings:
         name = "notifications"
+        indexes = [
+            IndexModel([("user_id", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)]),
+            IndexModel([("user_id", ASCENDING), ("is_read", ASCENDING)]),
+            IndexModel([("user_id", ASCENDING), ("seq", ASCENDING)]),
+            IndexModel([("audience", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)]),
+            IndexModel([("audience", ASCENDING), ("bseq", DESCENDING)]),  # watermark lookups, broadcast replay
+        ]
 
 
 class Task(Document):
@@ -203,6 +547,10 @@ class Task(Document):
 
     class Settings:
         name = "tasks"
+        indexes = [
+            IndexModel([("created_at", DESCENDING), ("_id", DESCENDING)]),
+            IndexModel([("expires_at", ASCENDING)]),
+        ]
 
 
 class TaskSubmission(Document):
@@ -215,6 +563,9 @@ class TaskSubmission(Document):
 
     class Settings:
         name = "task_submissions"
+        indexes = [
+            IndexModel([("user_id", ASCENDING), ("status", ASCENDING)]),
+        ]
 
 
 class PayoutRequest(Document):
@@ -228,6 +579,12 @@ class PayoutRequest(Document):
 
     class Settings:
         name = "payout_requests"
+        indexes = [
+            IndexModel([("user_id", ASCENDING), ("status", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)]),
+            IndexModel([("status", ASCENDING), ("created_at", DESCENDING)]),
+            IndexModel([("user_id", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)]),
+            IndexModel([("created_at", DESCENDING), ("_id", DESCENDING)]),
+        ]
 
 
 class FraudLog(Document):
@@ -238,6 +595,233 @@ class FraudLog(Document):
 
     class Settings:
         name = "fraud_logs"
+        indexes = [
+            IndexModel([("created_at", DESCENDING), ("_id", DESCENDING)]),
+        ]
+
+
+class BinarySlot(Document):
+    # Open-slot frontier: one row per free left/right child position. Rows
+    # sort by (depth, path) in the same order the BFS placement visits them.
+    node_id: str
+    side: Literal["left", "right"]
+    ancestors: List[str]  # node's binary_ancestors + [node_id]
+    depth: int  # depth of the free child position
+    path: str  # binary_path of the free child position
+    # Set while a registration fills the slot; an expired claim is free again
+    claimed_by: Optional[str] = None
+    claimed_until: Optional[datetime] = None
+
+    class Settings:
+        name = "binary_slots"
+        indexes = [
+            IndexModel([("ancestors", ASCENDING), ("depth", ASCENDING), ("path", ASCENDING)]),
+            IndexModel([("node_id", ASCENDING), ("side", ASCENDING)], unique=True),
+        ]
+
+
+class OutboxMessage(Document):
+    # Durable side effects (emails) written by request handlers and drained by
+    # OutboxDispatcher with retry/backoff. Websocket pushes bypass it: a
+    # dispatcher holds no sockets, so they are published on the backplane.
+    kind: Literal["email"]
+    payload: Dict[str, Any]
+    status: Literal["pending", "processing", "sent", "failed"] = "pending"
+    attempts: int = 0
+    next_attempt_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    locked_until: Optional[datetime] = None
+    last_error: Optional[str] = None
+    sent_at: Optional[datetime] = None
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+    class Settings:
+        name = "outbox"
+        indexes = [
+            IndexModel([("status", ASCENDING), ("next_attempt_at", ASCENDING)]),
+            IndexModel([("status", ASCENDING), ("locked_until", ASCENDING)]),
+            # delivered rows expire; pending/failed rows have no sent_at and stay
+            IndexModel([("sent_at", ASCENDING)], expireAfterSeconds=settings.outbox_retention_days * 86400),
+        ]
+
+
+class BroadcastJob(Document):
+    subject: str
+    body: str
+    to_all: bool = True
+    user_ids: Optional[List[str]] = None
+    status: Literal["queued", "running", "completed", "failed"] = "queued"
+    total: int = 0
+    sent: int = 0
+    failed: int = 0
+    created_by: Optional[str] = None
+    error: Optional[str] = None
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    finished_at: Optional[datetime] = None
+
+    class Settings:
+        name = "broadcast_jobs"
+
+
+class DailyRollup(Document):
+    # Per-user, per-UTC-day chart counters maintained on write (see rollup_inc)
+    user_id: str
+    date: str  # YYYY-MM-DD (UTC)
+    metrics: Dict[str, float] = Field(default_factory=dict)
+
+    class Settings:
+        name = "daily_rollups"
+        indexes = [IndexModel([("user_id", ASCENDING), ("date", ASCENDING)], unique=True)]
+
+
+class ProcessedEvent(Document):
+    # One row per gateway event id; the unique index is the idempotency claim
+    event_id: str
+    gateway: str
+    status: Literal["processing", "done"] = "processing"
+    locked_until: Optional[datetime] = None
+    payment_id: Optional[str] = None
+    result_code: Optional[str] = None
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+    class Settings:
+        name = "processed_events"
+        indexes = [
+            IndexModel([("event_id", ASCENDING)], unique=True),
+            IndexModel([("created_at", ASCENDING)], expireAfterSeconds=settings.webhook_event_retention_days * 86400),
+        ]
+
+
+class WebhookEvent(Document):
+    # Raw gateway event persisted by the ingestion endpoint (WEBHOOK_INGEST_MODE=queue).
+    # Events sharing partition_key (the user) are applied in created_at order.
+    event_id: str
+    gateway: Literal["pesapal", "paypal"]
+    payload: Dict[str, Any]
+    partition_key: str
+    partition: int
+    status: Literal["pending", "retry", "done", "dead"] = "pending"
+    attempts: int = 0
+    next_attempt_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    result_code: Optional[str] = None
+    last_error: Optional[str] = None
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    processed_at: Optional[datetime] = None
+
+    class Settings:
+        name = "webhook_events"
+        indexes = [
+            IndexModel([("event_id", ASCENDING)], unique=True),
+            IndexModel([("partition", ASCENDING), ("status", ASCENDING), ("created_at", ASCENDING)]),
+            IndexModel([("status", ASCENDING), ("created_at", ASCENDING)]),
+        ]
+
+
+class WebhookPartitionLease(Document):
+    # A worker lane owns a partition while it drains it, which keeps per-user order across processes
+    partition: int
+    owner: Optional[str] = None
+    locked_until: Optional[datetime] = None
+
+    class Settings:
+        name = "webhook_partitions"
+        indexes = [IndexModel([("partition", ASCENDING)], unique=True)]
+
+
+class JobCheckpoint(Document):
+    # Progress of a resumable batch job; the lease keeps one runner at a time
+    name: Indexed(str, unique=True)  # type: ignore
+    status: Literal["running", "completed"] = "completed"
+    cutoff: Optional[datetime] = None
+    last_id: Optional[str] = None
+    # ids of the chunk being expired, recorded before their status is flipped
+    batch: List[str] = Field(default_factory=list)
+    run_id: Optional[str] = None
+    processed: int = 0
+    owner: Optional[str] = None
+    locked_until: Optional[datetime] = None
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+
+    class Settings:
+        name = "job_checkpoints"
+
+
+class BroadcastCounter(Document):
+    # Last bseq handed out per broadcast audience; unread = counter - watermark - individually read
+    audience: Indexed(str, unique=True)  # type: ignore
+    seq: int = 0
+
+    class Settings:
+        name = "broadcast_counters"
+
+
+class WsMessage(Document):
+    # Transport rows for MongoBackplane; nodes tail inserts with a change stream
+    target: str  # node id, or "*" for every node
+    envelope: Dict[str, Any]
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+    class Settings:
+        name = "ws_messages"
+        indexes = [IndexModel([("created_at", ASCENDING)], expireAfterSeconds=300)]
+
+
+class WsPresence(Document):
+    # Which nodes hold sockets for a user; refreshed by the owning node, expired when it dies
+    user_id: str
+    node_id: str
+    updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+    class Settings:
+        name = "ws_presence"
+        indexes = [
+            IndexModel([("user_id", ASCENDING), ("node_id", ASCENDING)], unique=True),
+            IndexModel([("node_id", ASCENDING)]),
+            IndexModel([("updated_at", ASCENDING)], expireAfterSeconds=settings.ws_presence_ttl_seconds),
+        ]
+
+
+class CurrencyRates(Document):
+    # Last good rates snapshot, so a cold worker can serve without the network
+    base: Indexed(str, unique=True)  # type: ignore
+    rates: Dict[str, float]
+    fetched_at: datetime
+
+    class Settings:
+        name = "currency_rates"
+
+
+class Wallet(Document):
+    # Materialized running totals per user, maintained with $inc on every
+    # commission insert and payout status change (see wallet_inc).
+    user_id: Indexed(str, unique=True)  # type: ignore
+    earned_usd: float = 0.0
+    withdrawn_usd: float = 0.0  # payouts in "sent"
+    reserved_usd: float = 0.0  # payouts awaiting review ("pending"/"approved")
+    commission_count: int = 0
+    payout_sent_count: int = 0
+    updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+    class Settings:
+        name = "wallets"
+
+
+class NotificationState(Document):
+    # Per-user notification counters, kept in step with inserts and read marks
+    # (see notification_unread_inc) so the badge poll is a single point read.
+    # last_seq is the sequence counter handed out to new notifications.
+    user_id: Indexed(str, unique=True)  # type: ignore
+    unread: int = 0
+    unread_synced: bool = False  # False until unread has been counted from the collection once
+    last_seq: int = 0
+    # Broadcast read state per audience: every bseq <= watermark is read, plus
+    # the individually read bseqs above it.
+    broadcast_read_seq: Dict[str, int] = Field(default_factory=dict)
+    broadcast_read: Dict[str, List[int]] = Field(default_factory=dict)
+    updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+    class Settings:
+        name = "notification_state"
 
 
 # ----------------------------------------------------------------------------
@@ -254,11 +838,11 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
 
-@app.on_event("startup")
-async def on_startup() -> None:
+async def init_db() -> None:
     client = AsyncIOMotorClient(settings.mongo_uri)
     await init_beanie(database=client.get_default_database(), document_models=[
         User,
@@ -269,9 +853,49 @@ async def on_startup() -> None:
         TaskSubmission,
         PayoutRequest,
         FraudLog,
+        Wallet,
+        BinarySlot,
+        OutboxMessage,
+        BroadcastJob,
+        DailyRollup,
+        CurrencyRates,
+        ProcessedEvent,
+        WebhookEvent,
+        WebhookPartitionLease,
+        NotificationState,
+        BroadcastCounter,
+        JobCheckpoint,
+        WsMessage,
+        WsPresence,
     ])
 
 
+@app.on_event("startup")
+async def on_startup() -> None:
+    await init_db()
+    await ws_backplane.start(ws_manager.deliver_local)
+    ws_manager.start()
+    if settings.outbox_dispatcher_enabled:
+        outbox.start()
+    rates_refresher.start()
+    if settings.webhook_worker_enabled:
+        webhook_worker.start()
+    if settings.expire_accounts_interval_seconds > 0:
+        expire_accounts_scheduler.start()
+
+
+@app.on_event("shutdown")
+async def on_shutdown() -> None:
+    await outbox.stop()
+    await rates_refresher.stop()
+    await webhook_worker.stop()
+    await expire_accounts_scheduler.stop()
+    await ws_manager.stop()
+    await ws_backplane.stop()
+    await smtp_pool.close()
+    password_hasher.shutdown()
+
+
 # ----------------------------------------------------------------------------
 # Middleware: attach trace_id to request state
 # ----------------------------------------------------------------------------
@@ -302,7 +926,48 @@ class TokenPair(BaseModel):
     token_type: str = "bearer"
 
 
-async def get_current_user(request: Request) -> User:
+# Read-only view of the authenticated user, shared across requests through
+# the cache. It is not a Document, so handlers cannot save it; anything that
+# writes a user must load the User itself.
+class Principal(BaseModel):
+    id: PydanticObjectId
+    name: str
+    email: EmailStr
+    phone: Optional[str] = None
+    country: Optional[str] = None
+    currency: Optional[str] = None
+    referral_code: str
+    parent_referrer: Optional[str] = None
+    binary_parent: Optional[str] = None
+    left_child: Optional[str] = None
+    right_child: Optional[str] = None
+    binary_depth: int = 0
+    binary_path: str = ""
+    status: Literal["pending", "active", "suspended"] = "pending"
+    activation_expires_at: Optional[datetime] = None
+    created_at: datetime
+    is_admin: bool = False
+
+    class Config:
+        allow_mutation = False
+
+
+_principal_cache = TTLCache(maxsize=settings.auth_cache_size, ttl_seconds=settings.auth_cache_ttl_seconds)
+events.subscribe(USER_CHANGED, _principal_cache.invalidate)
+
+
+async def load_principal(user_id: str) -> Optional[Principal]:
+    principal = _principal_cache.get(user_id)
+    if principal is None:
+        user = await User.get(user_id)
+        if user is None:
+            return None
+        principal = Principal(**user.dict(include=set(Principal.__fields__)))
+        _principal_cache.set(user_id, principal)
+    return principal
+
+
+async def get_current_user(request: Request) -> Principal:
     auth = request.headers.get("Authorization", "")
     if not auth.startswith("Bearer "):
         raise HTTPException(status_code=401, detail="Missing bearer token")
@@ -311,7 +976,7 @@ async def get_current_user(request: Request) -> User:
     if payload.get("type") != "access":
         raise HTTPException(status_code=401, detail="Invalid token type")
     user_id = payload.get("sub")
-    user = await User.get(user_id)
+    user = await load_principal(user_id)
     if user is None:
         raise HTTPException(status_code=401, detail="User not found")
     if user.status == "suspended":
@@ -319,13 +984,13 @@ async def get_current_user(request: Request) -> User:
     return user
 
 
-async def get_admin_user(user: User = Depends(get_current_user)) -> User:
+async def get_admin_user(user: Principal = Depends(get_current_user)) -> Principal:
     if not user.is_admin:
         raise HTTPException(status_code=403, detail="Admin required")
     return user
 
 
-async def get_active_user(user: User = Depends(get_current_user)) -> User:
+async def get_active_user(user: Principal = Depends(get_current_user)) -> Principal:
     if user.status != "active":
         # 403 with machine-readable code and suggested next action
         raise HTTPException(status_code=403, detail="ACCOUNT_INACTIVE")
@@ -343,69 +1008,1311 @@ class EmailMessage(BaseModel):
     body: str
 
 
-async def send_email_stub(message: EmailMessage) -> None:
-    # If SMTP settings provided, send via SMTP; otherwise, simulate
-    if settings.smtp_host and settings.smtp_user and settings.smtp_password:
-        loop = asyncio.get_event_loop()
-        def _send():
+class _SMTPSession:
+    # One pooled SMTP connection; only ever used by one executor thread at a time
+    def __init__(self) -> None:
+        self.server: Optional[smtplib.SMTP] = None
+        self.sent_on_connection = 0
+        self.last_used = 0.0
+        self.next_send_at = 0.0
+
+    def close(self) -> None:
+        if self.server is not None:
+            try:
+                self.server.quit()
+            except Exception:  # noqa: BLE001
+                pass
+        self.server = None
+        self.sent_on_connection = 0
+
+    def _connect(self) -> None:
+        self.close()
+        server = smtplib.SMTP(settings.smtp_host, settings.smtp_port, timeout=30)
+        if settings.smtp_starttls:
+            server.starttls()
+        if settings.smtp_user and settings.smtp_password:
+            server.login(settings.smtp_user, settings.smtp_password)
+        self.server = server
+
+    def _ensure_connected(self) -> None:
+        now = time.monotonic()
+        if self.server is None or self.sent_on_connection >= settings.smtp_max_messages_per_connection:
+            self._connect()
+        elif now - self.last_used > settings.smtp_idle_timeout_seconds:
+            try:
+                if self.server.noop()[0] != 250:
+                    self._connect()
+            except smtplib.SMTPException:
+                self._connect()
+
+    def _throttle(self) -> None:
+        if settings.smtp_rate_per_connection <= 0:
+            return
+        now = time.monotonic()
+        if self.next_send_at > now:
+            time.sleep(self.next_send_at - now)
+        self.next_send_at = max(now, self.next_send_at) + 1.0 / settings.smtp_rate_per_connection
+
+    def send_batch(self, messages: List[EmailMessage]) -> List[Optional[Exception]]:
+        results: List[Optional[Exception]] = []
+        for message in messages:
             msg = MIMEText(message.body, _subtype="plain", _charset="utf-8")
             msg["Subject"] = message.subject
             msg["From"] = settings.email_from
             msg["To"] = message.to
-            with smtplib.SMTP(settings.smtp_host, settings.smtp_port) as server:
-                if settings.smtp_starttls:
-                    server.starttls()
-                server.login(settings.smtp_user, settings.smtp_password)
-                server.sendmail(settings.email_from, [message.to], msg.as_string())
-        await loop.run_in_executor(None, _send)
+            error: Optional[Exception] = None
+            for attempt in range(2):  # one reconnect if the server dropped us
+                try:
+                    self._ensure_connected()
+                    self._throttle()
+                    self.server.sendmail(settings.email_from, [message.to], msg.as_string())
+                    self.sent_on_connection += 1
+                    error = None
+                    break
+                except smtplib.SMTPServerDisconnected as e:
+                    self.close()
+                    error = e
+                except smtplib.SMTPException as e:
+                    # refused recipient, rejected data, ...: the session is still good
+                    error = e
+                    break
+                except OSError as e:  # socket-level failure (SMTPException subclasses OSError)
+                    self.close()
+                    error = e
+            self.last_used = time.monotonic()
+            results.append(error)
+        return results
+
+
+class SMTPPool:
+    # Reuses authenticated SMTP sessions across messages and batches; each
+    # session is driven by a dedicated executor thread.
+    def __init__(self, size: int) -> None:
+        self.size = max(1, size)
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._sessions: Optional[asyncio.Queue] = None
+        self._all: List[_SMTPSession] = []
+
+    def _ensure_started(self) -> None:
+        if self._sessions is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.size, thread_name_prefix="smtp")
+            self._sessions = asyncio.Queue()
+            self._all = [_SMTPSession() for _ in range(self.size)]
+            for session in self._all:
+                self._sessions.put_nowait(session)
+
+    async def _send_chunk(self, chunk: List[EmailMessage]) -> List[Optional[Exception]]:
+        session = await self._sessions.get()
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, session.send_batch, chunk)
+        finally:
+            self._sessions.put_nowait(session)
+
+    async def send_batch(self, messages: List[EmailMessage]) -> List[Optional[Exception]]:
+        # Returns one entry per message: None on success, else the error
+        self._ensure_started()
+        size = max(1, settings.smtp_batch_size)
+        chunks = [messages[i:i + size] for i in range(0, len(messages), size)]
+        results = await asyncio.gather(*[self._send_chunk(c) for c in chunks])
+        return [r for chunk_results in results for r in chunk_results]
+
+    async def send(self, message: EmailMessage) -> None:
+        error = (await self.send_batch([message]))[0]
+        if error is not None:
+            raise error
+
+    async def close(self) -> None:
+        if self._sessions is None:
+            return
+        executor, sessions = self._executor, self._all
+        self._sessions, self._executor, self._all = None, None, []
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[loop.run_in_executor(executor, s.close) for s in sessions])
+        executor.shutdown(wait=False)
+
+
+smtp_pool = SMTPPool(settings.smtp_pool_size)
+
+
+def smtp_configured() -> bool:
+    return settings.smtp_enabled and bool(settings.smtp_host)
+
+
+async def send_email_stub(message: EmailMessage) -> None:
+    # If SMTP settings provided, send via the pooled SMTP sessions; otherwise, simulate
+    if smtp_configured():
+        await smtp_pool.send(message)
     else:
         await asyncio.sleep(0.01)
 
 
-class ConnectionManager:
+async def send_email_batch(messages: List[EmailMessage]) -> List[Optional[Exception]]:
+    if smtp_configured():
+        return await smtp_pool.send_batch(messages)
+    await asyncio.sleep(0.01)
+    return [None] * len(messages)
+
+
+class WebSocketBackplane(ABC):
+    # Routes websocket pushes to the nodes that hold sockets for the user. Each
+    # node registers the users it has sockets for; a user push goes only to
+    # those nodes, a broadcast (user_id None) goes to every node. Subclasses
+    # supply the registry and the transport.
+    def __init__(self, node_id: Optional[str] = None) -> None:
+        self.node_id = node_id or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self._handler: Optional[Callable[[Dict[str, Any]], Any]] = None
+
+    async def start(self, handler: Callable[[Dict[str, Any]], Any]) -> None:
+        self._handler = handler
+
+    async def stop(self) -> None:
+        self._handler = None
+
+    @abstractmethod
+    async def register(self, user_id: str) -> None:
+        ...
+
+    @abstractmethod
+    async def unregister(self, user_id: str) -> None:
+        ...
+
+    @abstractmethod
+    async def nodes_for(self, user_id: str) -> set:
+        ...
+
+    @abstractmethod
+    async def _send(self, node_id: str, envelope: Dict[str, Any]) -> None:
+        ...
+
+    @abstractmethod
+    async def _send_all(self, envelope: Dict[str, Any]) -> None:
+        ...
+
+    async def _dispatch(self, envelope: Dict[str, Any]) -> None:
+        # local delivery problems must not fail (and so re-send) the whole publish
+        if self._handler is None:
+            return
+        try:
+            await self._handler(envelope)
+        except Exception:  # noqa: BLE001
+            logger.exception("websocket delivery failed on %s", self.node_id)
+
+    async def publish(self, user_id: Optional[str], message: Dict[str, Any], audience: Optional[str] = None) -> None:
+        envelope = {"user_id": user_id, "message": message, "audience": audience}
+        if user_id is None:
+            await self._send_all(envelope)
+            return
+        for node_id in await self.nodes_for(user_id):
+            if node_id == self.node_id:
+                await self._dispatch(envelope)
+            else:
+                await self._send(node_id, envelope)
+
+
+class InMemoryHub:
+    # State shared by InMemoryBackplane nodes. One hub per process is the
+    # single-worker setup; several backplanes on one hub fake a cluster in tests.
     def __init__(self) -> None:
-        self.user_connections: Dict[str, List[WebSocket]] = {}
+        self.nodes: Dict[str, "InMemoryBackplane"] = {}
+        self.registry: Dict[str, set] = {}
+
+
+class InMemoryBackplane(WebSocketBackplane):
+    def __init__(self, hub: Optional[InMemoryHub] = None, node_id: Optional[str] = None) -> None:
+        super().__init__(node_id)
+        self.hub = hub or InMemoryHub()
+
+    async def start(self, handler: Callable[[Dict[str, Any]], Any]) -> None:
+        await super().start(handler)
+        self.hub.nodes[self.node_id] = self
+
+    async def stop(self) -> None:
+        self.hub.nodes.pop(self.node_id, None)
+        for nodes in self.hub.registry.values():
+            nodes.discard(self.node_id)
+        await super().stop()
+
+    async def register(self, user_id: str) -> None:
+        self.hub.registry.setdefault(user_id, set()).add(self.node_id)
+
+    async def unregister(self, user_id: str) -> None:
+        nodes = self.hub.registry.get(user_id)
+        if nodes is not None:
+            nodes.discard(self.node_id)
+            if not nodes:
+                del self.hub.registry[user_id]
+
+    async def nodes_for(self, user_id: str) -> set:
+        return set(self.hub.registry.get(user_id, ()))
+
+    async def _send(self, node_id: str, envelope: Dict[str, Any]) -> None:
+        node = self.hub.nodes.get(node_id)
+        if node is not None:
+            await node._dispatch(envelope)
+
+    async def _send_all(self, envelope: Dict[str, Any]) -> None:
+        for node in list(self.hub.nodes.values()):
+            await node._dispatch(envelope)
+
+
+class RedisBackplane(WebSocketBackplane):
+    # A pub/sub channel per node plus one broadcast channel. The registry is a
+    # set of node ids per user, filtered by each node's expiring liveness key so
+    # a crashed node stops receiving traffic after WS_PRESENCE_TTL.
+    BROADCAST_CHANNEL = "ws:all"
+
+    def __init__(self, url: str, node_id: Optional[str] = None) -> None:
+        super().__init__(node_id)
+        if aioredis is None:
+            raise RuntimeError("WS_BACKPLANE=redis requires the 'redis' package")
+        self.redis = aioredis.from_url(url, decode_responses=True)
+        self._tasks: List[asyncio.Task] = []
+        self._registered: set = set()  # users with sockets here, re-added if our entries were pruned
+
+    @staticmethod
+    def _channel(node_id: str) -> str:
+        return f"ws:node:{node_id}"
+
+    @staticmethod
+    def _alive_key(node_id: str) -> str:
+        return f"ws:alive:{node_id}"
+
+    @staticmethod
+    def _user_key(user_id: str) -> str:
+        return f"ws:user:{user_id}"
+
+    async def start(self, handler: Callable[[Dict[str, Any]], Any]) -> None:
+        await super().start(handler)
+        await self.redis.set(self._alive_key(self.node_id), "1", ex=settings.ws_presence_ttl_seconds)
+        self._tasks = [asyncio.create_task(self._listen()), asyncio.create_task(self._heartbeat())]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await self.redis.delete(self._alive_key(self.node_id))
+        await super().stop()
+
+    async def _heartbeat(self) -> None:
+        key = self._alive_key(self.node_id)
+        while True:
+            await asyncio.sleep(settings.ws_presence_ttl_seconds / 3)
+            try:
+                if not await self.redis.expire(key, settings.ws_presence_ttl_seconds):
+                    # the key lapsed (Redis outage): peers may have pruned us from user sets
+                    await self.redis.set(key, "1", ex=settings.ws_presence_ttl_seconds)
+                    for user_id in list(self._registered):
+                        await self.redis.sadd(self._user_key(user_id), self.node_id)
+            except Exception:  # noqa: BLE001
+                logger.warning("redis backplane heartbeat failed", exc_info=True)
+
+    async def _listen(self) -> None:
+        while True:
+            pubsub = self.redis.pubsub()
+            try:
+                await pubsub.subscribe(self._channel(self.node_id), self.BROADCAST_CHANNEL)
+                async for msg in pubsub.listen():
+                    if msg.get("type") != "message":
+                        continue
+                    try:
+                        envelope = json.loads(msg["data"])
+                    except ValueError:
+                        continue
+                    await self._dispatch(envelope)
+            except asyncio.CancelledError:
+                raise
+            except Exception:  # noqa: BLE001
+                logger.warning("redis backplane subscription failed; resubscribing", exc_info=True)
+                await asyncio.sleep(1)
+            finally:
+                try:
+                    await pubsub.close()
+                except Exception:  # noqa: BLE001
+                    pass
+
+    async def register(self, user_id: str) -> None:
+        self._registered.add(user_id)
+        await self.redis.sadd(self._user_key(user_id), self.node_id)
+
+    async def unregister(self, user_id: str) -> None:
+        self._registered.discard(user_id)
+        await self.redis.srem(self._user_key(user_id), self.node_id)
+
+    async def nodes_for(self, user_id: str) -> set:
+        key = self._user_key(user_id)
+        members = list(await self.redis.smembers(key))
+        if not members:
+            return set()
+        alive = await self.redis.mget([self._alive_key(n) for n in members])
+        dead = [n for n, a in zip(members, alive) if a is None]
+        if dead:
+            # ids left behind by restarted or crashed workers
+            await self.redis.srem(key, *dead)
+        return {n for n, a in zip(members, alive) if a is not None}
+
+    async def _send(self, node_id: str, envelope: Dict[str, Any]) -> None:
+        await self.redis.publish(self._channel(node_id), json.dumps(envelope, default=str))
+
+    async def _send_all(self, envelope: Dict[str, Any]) -> None:
+        await self.redis.publish(self.BROADCAST_CHANNEL, json.dumps(envelope, default=str))
+
+
+class MongoBackplane(WebSocketBackplane):
+    # Messages are rows in ws_messages tailed with a change stream (needs a
+    # replica set); presence rows in ws_presence expire unless their node
+    # keeps refreshing them.
+    def __init__(self, node_id: Optional[str] = None) -> None:
+        super().__init__(node_id)
+        self._tasks: List[asyncio.Task] = []
+
+    async def start(self, handler: Callable[[Dict[str, Any]], Any]) -> None:
+        await super().start(handler)
+        self._tasks = [asyncio.create_task(self._listen()), asyncio.create_task(self._heartbeat())]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await WsPresence.get_motor_collection().delete_many({"node_id": self.node_id})
+        await super().stop()
+
+    async def _heartbeat(self) -> None:
+        while True:
+            await asyncio.sleep(settings.ws_presence_ttl_seconds / 3)
+            try:
+                await WsPresence.get_motor_collection().update_many(
+                    {"node_id": self.node_id}, {"$set": {"updated_at": datetime.now(timezone.utc)}}
+                )
+            except Exception:  # noqa: BLE001
+                logger.warning("mongo backplane heartbeat failed", exc_info=True)
+
+    async def _listen(self) -> None:
+        pipeline = [{"$match": {"operationType": "insert", "fullDocument.target": {"$in": [self.node_id, "*"]}}}]
+        while True:
+            try:
+                async with WsMessage.get_motor_collection().watch(pipeline) as stream:
+                    async for change in stream:
+                        await self._dispatch(change["fullDocument"]["envelope"])
+            except asyncio.CancelledError:
+                raise
+            except Exception:  # noqa: BLE001
+                logger.warning("mongo backplane change stream failed; reconnecting", exc_info=True)
+                await asyncio.sleep(1)
+
+    async def register(self, user_id: str) -> None:
+        await WsPresence.get_motor_collection().update_one(
+            {"user_id": user_id, "node_id": self.node_id},
+            {"$set": {"updated_at": datetime.now(timezone.utc)}},
+            upsert=True,
+        )
 
-    async def connect(self, user_id: str, websocket: WebSocket) -> None:
-        await websocket.accept()
-        self.user_connections.setdefault(user_id, []).append(websocket)
+    async def unregister(self, user_id: str) -> None:
+        await WsPresence.get_motor_collection().delete_one({"user_id": user_id, "node_id": self.node_id})
+
+    async def nodes_for(self, user_id: str) -> set:
+        return set(await WsPresence.get_motor_collection().distinct("node_id", {"user_id": user_id}))
+
+    async def _send(self, node_id: str, envelope: Dict[str, Any]) -> None:
+        await WsMessage.get_motor_collection().insert_one({"target": node_id, "envelope": envelope, "created_at": datetime.now(timezone.utc)})
+
+    async def _send_all(self, envelope: Dict[str, Any]) -> None:
+        await self._send("*", envelope)
+
+
+def _make_backplane() -> WebSocketBackplane:
+    if settings.ws_backplane == "redis":
+        return RedisBackplane(settings.redis_url)
+    if settings.ws_backplane == "mongo":
+        return MongoBackplane()
+    return InMemoryBackplane()
+
+
+def encode_ws_message(message: Dict[str, Any]) -> str:
+    # Encoded once per push and shared by every socket it goes to
+    return json.dumps(message, separators=(",", ":"), default=str)
 
-    def disconnect(self, user_id: str, websocket: WebSocket) -> None:
-        conns = self.user_connections.get(user_id, [])
-        if websocket in conns:
-            conns.remove(websocket)
-        if not conns and user_id in self.user_connections:
-            del self.user_connections[user_id]
+
+class WsConnection:
+    __slots__ = ("user_id", "websocket", "queue", "writer", "closed", "last_seen", "held", "audiences", "heartbeat")
+
+    def __init__(self, user_id: str, websocket: WebSocket, audiences: tuple = ("all",), heartbeat: bool = False) -> None:
+        self.user_id = user_id
+        self.audiences = audiences  # broadcast audiences this socket receives
+        self.heartbeat = heartbeat  # client opted into app-level ping/pong and idle reaping
+        self.websocket = websocket
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max(1, settings.ws_send_queue_size))
+        self.writer: Optional[asyncio.Task] = None
+        self.closed = False
+        self.last_seen = time.monotonic()  # last inbound frame (pong or anything else)
+        self.held: Optional[List[tuple]] = None  # live (key, text) pushes parked during replay
+
+
+class ConnectionManager:
+    # Sockets held by this worker; pushes for other workers' sockets arrive
+    # through the backplane and land in deliver_local. Each socket has its own
+    # bounded queue drained by a writer task, so a fan-out only enqueues and a
+    # stalled client can delay nobody but itself.
+    def __init__(self, backplane: WebSocketBackplane) -> None:
+        self.backplane = backplane
+        self.user_connections: Dict[str, List[WsConnection]] = {}
+        self.evicted_slow = 0
+        self.send_failures = 0
+        self.reaped_idle = 0
+        self._closing: set = set()
+        self._heartbeat_task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self._heartbeat_task is None:
+            self._heartbeat_task = asyncio.create_task(self._heartbeat())
+
+    async def stop(self) -> None:
+        if self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
+            await asyncio.gather(self._heartbeat_task, return_exceptions=True)
+            self._heartbeat_task = None
+
+    async def _heartbeat(self) -> None:
+        # Only for heartbeat sockets. Pings go through the send queues like any
+        # push, so a client that stops reading is caught by eviction and one that
+        # stops answering by the reaper.
+        while True:
+            await asyncio.sleep(settings.ws_heartbeat_interval_seconds)
+            try:
+                self.reap_idle()
+                ping = encode_ws_message({"type": "ping", "ts": int(time.time())})
+                for conns in list(self.user_connections.values()):
+                    for conn in list(conns):
+                        if conn.heartbeat:
+                            self._enqueue(conn, ping)
+            except Exception:  # noqa: BLE001
+                logger.exception("websocket heartbeat failed")
+
+    def reap_idle(self) -> int:
+        cutoff = time.monotonic() - settings.ws_idle_timeout_seconds
+        reaped = 0
+        for conns in list(self.user_connections.values()):
+            for conn in list(conns):
+                if conn.heartbeat and conn.last_seen < cutoff:
+                    self._evict(conn, code=1001)
+                    reaped += 1
+        self.reaped_idle += reaped
+        return reaped
+
+    def touch(self, conn: WsConnection) -> None:
+        conn.last_seen = time.monotonic()
+
+    async def connect(self, user_id: str, websocket: WebSocket, audiences: tuple = ("all",), heartbeat: bool = False) -> WsConnection:
+        await websocket.accept()
+        conn = WsConnection(user_id, websocket, audiences, heartbeat)
+        conn.writer = asyncio.create_task(self._writer(conn))
+        conns = self.user_connections.setdefault(user_id, [])
+        conns.append(conn)
+        if len(conns) == 1:
+            await self.backplane.register(user_id)
+        return conn
+
+    async def disconnect(self, user_id: str, websocket: WebSocket) -> None:
+        for conn in list(self.user_connections.get(user_id, [])):
+            if conn.websocket is websocket:
+                await self.drop(conn)
+
+    async def drop(self, conn: WsConnection, code: int = 1000) -> None:
+        if conn.closed:
+            return
+        conn.closed = True
+        conns = self.user_connections.get(conn.user_id, [])
+        if conn in conns:
+            conns.remove(conn)
+        last = not conns and self.user_connections.pop(conn.user_id, None) is not None
+        if conn.writer is not None and conn.writer is not asyncio.current_task():
+            conn.writer.cancel()
+        if conn.websocket.client_state == WebSocketState.CONNECTED:
+            try:
+                # the peer may be the stalled client that got it dropped; don't hang on it too
+                await asyncio.wait_for(conn.websocket.close(code=code), timeout=settings.ws_send_timeout_seconds)
+            except Exception:  # noqa: BLE001
+                pass
+        if last:
+            await self.backplane.unregister(conn.user_id)
+
+    def _evict(self, conn: WsConnection, code: int) -> None:
+        # Called from synchronous fan-out; the close itself runs in the background
+        task = asyncio.create_task(self.drop(conn, code))
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+
+    async def _writer(self, conn: WsConnection) -> None:
+        while True:
+            text = await conn.queue.get()
+            try:
+                await asyncio.wait_for(conn.websocket.send_text(text), timeout=settings.ws_send_timeout_seconds)
+            except asyncio.CancelledError:
+                raise
+            except Exception:  # noqa: BLE001
+                self.send_failures += 1
+                await self.drop(conn, code=1011)
+                return
+
+    def _enqueue(self, conn: WsConnection, text: str, key: Optional[tuple] = None) -> None:
+        # key identifies a notification for replay dedup: ("user", seq) or (audience, bseq)
+        if conn.closed:
+            return
+        if conn.websocket.client_state != WebSocketState.CONNECTED:
+            self._evict(conn, code=1000)
+            return
+        if conn.held is not None:
+            # replay in progress: park live pushes so they can't overtake it
+            if len(conn.held) >= conn.queue.maxsize:
+                self.evicted_slow += 1
+                self._evict(conn, code=1013)
+            else:
+                conn.held.append((key, text))
+            return
+        try:
+            conn.queue.put_nowait(text)
+        except asyncio.QueueFull:
+            self.evicted_slow += 1
+            self._evict(conn, code=1013)  # try again later
+
+    def send(self, conn: WsConnection, message: Dict[str, Any]) -> None:
+        self._enqueue(conn, encode_ws_message(message))
+
+    async def replay(self, conn: WsConnection, since: Optional[int], broadcast_since: Optional[Dict[str, int]] = None) -> None:
+        # Sends this user's notifications with seq > since and the broadcasts
+        # with bseq above the per-audience cursors, oldest first, then the live
+        # pushes that arrived meanwhile minus any the replay sent. Seqs are
+        # reserved before insert, so a parked push below the replay's last seq
+        # may still be one the query could not see yet.
+        conn.held = []
+        sent: set = set()
+        last = since
+        last_b = dict(broadcast_since or {})
+        truncated = False
+
+        async def put(message: Dict[str, Any]) -> None:
+            # blocking put: the replay is paced by this client's writer
+            await asyncio.wait_for(conn.queue.put(encode_ws_message(message)), timeout=settings.ws_send_timeout_seconds)
+
+        try:
+            principal = await load_principal(conn.user_id)
+            if since is not None:
+                items = await replay_notifications(conn.user_id, since, settings.ws_replay_limit + 1)
+                truncated = len(items) > settings.ws_replay_limit
+                for notif in items[:settings.ws_replay_limit]:
+                    await put(notification_message(notif))
+                    sent.add(("user", notif.seq))
+                    last = notif.seq
+            for audience, bsince in (broadcast_since or {}).items():
+                if principal is None or audience not in conn.audiences:
+                    continue
+                items = await replay_broadcasts(principal, audience, bsince, settings.ws_replay_limit + 1)
+                truncated = truncated or len(items) > settings.ws_replay_limit
+                for notif in items[:settings.ws_replay_limit]:
+                    await put(notification_message(notif))
+                    sent.add((audience, notif.bseq))
+                    last_b[audience] = notif.bseq
+            unread = await notification_unread_total(principal) if principal else 0
+            await put({"type": "resync" if truncated else "replay_done", "seq": last, "bseq": last_b, "unread": unread})
+        except asyncio.TimeoutError:
+            self.evicted_slow += 1
+            await self.drop(conn, code=1013)
+            return
+        finally:
+            held, conn.held = conn.held or [], None
+        for key, text in held:
+            if key is None or key not in sent:
+                self._enqueue(conn, text, key)
 
     async def send_to_user(self, user_id: str, message: Dict[str, Any]) -> None:
-        for ws in self.user_connections.get(user_id, []):
-            if ws.client_state == WebSocketState.CONNECTED:
-                await ws.send_json(message)
+        conns = self.user_connections.get(user_id)
+        if not conns:
+            return
+        text = encode_ws_message(message)
+        key = ("user", message["seq"]) if message.get("seq") is not None else None
+        for conn in list(conns):
+            self._enqueue(conn, text, key)
+
+    async def broadcast(self, message: Dict[str, Any], audience: Optional[str] = None) -> None:
+        text = encode_ws_message(message)
+        key = (audience, message["bseq"]) if audience and message.get("bseq") is not None else None
+        for conns in list(self.user_connections.values()):
+            for conn in list(conns):
+                if audience is None or audience in conn.audiences:
+                    self._enqueue(conn, text, key)
+
+    async def deliver_local(self, envelope: Dict[str, Any]) -> None:
+        if envelope.get("user_id"):
+            await self.send_to_user(envelope["user_id"], envelope["message"])
+        else:
+            await self.broadcast(envelope["message"], envelope.get("audience"))
+
+    async def publish(self, user_id: Optional[str], message: Dict[str, Any], audience: Optional[str] = None) -> None:
+        # Cluster-wide push: reaches this user's sockets on whichever nodes hold them
+        await self.backplane.publish(user_id, message, audience)
+
+    def connection_count(self) -> int:
+        return sum(len(conns) for conns in self.user_connections.values())
+
+    def stats(self) -> Dict[str, Any]:
+        # Gauges for this worker only; sum across workers for the cluster view
+        return {
+            "node_id": self.backplane.node_id,
+            "backplane": type(self.backplane).__name__,
+            "live_connections": self.connection_count(),
+            "connected_users": len(self.user_connections),
+            "queued_messages": sum(c.queue.qsize() for conns in self.user_connections.values() for c in conns),
+            "evicted_slow": self.evicted_slow,
+            "send_failures": self.send_failures,
+            "reaped_idle": self.reaped_idle,
+        }
+
+
+ws_backplane = _make_backplane()
+ws_manager = ConnectionManager(ws_backplane)
+
+
+# ----------------------------------------------------------------------------
+# Outbox: durable email/websocket fan-out
+# ----------------------------------------------------------------------------
+
+
+async def _deliver_email(payload: Dict[str, Any]) -> None:
+    to = payload.get("to")
+    if not to and payload.get("user_id"):
+        doc = await User.get_motor_collection().find_one({"_id": ObjectId(payload["user_id"])}, projection={"email": 1})
+        if doc is None:
+            return  # account gone; nothing to deliver
+        to = doc["email"]
+    await send_email_stub(EmailMessage(to=to, subject=payload["subject"], body=payload["body"]))
+
+
+class OutboxDispatcher:
+    def __init__(self) -> None:
+        self.handlers = {"email": _deliver_email}
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._inflight: set = set()
+
+    def notify(self) -> None:
+        self._wake.set()
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        # in-flight deliveries finish or fall back to their lease
+        await asyncio.gather(*self._inflight, return_exceptions=True)
+
+    async def _claim(self) -> Optional[Dict[str, Any]]:
+        # Pending rows that are due, plus rows whose worker died mid-delivery
+        now = datetime.now(timezone.utc)
+        return await OutboxMessage.get_motor_collection().find_one_and_update(
+            {"$or": [
+                {"status": "pending", "next_attempt_at": {"$lte": now}},
+                {"status": "processing", "locked_until": {"$lt": now}},
+            ]},
+            {"$set": {"status": "processing", "locked_until": now + timedelta(seconds=settings.outbox_lease_seconds)}, "$inc": {"attempts": 1}},
+            sort=[("next_attempt_at", ASCENDING)],
+            return_document=ReturnDocument.AFTER,
+        )
+
+    async def run(self) -> None:
+        slots = asyncio.Semaphore(max(1, settings.outbox_concurrency))
+        while True:
+            await slots.acquire()
+            self._wake.clear()
+            try:
+                doc = await self._claim()
+            except Exception:  # noqa: BLE001
+                slots.release()
+                logger.exception("outbox claim failed")
+                await asyncio.sleep(settings.outbox_poll_interval_seconds)
+                continue
+            if doc is None:
+                slots.release()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout=settings.outbox_poll_interval_seconds)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            task = asyncio.create_task(self._deliver(doc, slots))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    async def drain(self) -> int:
+        # Deliver everything currently due, then return (CLI / tests)
+        delivered = 0
+        while True:
+            doc = await self._claim()
+            if doc is None:
+                return delivered
+            await self._deliver(doc, None)
+            delivered += 1
+
+    async def _deliver(self, doc: Dict[str, Any], slots: Optional[asyncio.Semaphore]) -> None:
+        coll = OutboxMessage.get_motor_collection()
+        try:
+            await self.handlers[doc["kind"]](doc["payload"])
+        except Exception as e:  # noqa: BLE001
+            attempts = doc.get("attempts", 1)
+            if attempts >= settings.outbox_max_attempts:
+                update = {"status": "failed", "last_error": repr(e), "locked_until": None}
+            else:
+                delay = min(settings.outbox_backoff_max_seconds, settings.outbox_backoff_base_seconds * (2 ** (attempts - 1)))
+                delay *= random.uniform(0.5, 1.0)
+                update = {"status": "pending", "last_error": repr(e), "locked_until": None,
+                          "next_attempt_at": datetime.now(timezone.utc) + timedelta(seconds=delay)}
+            await coll.update_one({"_id": doc["_id"]}, {"$set": update})
+        else:
+            await coll.update_one({"_id": doc["_id"]}, {"$set": {"status": "sent", "sent_at": datetime.now(timezone.utc), "locked_until": None}})
+        finally:
+            if slots is not None:
+                slots.release()
+
+
+outbox = OutboxDispatcher()
+
+
+async def enqueue_outbox(messages: List[OutboxMessage]) -> None:
+    if not messages:
+        return
+    await OutboxMessage.insert_many(messages)
+    outbox.notify()
 
-    async def broadcast(self, message: Dict[str, Any]) -> None:
-        for user_id in list(self.user_connections.keys()):
-            await self.send_to_user(user_id, message)
 
+def email_message(subject: str, body: str, to: Optional[str] = None, user_id: Optional[str] = None) -> OutboxMessage:
+    return OutboxMessage(kind="email", payload={"to": to, "user_id": user_id, "subject": subject, "body": body})
 
-ws_manager = ConnectionManager()
 
+async def enqueue_email(subject: str, body: str, to: Optional[str] = None, user_id: Optional[str] = None) -> None:
+    await enqueue_outbox([email_message(subject, body, to=to, user_id=user_id)])
 
-async def create_notification(user_id: Optional[str], ntype: Literal["payment", "referral", "task", "system"], title: str, body: str, data: Optional[Dict[str, Any]] = None, channels: Optional[List[str]] = None) -> Notification:
+
+def notification_message(notif: Notification) -> Dict[str, Any]:
+    # Websocket shape, shared by live pushes and reconnect replay
+    message = {"id": str(notif.id), "type": notif.type, "title": notif.title, "body": notif.body, "data": notif.data}
+    if notif.seq is not None:
+        message["seq"] = notif.seq
+    if notif.bseq is not None:
+        message["audience"] = notif.audience
+        message["bseq"] = notif.bseq
+    return message
+
+
+def _notification_outbox(notif: Notification) -> List[OutboxMessage]:
+    if notif.user_id and "email" in notif.channels:
+        return [email_message(notif.title, notif.body, user_id=notif.user_id)]
+    return []
+
+
+async def push_notifications(notifs: List[Notification]) -> None:
+    # Best effort, published at write time so whichever node holds the socket
+    # gets it; a client that misses one catches up with ?since= on reconnect.
+    async def push(n: Notification) -> None:
+        try:
+            await ws_manager.publish(n.user_id, notification_message(n), None if n.user_id else n.audience)
+        except Exception:  # noqa: BLE001
+            logger.warning("websocket push for notification %s failed", n.id, exc_info=True)
+
+    await asyncio.gather(*(push(n) for n in notifs))
+
+
+async def create_notification(user_id: Optional[str], ntype: Literal["payment", "referral", "task", "system"], title: str, body: str, data: Optional[Dict[str, Any]] = None, channels: Optional[List[str]] = None, audience: Literal["all", "admins"] = "all") -> Notification:
+    # user_id None stores one broadcast row for `audience` instead of a row per user
     notif = Notification(user_id=user_id, type=ntype, title=title, body=body, data=data or {}, channels=channels or ["email", "dashboard", "websocket"])
-    await notif.insert()
-    # WebSocket push
     if user_id:
-        await ws_manager.send_to_user(user_id, {"type": ntype, "title": title, "body": body, "data": notif.data, "id": str(notif.id)})
+        notif.seq = (await allocate_notification_seqs({user_id: 1}))[user_id]
     else:
-        await ws_manager.broadcast({"type": ntype, "title": title, "body": body, "data": notif.data})
-    # Email channel
-    if user_id and ("email" in notif.channels):
-        u = await User.get(user_id)
-        if u:
-            await send_email_stub(EmailMessage(to=u.email, subject=title, body=body))
+        notif.audience = audience
+        notif.bseq = await allocate_broadcast_seq(audience)
+    await notif.insert()
+    # Email goes out through the outbox dispatcher, the websocket push via the backplane
+    await enqueue_outbox(_notification_outbox(notif))
+    await push_notifications([notif])
     return notif
 
 
+async def create_notifications_bulk(notifs: List[Notification]) -> List[Notification]:
+    # Same channels as create_notification with one insert_many per collection
+    if not notifs:
+        return notifs
+    counts: Dict[str, int] = {}
+    for n in notifs:
+        n.id = PydanticObjectId()
+        if n.user_id:
+            counts[n.user_id] = counts.get(n.user_id, 0) + 1
+    last = await allocate_notification_seqs(counts)
+    for n in reversed(notifs):
+        if n.user_id:
+            n.seq = last[n.user_id]
+            last[n.user_id] -= 1
+    await Notification.insert_many(notifs)
+    await enqueue_outbox([item for n in notifs for item in _notification_outbox(n)])
+    await push_notifications(notifs)
+    return notifs
+
+
+async def allocate_notification_seqs(counts: Dict[str, int]) -> Dict[str, int]:
+    # Reserves `n` sequence numbers per user and counts them as unread in the
+    # same write; returns each user's highest reserved seq. Seqs are taken
+    # before the rows are inserted, so a failed insert leaves a gap, never a repeat.
+    coll = NotificationState.get_motor_collection()
+
+    async def one(uid: str, n: int) -> int:
+        doc = await coll.find_one_and_update(
+            {"user_id": uid},
+            {"$inc": {"last_seq": n, "unread": n}, "$set": {"updated_at": datetime.now(timezone.utc)}},
+            projection={"last_seq": 1},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        return doc["last_seq"]
+
+    items = [(uid, n) for uid, n in counts.items() if n]
+    seqs = await asyncio.gather(*(one(uid, n) for uid, n in items))
+    return {uid: seq for (uid, _), seq in zip(items, seqs)}
+
+
+async def notification_unread_inc(counts: Dict[str, int]) -> None:
+    # No upsert: read marks only ever apply to a row allocate_notification_seqs
+    # created, and a row that was never counted is recounted on first read.
+    ops = [
+        UpdateOne({"user_id": uid}, {"$inc": {"unread": n}, "$set": {"updated_at": datetime.now(timezone.utc)}})
+        for uid, n in counts.items() if n
+    ]
+    if ops:
+        await NotificationState.get_motor_collection().bulk_write(ops, ordered=False)
+
+
+async def rebuild_notification_state(user_id: str) -> NotificationState:
+    unread = await Notification.find(Notification.user_id == user_id, Notification.is_read == False).count()  # noqa: E712
+    await NotificationState.get_motor_collection().update_one(
+        {"user_id": user_id},
+        {"$set": {"unread": unread, "unread_synced": True, "updated_at": datetime.now(timezone.utc)}},
+        upsert=True,
+    )
+    return await NotificationState.find_one(NotificationState.user_id == user_id)
+
+
+async def get_notification_state(user_id: str) -> NotificationState:
+    # Rows first created by a seq allocation only count what arrived since;
+    # accounts with older unread rows get one full recount.
+    state = await NotificationState.find_one(NotificationState.user_id == user_id)
+    if state is None or not state.unread_synced:
+        state = await rebuild_notification_state(user_id)
+    return state
+
+
+async def allocate_broadcast_seq(audience: str) -> int:
+    doc = await BroadcastCounter.get_motor_collection().find_one_and_update(
+        {"audience": audience}, {"$inc": {"seq": 1}}, upsert=True, return_document=ReturnDocument.AFTER
+    )
+    return doc["seq"]
+
+
+def notification_audiences(user: Principal) -> List[str]:
+    return ["all", "admins"] if user.is_admin else ["all"]
+
+
+def notification_feed_query(user: Principal) -> Dict[str, Any]:
+    # The user's own rows plus the broadcasts for their audiences since they joined
+    return {"$or": [
+        {"user_id": str(user.id)},
+        {"user_id": None, "audience": {"$in": notification_audiences(user)}, "created_at": {"$gte": user.created_at}},
+    ]}
+
+
+async def broadcast_read_state(user: Principal, state: NotificationState) -> Dict[str, int]:
+    # Watermark per audience. A missing one starts at the last broadcast
+    # before the user joined, matching the feed's created_at bound.
+    coll = NotificationState.get_motor_collection()
+    watermarks = dict(state.broadcast_read_seq)
+    for audience in notification_audiences(user):
+        if audience in watermarks:
+            continue
+        before = await Notification.get_motor_collection().find_one(
+            {"user_id": None, "audience": audience, "created_at": {"$lt": user.created_at}, "bseq": {"$ne": None}},
+            projection={"bseq": 1}, sort=[("bseq", DESCENDING)],
+        )
+        mark = before["bseq"] if before else 0
+        await coll.update_one(
+            {"user_id": str(user.id), f"broadcast_read_seq.{audience}": {"$exists": False}},
+            {"$set": {f"broadcast_read_seq.{audience}": mark}},
+        )
+        watermarks[audience] = mark
+    return watermarks
+
+
+async def broadcast_counters() -> Dict[str, int]:
+    return {d["audience"]: d["seq"] async for d in BroadcastCounter.get_motor_collection().find({})}
+
+
+async def notification_unread_total(user: Principal) -> int:
+    # O(1): the user's counter plus, per audience, counter - watermark - read above it
+    state = await get_notification_state(str(user.id))
+    watermarks = await broadcast_read_state(user, state)
+    counters = await broadcast_counters()
+    unread = max(0, state.unread)
+    for audience, mark in watermarks.items():
+        if audience in notification_audiences(user):
+            unread += max(0, counters.get(audience, 0) - mark - len(state.broadcast_read.get(audience, [])))
+    return unread
+
+
+async def mark_broadcast_read(user: Principal, audience: str, bseq: int) -> None:
+    coll = NotificationState.get_motor_collection()
+    state = await get_notification_state(str(user.id))
+    await broadcast_read_state(user, state)
+    uid = str(user.id)
+    await coll.update_one(
+        {"user_id": uid, f"broadcast_read_seq.{audience}": {"$lt": bseq}},
+        {"$addToSet": {f"broadcast_read.{audience}": bseq}},
+    )
+    # fold a contiguous run above the watermark into it so the list stays short
+    doc = await coll.find_one({"user_id": uid}, projection={"broadcast_read_seq": 1, "broadcast_read": 1})
+    mark = doc["broadcast_read_seq"][audience]
+    read = set(doc.get("broadcast_read", {}).get(audience, []))
+    new_mark = mark
+    while new_mark + 1 in read:
+        new_mark += 1
+    if new_mark > mark:
+        await coll.update_one(
+            {"user_id": uid, f"broadcast_read_seq.{audience}": mark},
+            {"$set": {f"broadcast_read_seq.{audience}": new_mark}, "$pull": {f"broadcast_read.{audience}": {"$lte": new_mark}}},
+        )
+
+
+async def mark_all_broadcasts_read(user: Principal) -> None:
+    counters = await broadcast_counters()
+    audiences = notification_audiences(user)
+    if not any(counters.get(a) for a in audiences):
+        return
+    await get_notification_state(str(user.id))
+    # $max so a concurrent compaction can't move a watermark backwards
+    await NotificationState.get_motor_collection().update_one(
+        {"user_id": str(user.id)},
+        {
+            "$max": {f"broadcast_read_seq.{a}": counters.get(a, 0) for a in audiences},
+            "$pull": {f"broadcast_read.{a}": {"$lte": counters.get(a, 0)} for a in audiences},
+        },
+    )
+
+
+async def replay_notifications(user_id: str, since: int, limit: int) -> List[Notification]:
+    return await Notification.find(Notification.user_id == user_id, Notification.seq > since)\
+        .sort("seq").limit(limit).to_list()
+
+
+async def replay_broadcasts(user: Principal, audience: str, since: int, limit: int) -> List[Notification]:
+    # Same bounds as the feed: only broadcasts created since the user joined
+    return await Notification.find(
+        {"user_id": None, "audience": audience, "bseq": {"$gt": since}, "created_at": {"$gte": user.created_at}}
+    ).sort("bseq").limit(limit).to_list()
+
+
+# ----------------------------------------------------------------------------
+# Wallet ledger (materialized running totals)
+# ----------------------------------------------------------------------------
+
+
+PAYOUT_RESERVED_STATUSES = ("pending", "approved")
+PAYOUT_WITHDRAWN_STATUSES = ("sent",)
+WALLET_EPSILON_USD = 0.005
+WALLET_TOTAL_FIELDS = ("earned_usd", "withdrawn_usd", "reserved_usd", "commission_count", "payout_sent_count")
+
+
+def wallet_view(wallet: Wallet) -> Dict[str, float]:
+    balance = round(wallet.earned_usd - wallet.withdrawn_usd, 2)
+    return {
+        "earned_usd": round(wallet.earned_usd, 2),
+        "withdrawn_usd": round(wallet.withdrawn_usd, 2),
+        "reserved_usd": round(wallet.reserved_usd, 2),
+        "balance_usd": balance,
+        "available_usd": round(balance - wallet.reserved_usd, 2),
+    }
+
+
+async def wallet_inc(user_id: str, earned: float = 0.0, withdrawn: float = 0.0, reserved: float = 0.0, commissions: int = 0, payouts_sent: int = 0) -> None:
+    deltas = zip(WALLET_TOTAL_FIELDS, (earned, withdrawn, reserved, commissions, payouts_sent))
+    inc = {k: v for k, v in deltas if v}
+    if not inc:
+        return
+    # Upserts: pre-ledger accounts got their wallet from the one-time
+    # "python server.py wallets rebuild" migration, so a missing document means
+    # no history yet and counting from zero is exact.
+    await Wallet.get_motor_collection().update_one(
+        {"user_id": user_id},
+        {"$inc": inc, "$set": {"updated_at": datetime.now(timezone.utc)}},
+        upsert=True,
+    )
+    invalidate_user_summary(user_id)
+
+
+def _empty_wallet_totals() -> Dict[str, float]:
+    return {k: 0 for k in WALLET_TOTAL_FIELDS}
+
+
+async def compute_wallet_totals(user_id: str) -> Dict[str, float]:
+    earned = await Commission.aggregate([
+        {"$match": {"user_id": user_id}},
+        {"$group": {"_id": None, "total": {"$sum": "$amount_usd"}, "count": {"$sum": 1}}},
+    ]).to_list()
+    by_status = await PayoutRequest.aggregate([
+        {"$match": {"user_id": user_id}},
+        {"$group": {"_id": "$status", "total": {"$sum": "$amount_usd"}, "count": {"$sum": 1}}},
+    ]).to_list()
+    totals = _empty_wallet_totals()
+    if earned:
+        totals["earned_usd"] = earned[0]["total"]
+        totals["commission_count"] = earned[0]["count"]
+    for row in by_status:
+        if row["_id"] in PAYOUT_WITHDRAWN_STATUSES:
+            totals["withdrawn_usd"] += row["total"]
+            totals["payout_sent_count"] += row["count"]
+        elif row["_id"] in PAYOUT_RESERVED_STATUSES:
+            totals["reserved_usd"] += row["total"]
+    return totals
+
+
+async def rebuild_wallet(user_id: str) -> Wallet:
+    totals = await compute_wallet_totals(user_id)
+    await Wallet.get_motor_collection().update_one(
+        {"user_id": user_id},
+        {"$set": {**totals, "updated_at": datetime.now(timezone.utc)}},
+        upsert=True,
+    )
+    return await Wallet.find_one(Wallet.user_id == user_id)
+
+
+async def get_wallet(user_id: str) -> Wallet:
+    # Never rebuilt on read: a $set of totals computed before a concurrent
+    # commission would overwrite (or, without a document, drop) its increment.
+    wallet = await Wallet.find_one(Wallet.user_id == user_id)
+    if wallet is None:
+        try:
+            await Wallet.get_motor_collection().update_one(
+                {"user_id": user_id},
+                {"$setOnInsert": {**_empty_wallet_totals(), "updated_at": datetime.now(timezone.utc)}},
+                upsert=True,
+            )
+        except DuplicateKeyError:
+            pass  # created concurrently
+        wallet = await Wallet.find_one(Wallet.user_id == user_id)
+    return wallet
+
+
+async def wallet_reserve(user_id: str, amount_usd: float) -> bool:
+    # Atomically move funds into "reserved" only if the available balance covers it
+    await get_wallet(user_id)
+    available = {"$subtract": ["$earned_usd", {"$add": ["$withdrawn_usd", "$reserved_usd"]}]}
+    res = await Wallet.get_motor_collection().update_one(
+        {"user_id": user_id, "$expr": {"$gte": [available, amount_usd - WALLET_EPSILON_USD]}},
+        {"$inc": {"reserved_usd": amount_usd}, "$set": {"updated_at": datetime.now(timezone.utc)}},
+    )
+    invalidate_user_summary(user_id)
+    return res.modified_count == 1
+
+
+async def insert_commission(comm: Commission) -> Commission:
+    await comm.insert()
+    await wallet_inc(comm.user_id, earned=comm.amount_usd, commissions=1)
+    await rollup_inc(comm.user_id, comm.created_at, {"commissions_usd": comm.amount_usd})
+    return comm
+
+
+async def insert_commissions(comms: List[Commission]) -> List[Commission]:
+    # Returns the rows actually inserted. Rows already present for the same
+    # transaction (a retried webhook) are skipped, and those earners' wallets
+    # are rebuilt in case the earlier attempt stopped before its $inc.
+    if not comms:
+        return comms
+    duplicates: set = set()
+    try:
+        await Commission.insert_many(comms, ordered=False)
+    except BulkWriteError as e:
+        errors = e.details.get("writeErrors", [])
+        if any(err.get("code") != 11000 for err in errors):
+            raise
+        duplicates = {err["index"] for err in errors}
+    for uid in {comms[i].user_id for i in duplicates}:
+        await rebuild_wallet(uid)
+    comms = [c for i, c in enumerate(comms) if i not in duplicates]
+    if not comms:
+        return comms
+    earned: Dict[str, Dict[str, float]] = {}
+    for c in comms:
+        inc = earned.setdefault(c.user_id, {"earned_usd": 0.0, "commission_count": 0})
+        inc["earned_usd"] += c.amount_usd
+        inc["commission_count"] += 1
+    now = datetime.now(timezone.utc)
+    await Wallet.get_motor_collection().bulk_write([
+        UpdateOne({"user_id": uid}, {"$inc": inc, "$set": {"updated_at": now}}, upsert=True)
+        for uid, inc in earned.items()
+    ], ordered=False)
+    invalidate_user_summary(*earned)
+    await rollup_inc_many([_rollup_op(c.user_id, c.created_at, {"commissions_usd": c.amount_usd}) for c in comms])
+    return comms
+
+
+async def set_payout_status(pr: PayoutRequest, new_status: str, admin_note: Optional[str] = None) -> bool:
+    # Compare-and-set on the previous status so concurrent admin actions
+    # cannot apply the same wallet transition twice.
+    old_status = pr.status
+    update: Dict[str, Any] = {"status": new_status}
+    if admin_note is not None:
+        update["admin_note"] = admin_note
+    if old_status == new_status:
+        if admin_note is not None:
+            pr.admin_note = admin_note
+            await pr.save()
+        return True
+    res = await PayoutRequest.get_motor_collection().update_one({"_id": pr.id, "status": old_status}, {"$set": update})
+    if res.modified_count != 1:
+        return False
+    pr.status = new_status
+    if admin_note is not None:
+        pr.admin_note = admin_note
+    invalidate_user_summary(pr.user_id)
+
+    def buckets(s: str) -> tuple:
+        sent = s in PAYOUT_WITHDRAWN_STATUSES
+        return (pr.amount_usd if sent else 0.0, pr.amount_usd if s in PAYOUT_RESERVED_STATUSES else 0.0, 1 if sent else 0)
+
+    old_w, old_r, old_n = buckets(old_status)
+    new_w, new_r, new_n = buckets(new_status)
+    await wallet_inc(pr.user_id, withdrawn=new_w - old_w, reserved=new_r - old_r, payouts_sent=new_n - old_n)
+    return True
+
+
+async def verify_wallets(fix: bool = False, sample_limit: int = 100) -> Dict[str, Any]:
+    # Recompute every wallet from the raw collections in two grouped scans and
+    # report (optionally repair) any drift from the materialized totals.
+    expected: Dict[str, Dict[str, float]] = {}
+
+    def slot(uid: str) -> Dict[str, float]:
+        return expected.setdefault(uid, _empty_wallet_totals())
+
+    async for row in Commission.get_motor_collection().aggregate([
+        {"$group": {"_id": "$user_id", "total": {"$sum": "$amount_usd"}, "count": {"$sum": 1}}},
+    ]):
+        slot(row["_id"]).update(earned_usd=row["total"], commission_count=row["count"])
+    async for row in PayoutRequest.get_motor_collection().aggregate([
+        {"$match": {"status": {"$in": list(PAYOUT_WITHDRAWN_STATUSES + PAYOUT_RESERVED_STATUSES)}}},
+        {"$group": {"_id": {"user_id": "$user_id", "status": "$status"}, "total": {"$sum": "$amount_usd"}, "count": {"$sum": 1}}},
+    ]):
+        totals = slot(row["_id"]["user_id"])
+        if row["_id"]["status"] in PAYOUT_WITHDRAWN_STATUSES:
+            totals["withdrawn_usd"] += row["total"]
+            totals["payout_sent_count"] += row["count"]
+        else:
+            totals["reserved_usd"] += row["total"]
+
+    checked = 0
+    drift: List[Dict[str, Any]] = []
+    seen: set = set()
+    async for w in Wallet.get_motor_collection().find({}, projection={k: 1 for k in ("user_id",) + WALLET_TOTAL_FIELDS}):
+        checked += 1
+        uid = w["user_id"]
+        seen.add(uid)
+        want = expected.get(uid, _empty_wallet_totals())
+        if any(abs(w.get(k, 0) - v) > WALLET_EPSILON_USD for k, v in want.items()):
+            drift.append({"user_id": uid, "stored": {k: w.get(k, 0) for k in want}, "expected": want})
+    missing = [uid for uid in expected if uid not in seen]
+    for uid in missing:
+        drift.append({"user_id": uid, "stored": None, "expected": expected[uid]})
+
+    fixed = 0
+    if fix and drift:
+        now = datetime.now(timezone.utc)
+        ops = [UpdateOne({"user_id": d["user_id"]}, {"$set": {**d["expected"], "updated_at": now}}, upsert=True) for d in drift]
+        for i in range(0, len(ops), 1000):
+            res = await Wallet.get_motor_collection().bulk_write(ops[i:i + 1000], ordered=False)
+            fixed += res.modified_count + res.upserted_count
+    return {"checked": checked, "missing": len(missing), "drifted": len(drift), "fixed": fixed, "samples": drift[:sample_limit]}
+
+
+# ----------------------------------------------------------------------------
+# Daily rollups (chart time series)
+# ----------------------------------------------------------------------------
+
+
+ROLLUP_METRICS = ("referrals", "commissions_usd", "tasks_submitted", "tasks_approved", "tasks_rejected")
+
+
+def _date_key(dt: datetime) -> str:
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    d = dt.astimezone(timezone.utc).date()
+    return d.isoformat()
+
+
+def _rollup_op(user_id: str, day: datetime, deltas: Dict[str, float]) -> Optional[UpdateOne]:
+    inc = {f"metrics.{k}": v for k, v in deltas.items() if v}
+    if not inc:
+        return None
+    return UpdateOne({"user_id": user_id, "date": _date_key(day)}, {"$inc": inc}, upsert=True)
+
+
+async def rollup_inc(user_id: str, day: datetime, deltas: Dict[str, float]) -> None:
+    op = _rollup_op(user_id, day, deltas)
+    if op is not None:
+        await DailyRollup.get_motor_collection().bulk_write([op])
+
+
+async def rollup_inc_many(ops: List[Optional[UpdateOne]]) -> None:
+    ops = [op for op in ops if op is not None]
+    if ops:
+        await DailyRollup.get_motor_collection().bulk_write(ops, ordered=False)
+
+
+async def rebuild_daily_rollups(chunk_size: int = 1000) -> Dict[str, int]:
+    # Recompute every rollup row from the raw collections with $dateToString
+    # groups into a scratch collection, then swap it in with one rename so
+    # charts never read an empty or half-built collection. Increments made
+    # while it runs land in the old collection and are replaced, so it is
+    # still best run in a quiet window.
+    live = DailyRollup.get_motor_collection()
+    db = live.database
+    coll = db[f"{live.name}_rebuild_{uuid.uuid4().hex[:8]}"]
+    await coll.create_index([("user_id", ASCENDING), ("date", ASCENDING)], unique=True)
+    day = {"$dateToString": {"format": "%Y-%m-%d", "date": "$created_at"}}
+    sources = [
+        (User, "parent_referrer", {"parent_referrer": {"$ne": None}}, {"referrals": {"$sum": 1}}),
+        (Commission, "user_id", {}, {"commissions_usd": {"$sum": "$amount_usd"}}),
+        (TaskSubmission, "user_id", {"status": "submitted"}, {"tasks_submitted": {"$sum": 1}}),
+        (TaskSubmission, "user_id", {"status": "approved"}, {"tasks_approved": {"$sum": 1}}),
+        (TaskSubmission, "user_id", {"status": "rejected"}, {"tasks_rejected": {"$sum": 1}}),
+    ]
+    written = 0
+    try:
+        for model, owner_field, match, acc in sources:
+            metric = next(iter(acc))
+            ops: List[UpdateOne] = []
+            pipeline = [{"$match": match}, {"$group": {"_id": {"user_id": f"${owner_field}", "date": day}, **acc}}]
+            async for row in model.get_motor_collection().aggregate(pipeline, allowDiskUse=True):
+                ops.append(UpdateOne(row["_id"], {"$set": {f"metrics.{metric}": row[metric]}}, upsert=True))
+                if len(ops) >= chunk_size:
+                    await coll.bulk_write(ops, ordered=False)
+                    written += len(ops)
+                    ops = []
+            if ops:
+                await coll.bulk_write(ops, ordered=False)
+                written += len(ops)
+        await db.client.admin.command("renameCollection", f"{db.name}.{coll.name}", to=f"{db.name}.{live.name}", dropTarget=True)
+    except Exception:
+        await coll.drop()  # leave the live rollups untouched
+        raise
+    return {"rows_written": written}
+
+
 # ----------------------------------------------------------------------------
 # Referral & Commission Logic (stubs with simple placement)
 # ----------------------------------------------------------------------------
@@ -416,56 +2323,186 @@ def generate_referral_code(name: str) -> str:
     return f"{base}-{uuid.uuid4().hex[:8]}"
 
 
+def _binary_slot_rows(node_id: str, ancestors: List[str], depth: int, path: str, sides: List[str]) -> List[Dict[str, Any]]:
+    return [{
+        "node_id": node_id,
+        "side": side,
+        "ancestors": ancestors + [node_id],
+        "depth": depth + 1,
+        "path": path + ("L" if side == "left" else "R"),
+    } for side in sides]
+
+
+async def _insert_binary_slots(rows: List[Dict[str, Any]]) -> None:
+    # A lazy tree backfill and a registration may both open the same position
+    try:
+        await BinarySlot.get_motor_collection().insert_many(rows, ordered=False)
+    except BulkWriteError as e:
+        if any(err.get("code") != 11000 for err in e.details.get("writeErrors", [])):
+            raise
+
+
+async def open_binary_slots(user: User) -> None:
+    await _insert_binary_slots(_binary_slot_rows(str(user.id), user.binary_ancestors, user.binary_depth, user.binary_path, ["left", "right"]))
+
+
+async def _claim_binary_slot(new_user: User, sponsor_id: str) -> bool:
+    # Shallowest, left-most free position anywhere under the sponsor. The slot
+    # is claimed for a lease and deleted only once the child is written, so a
+    # crash in between leaves it claimable again instead of losing it.
+    slots = BinarySlot.get_motor_collection()
+    users = User.get_motor_collection()
+    uid = str(new_user.id)
+    while True:
+        now = datetime.now(timezone.utc)
+        slot = await slots.find_one_and_update(
+            {"ancestors": sponsor_id, "$or": [{"claimed_until": None}, {"claimed_until": {"$lt": now}}]},
+            {"$set": {"claimed_by": uid, "claimed_until": now + timedelta(seconds=settings.binary_slot_claim_seconds)}},
+            sort=[("depth", ASCENDING), ("path", ASCENDING)],
+            return_document=ReturnDocument.AFTER,
+        )
+        if slot is None:
+            if await slots.find_one({"ancestors": sponsor_id}, projection={"_id": 1}) is None:
+                return False
+            await asyncio.sleep(0.05)  # every free slot is claimed right now
+            continue
+        field = f"{slot['side']}_child"
+        res = await users.update_one({"_id": ObjectId(slot["node_id"]), field: None}, {"$set": {field: uid}})
+        if res.modified_count == 1:
+            break
+        # stale slot (position filled outside the frontier, or by a crashed claimer); drop it
+        await slots.delete_one({"_id": slot["_id"], "claimed_by": uid})
+    new_user.binary_parent = slot["node_id"]
+    new_user.binary_ancestors = slot["ancestors"]
+    new_user.binary_depth = slot["depth"]
+    new_user.binary_path = slot["path"]
+    await new_user.save()
+    await open_binary_slots(new_user)
+    await slots.delete_one({"_id": slot["_id"], "claimed_by": uid})
+    return True
+
+
+async def _binary_root(node_id: str) -> Optional[Dict[str, Any]]:
+    users = User.get_motor_collection()
+    projection = {"_id": 1, "binary_parent": 1, "left_child": 1, "right_child": 1}
+    seen: set = set()
+    while node_id not in seen:
+        seen.add(node_id)
+        doc = await users.find_one({"_id": ObjectId(node_id)}, projection=projection)
+        if doc is None or not doc.get("binary_parent"):
+            return doc
+        node_id = doc["binary_parent"]
+    return None  # cycle in binary_parent links
+
+
+async def backfill_binary_tree(node_id: str) -> None:
+    # Lazy migrate-tree for the one tree containing node_id, under a per-tree
+    # lease; a registration that loses the race waits for the winner instead.
+    root = await _binary_root(node_id)
+    if root is None:
+        raise RuntimeError(f"binary tree above {node_id} is broken; run migrate-tree")
+    name = f"migrate-tree:{root['_id']}"
+    owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+    leases = JobCheckpoint.get_motor_collection()
+    if await acquire_job(name, owner) is None:
+        while await leases.find_one({"name": name, "locked_until": {"$gt": datetime.now(timezone.utc)}}, projection={"_id": 1}):
+            await asyncio.sleep(0.1)
+        return
+    try:
+        if await BinarySlot.get_motor_collection().find_one({"ancestors": str(root["_id"])}, projection={"_id": 1}) is None:
+            await _migrate_binary_trees([root])
+    finally:
+        await leases.delete_one({"name": name, "owner": owner})
+
+
 async def place_in_binary_tree(new_user: User, parent: User) -> None:
-    # Simple BFS-like placement under the referrer
-    queue: List[User] = [parent]
-    while queue:
-        node = queue.pop(0)
-        if node.left_child is None:
-            node.left_child = str(new_user.id)
-            await node.save()
-            new_user.binary_parent = str(node.id)
-            await new_user.save()
-            return
-        if node.right_child is None:
-            node.right_child = str(new_user.id)
-            await node.save()
-            new_user.binary_parent = str(node.id)
-            await new_user.save()
+    for _ in range(2):
+        if await _claim_binary_slot(new_user, str(parent.id)):
             return
-        # fetch children if exist
-        left = await User.get(node.left_child) if node.left_child else None
-        right = await User.get(node.right_child) if node.right_child else None
-        if left:
-            queue.append(left)
-        if right:
-            queue.append(right)
+        # No frontier rows under this sponsor: the tree predates the frontier.
+        # Backfill its paths and slots first so placement never writes a child
+        # with empty ancestors or a wrong depth.
+        await backfill_binary_tree(str(parent.id))
+    raise RuntimeError(f"no open binary slot under {parent.id} after backfill")
+
+
+async def resolve_referral_upline(user: User) -> List[str]:
+    if user.referral_ancestors or not user.parent_referrer:
+        return user.referral_ancestors[:settings.commission_max_levels]
+    # Account predates referral_ancestors: walk the chain once and persist it
+    users = User.get_motor_collection()
+    chain: List[str] = []
+    current_id: Optional[str] = user.parent_referrer
+    while current_id and len(chain) < settings.commission_max_levels:
+        doc = await users.find_one({"_id": ObjectId(current_id)}, projection={"parent_referrer": 1, "referral_ancestors": 1})
+        if doc is None:
+            break
+        chain.append(current_id)
+        if doc.get("referral_ancestors"):
+            chain += doc["referral_ancestors"]
+            break
+        current_id = doc.get("parent_referrer")
+    chain = chain[:settings.commission_max_levels]
+    await users.update_one({"_id": user.id}, {"$set": {"referral_ancestors": chain}})
+    user.referral_ancestors = chain
+    return chain
 
 
-async def record_commissions_for_referral(new_user: User, parent: User, trace_id: str) -> None:
+async def record_commissions_for_referral(new_user: User, transaction_id: str) -> None:
     # Level-based decaying commission distribution upwards
-    level = 1
-    current = parent
-    while current and level <= 10:  # cap at 10 for practicality
+    upline = await resolve_referral_upline(new_user)
+    if not upline:
+        return
+    existing = set()
+    async for doc in User.get_motor_collection().find({"_id": {"$in": [ObjectId(uid) for uid in upline]}}, projection={"_id": 1}):
+        existing.add(str(doc["_id"]))
+    comms: List[Commission] = []
+    for level, earner_id in enumerate(upline, start=1):
+        if earner_id not in existing:
+            break  # chain ends at a deleted account
         percent = max(0.0, settings.commission_base_percent - settings.commission_decay_percent * (level - 1))
         if percent <= 0:
             break
         amount = round(settings.activation_fee_usd * (percent / 100.0), 2)
-        comm = Commission(
-            user_id=str(current.id),
+        comms.append(Commission(
+            user_id=earner_id,
             source_user_id=str(new_user.id),
             level=level,
             amount_usd=amount,
             percent=percent,
             description=f"Level {level} referral commission from {new_user.email}",
-            transaction_id=trace_id,
-        )
-        await comm.insert()
-        # notify earner
-        await create_notification(str(current.id), "referral", "Referral commission earned", f"You earned ${amount} from a level {level} referral.")
-        # move up
-        current = await User.get(current.parent_referrer) if current.parent_referrer else None
-        level += 1
+            transaction_id=transaction_id,
+        ))
+    comms = await insert_commissions(comms)
+    # notify earners (only for rows this attempt inserted)
+    await create_notifications_bulk([
+        Notification(user_id=c.user_id, type="referral", title="Referral commission earned", body=f"You earned ${c.amount_usd} from a level {c.level} referral.")
+        for c in comms
+    ])
+
+
+async def migrate_referral_ancestors(chunk_size: int = 1000) -> Dict[str, int]:
+    # Backfill referral_ancestors top-down along parent_referrer
+    users = User.get_motor_collection()
+    frontier: Dict[str, List[str]] = {}
+    async for doc in users.find({"parent_referrer": None}, projection={"_id": 1}):
+        frontier[str(doc["_id"])] = []
+    updated = 0
+    while frontier:
+        next_frontier: Dict[str, List[str]] = {}
+        parent_ids = list(frontier)
+        for i in range(0, len(parent_ids), chunk_size):
+            ops = []
+            async for child in users.find({"parent_referrer": {"$in": parent_ids[i:i + chunk_size]}}, projection={"_id": 1, "parent_referrer": 1}):
+                pid = child["parent_referrer"]
+                chain = ([pid] + frontier[pid])[:settings.commission_max_levels]
+                ops.append(UpdateOne({"_id": child["_id"]}, {"$set": {"referral_ancestors": chain}}))
+                next_frontier[str(child["_id"])] = chain
+            if ops:
+                res = await users.bulk_write(ops, ordered=False)
+                updated += res.modified_count
+        frontier = next_frontier
+    return {"updated": updated}
 
 
 # ----------------------------------------------------------------------------
@@ -522,21 +2559,130 @@ def normalize_currency_code(currency: Optional[str], fallback_country: Optional[
     return detected or "USD"
 
 
+class RatesProvider(ABC):
+    @abstractmethod
+    async def fetch(self) -> Dict[str, float]:
+        ...
+
+
+class HttpRatesProvider(RatesProvider):
+    # urllib is blocking, so the request runs on a worker thread with a timeout
+    def __init__(self, url: str, timeout: float) -> None:
+        self.url = url
+        self.timeout = timeout
+
+    def _get(self) -> Dict[str, Any]:
+        with urllib.request.urlopen(self.url, timeout=self.timeout) as resp:
+            return json.loads(resp.read().decode("utf-8"))
+
+    async def fetch(self) -> Dict[str, float]:
+        data = await asyncio.wait_for(asyncio.to_thread(self._get), timeout=self.timeout + 1)
+        return data.get("rates") or {}
+
+
+class StaticRatesProvider(RatesProvider):
+    # Fixed rates for local runs and tests (CURRENCY_PROVIDER=static)
+    def __init__(self, rates: Dict[str, float]) -> None:
+        self.rates = rates
+
+    async def fetch(self) -> Dict[str, float]:
+        return dict(self.rates)
+
+
+def _default_rates_provider() -> RatesProvider:
+    if settings.currency_provider == "static":
+        return StaticRatesProvider(json.loads(settings.currency_static_rates or "{}"))
+    return HttpRatesProvider(settings.currency_api_url, settings.currency_fetch_timeout_seconds)
+
+
+class RatesRefresher:
+    # Serves whatever rates are cached (stale-while-revalidate) and coalesces
+    # refreshes into a single in-flight fetch; a background loop keeps them warm.
+    def __init__(self, provider: RatesProvider) -> None:
+        self.provider = provider
+        self._inflight: Optional[asyncio.Task] = None
+        self._loop_task: Optional[asyncio.Task] = None
+        self._loaded_snapshot = False
+
+    def _is_stale(self) -> bool:
+        return time.time() - _rates_cache.get("fetched_at", 0) >= settings.currency_cache_ttl_seconds
+
+    def _apply(self, rates: Dict[str, Any], fetched_at: float) -> None:
+        rates = {k.upper(): float(v) for k, v in rates.items()}
+        rates["USD"] = 1.0
+        _rates_cache["rates"] = rates
+        _rates_cache["fetched_at"] = fetched_at
+
+    async def _load_snapshot(self) -> None:
+        self._loaded_snapshot = True
+        try:
+            doc = await CurrencyRates.find_one(CurrencyRates.base == "USD")
+        except Exception:  # noqa: BLE001
+            logger.exception("loading persisted currency rates failed")
+            return
+        if doc and doc.rates and _rates_cache.get("fetched_at", 0) == 0:
+            fetched_at = doc.fetched_at if doc.fetched_at.tzinfo else doc.fetched_at.replace(tzinfo=timezone.utc)
+            self._apply(doc.rates, fetched_at.timestamp())
+
+    async def _refresh(self) -> None:
+        try:
+            rates = await self.provider.fetch()
+            if not isinstance(rates, dict) or not rates:
+                return
+            now = time.time()
+            self._apply(rates, now)
+            await CurrencyRates.get_motor_collection().update_one(
+                {"base": "USD"},
+                {"$set": {"rates": _rates_cache["rates"], "fetched_at": datetime.fromtimestamp(now, timezone.utc)}},
+                upsert=True,
+            )
+        except Exception:  # noqa: BLE001
+            # keep old cache on failure
+            logger.warning("currency rates refresh failed", exc_info=True)
+        finally:
+            self._inflight = None
+
+    def refresh(self) -> asyncio.Task:
+        # Single flight: every caller shares the one outstanding fetch
+        if self._inflight is None:
+            self._inflight = asyncio.create_task(self._refresh())
+        return self._inflight
+
+    async def ensure_rates(self) -> None:
+        if not self._loaded_snapshot:
+            await self._load_snapshot()
+        if not self._is_stale():
+            return
+        task = self.refresh()
+        if _rates_cache.get("fetched_at", 0) == 0:
+            # nothing to serve yet: wait for the shared fetch
+            await asyncio.shield(task)
+
+    async def _run(self) -> None:
+        while True:
+            await self.ensure_rates()
+            if self._inflight is not None:
+                await asyncio.shield(self._inflight)
+            await asyncio.sleep(max(60, settings.currency_cache_ttl_seconds))
+
+    def start(self) -> None:
+        if self._loop_task is None:
+            self._loop_task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        for task in (self._loop_task, self._inflight):
+            if task is not None:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+        self._loop_task = None
+        self._inflight = None
+
+
+rates_refresher = RatesRefresher(_default_rates_provider())
+
+
 async def _fetch_rates_if_needed() -> None:
-    now = time.time()
-    if now - _rates_cache.get("fetched_at", 0) < settings.currency_cache_ttl_seconds:
-        return
-    try:
-        with urllib.request.urlopen(settings.currency_api_url, timeout=10) as resp:
-            data = json.loads(resp.read().decode("utf-8"))
-            rates = data.get("rates") or {}
-            if isinstance(rates, dict) and rates:
-                rates["USD"] = 1.0
-                _rates_cache["rates"] = {k.upper(): float(v) for k, v in rates.items()}
-                _rates_cache["fetched_at"] = now
-    except Exception:
-        # keep old cache on failure
-        pass
+    await rates_refresher.ensure_rates()
 
 
 async def usd_to_local(amount_usd: float, currency: Optional[str]) -> Optional[float]:
@@ -643,7 +2789,7 @@ async def register(req: RegisterRequest, request: Request, background: Backgroun
         phone=req.phone,
         country=req.country,
         currency=normalize_currency_code(req.currency, req.country),
-        password_hash=hash_password(req.password),
+        password_hash=await password_hasher.hash(req.password),
         referral_code=referral_code,
         status="pending",
     )
@@ -653,15 +2799,21 @@ async def register(req: RegisterRequest, request: Request, background: Backgroun
         parent = await User.find(User.referral_code == req.referral_code).first_or_none()
         if parent:
             user.parent_referrer = str(parent.id)
+            user.referral_ancestors = ([str(parent.id)] + await resolve_referral_upline(parent))[:settings.commission_max_levels]
     await user.insert()
+    await Wallet(user_id=str(user.id)).insert()
 
-    # if parent exists, place in binary tree and notify
+    # if parent exists, place in binary tree and notify; otherwise the user roots a new tree
     if parent:
         await place_in_binary_tree(user, parent)
+        invalidate_user_summary(str(parent.id))
+        await rollup_inc(str(parent.id), user.created_at, {"referrals": 1})
         background.add_task(create_notification, str(parent.id), "referral", "New referral joined", f"{user.name} joined using your link.")
+    else:
+        await open_binary_slots(user)
 
     # Send welcome email (stub) and notify user
-    background.add_task(send_email_stub, EmailMessage(to=user.email, subject="Welcome", body="Welcome to the platform!"))
+    await enqueue_email("Welcome", "Welcome to the platform!", to=user.email)
     await create_notification(str(user.id), "system", "Welcome", "Your account was created. Activate to start earning.")
 
     data = {
@@ -675,9 +2827,14 @@ async def register(req: RegisterRequest, request: Request, background: Backgroun
 async def login(req: LoginRequest, request: Request):
     trace_id = request.state.trace_id
     user = await User.find(User.email == req.email).first_or_none()
-    if not user or not verify_password(req.password, user.password_hash):
+    valid, new_hash = await password_hasher.verify_and_update(req.password, user.password_hash) if user else (False, None)
+    if not valid:
         await FraudLog(action="login", reason="invalid_credentials", user_id=str(user.id) if user else None).insert()
         return make_response(False, "INVALID_CREDENTIALS", "Invalid email or password", http_status=401, trace_id=trace_id)
+    if new_hash:
+        # bcrypt cost changed since this hash was made; upgrade it transparently
+        await User.get_motor_collection().update_one({"_id": user.id, "password_hash": user.password_hash}, {"$set": {"password_hash": new_hash}})
+        password_hasher.rehashed += 1
 
     access = create_jwt_token(str(user.id), "access")
     refresh = create_jwt_token(str(user.id), "refresh")
@@ -703,7 +2860,7 @@ async def refresh_token(req: RefreshRequest, request: Request):
 
 
 @app.get("/users/me")
-async def get_me(user: User = Depends(get_current_user), request: Request = None):
+async def get_me(user: Principal = Depends(get_current_user), request: Request = None):
     trace_id = request.state.trace_id if request else str(uuid.uuid4())
     data = {
         "id": str(user.id),
@@ -722,30 +2879,37 @@ async def get_me(user: User = Depends(get_current_user), request: Request = None
 
 
 @app.get("/referrals/link")
-async def referral_link(user: User = Depends(get_active_user), request: Request = None):
+async def referral_link(user: Principal = Depends(get_active_user), request: Request = None):
     trace_id = request.state.trace_id if request else str(uuid.uuid4())
     link = f"{settings.frontend_base_url}/register?ref={user.referral_code}"
     return make_response(True, "REFERRAL_LINK", "Referral link", data={"link": link}, trace_id=trace_id)
 
 
 @app.get("/referrals/tree")
-async def referral_tree(user: User = Depends(get_active_user), request: Request = None):
+async def referral_tree(user: Principal = Depends(get_active_user), request: Request = None):
     trace_id = request.state.trace_id if request else str(uuid.uuid4())
 
-    async def build(node_id: Optional[str], depth: int = 0, max_depth: int = 5) -> Optional[Dict[str, Any]]:
-        if not node_id or depth > max_depth:
-            return None
-        node = await User.get(node_id)
+    max_depth = 5
+    # Whole 5-level subtree in one indexed query, assembled in memory
+    nodes: Dict[str, Dict[str, Any]] = {str(user.id): {"name": user.name, "left_child": user.left_child, "right_child": user.right_child}}
+    async for doc in User.get_motor_collection().find(
+        {"binary_ancestors": str(user.id), "binary_depth": {"$lte": user.binary_depth + max_depth}},
+        projection={"name": 1, "left_child": 1, "right_child": 1},
+    ):
+        nodes[str(doc["_id"])] = doc
+
+    def build(node_id: Optional[str]) -> Optional[Dict[str, Any]]:
+        node = nodes.get(node_id) if node_id else None
         if not node:
             return None
         return {
             "id": node_id,
-            "name": node.name,
-            "left": await build(node.left_child, depth + 1, max_depth),
-            "right": await build(node.right_child, depth + 1, max_depth),
+            "name": node["name"],
+            "left": build(node.get("left_child")),
+            "right": build(node.get("right_child")),
         }
 
-    tree = await build(str(user.id), 0, 5)
+    tree = build(str(user.id))
     return make_response(True, "REFERRAL_TREE", "Referral tree", data=tree, trace_id=trace_id)
 
 
@@ -755,7 +2919,7 @@ async def referral_tree(user: User = Depends(get_active_user), request: Request
 
 
 @app.post("/payments/activate/initiate")
-async def initiate_activation(req: PaymentInitiateRequest, user: User = Depends(get_current_user), request: Request = None):
+async def initiate_activation(req: PaymentInitiateRequest, user: Principal = Depends(get_current_user), request: Request = None):
     trace_id = request.state.trace_id if request else str(uuid.uuid4())
     # Create payment record
     pay = Payment(
@@ -769,7 +2933,7 @@ async def initiate_activation(req: PaymentInitiateRequest, user: User = Depends(
     pay.amount_local = await usd_to_local(pay.amount_usd, pay.currency)
     await pay.insert()
     # Email user with checkout details
-    await send_email_stub(EmailMessage(to=user.email, subject="Activation payment initiated", body=f"Use the checkout link to pay: https://payments.example/{req.gateway}/checkout/{pay.reference}"))
+    await enqueue_email("Activation payment initiated", f"Use the checkout link to pay: https://payments.example/{req.gateway}/checkout/{pay.reference}", to=user.email)
     data = {
         "payment_id": str(pay.id),
         "gateway": req.gateway,
@@ -783,12 +2947,89 @@ async def initiate_activation(req: PaymentInitiateRequest, user: User = Depends(
     return make_response(True, "PAYMENT_INITIATED", "Activation payment initiated", data=data, trace_id=trace_id, http_status=201)
 
 
-async def _process_payment_event(gateway: str, event: PaymentWebhook, request: Request) -> JSONResponse:
-    trace_id = request.state.trace_id
-    # idempotency: ensure event not processed
+# Recently finished event ids -> payment id; absorbs hot gateway retries without a round trip
+_recent_webhook_events = TTLCache(maxsize=settings.webhook_recent_cache_size, ttl_seconds=settings.webhook_recent_cache_ttl_seconds)
+
+
+async def claim_webhook_event(gateway: str, event_id: str) -> Optional[ProcessedEvent]:
+    # Returns the current row when someone else owns or finished the event, None when we hold the claim
+    now = datetime.now(timezone.utc)
+    lease = now + timedelta(seconds=settings.webhook_claim_lease_seconds)
+    try:
+        await ProcessedEvent(event_id=event_id, gateway=gateway, locked_until=lease).insert()
+        return None
+    except DuplicateKeyError:
+        pass
+    # take over a claim whose worker died mid-processing
+    taken = await ProcessedEvent.get_motor_collection().find_one_and_update(
+        {"event_id": event_id, "status": "processing", "locked_until": {"$lt": now}},
+        {"$set": {"locked_until": lease}},
+    )
+    if taken:
+        return None
+    return await ProcessedEvent.find_one(ProcessedEvent.event_id == event_id)
+
+
+async def release_webhook_event(event_id: str) -> None:
+    # Let a later delivery retry (e.g. the payment row did not exist yet)
+    await ProcessedEvent.get_motor_collection().delete_one({"event_id": event_id, "status": "processing"})
+
+
+async def finish_webhook_event(event_id: str, payment_id: str, result_code: str) -> None:
+    await ProcessedEvent.get_motor_collection().update_one(
+        {"event_id": event_id},
+        {"$set": {"status": "done", "payment_id": payment_id, "result_code": result_code, "locked_until": None}},
+    )
+    _recent_webhook_events.set(event_id, payment_id)
+
+
+async def _renew_webhook_claim(event_id: str) -> None:
+    # Keeps a slow attempt's claim alive so another worker cannot take it over halfway
+    coll = ProcessedEvent.get_motor_collection()
+    while True:
+        await asyncio.sleep(max(1.0, settings.webhook_claim_lease_seconds / 3))
+        try:
+            await coll.update_one(
+                {"event_id": event_id, "status": "processing"},
+                {"$set": {"locked_until": datetime.now(timezone.utc) + timedelta(seconds=settings.webhook_claim_lease_seconds)}},
+            )
+        except Exception:  # noqa: BLE001
+            logger.warning("renewing webhook claim %s failed", event_id, exc_info=True)
+
+
+def _webhook_result(success: bool, code: str, message: str, data: Optional[Dict[str, Any]] = None, http_status: int = 200) -> Dict[str, Any]:
+    return {"success": success, "code": code, "message": message, "data": data, "http_status": http_status}
+
+
+async def process_payment_event(gateway: str, event: PaymentWebhook, trace_id: str) -> Dict[str, Any]:
+    # Shared by the synchronous webhook path and the ingestion workers
+    # idempotency: in-process fast path, then an atomic claim on processed_events
+    recent = _recent_webhook_events.get(event.event_id)
+    if recent is not None:
+        return _webhook_result(True, "WEBHOOK_ALREADY_PROCESSED", "Event already processed", data={"payment_id": recent})
+    current = await claim_webhook_event(gateway, event.event_id)
+    if current is not None:
+        if current.status == "done":
+            _recent_webhook_events.set(event.event_id, current.payment_id)
+            return _webhook_result(True, "WEBHOOK_ALREADY_PROCESSED", "Event already processed", data={"payment_id": current.payment_id})
+        # non-2xx so the gateway retries if the in-flight attempt fails
+        return _webhook_result(False, "WEBHOOK_IN_PROGRESS", "Event is being processed", http_status=409)
+    renewer = asyncio.create_task(_renew_webhook_claim(event.event_id))
+    try:
+        return await _apply_payment_event(gateway, event, trace_id)
+    except Exception:
+        await release_webhook_event(event.event_id)
+        raise
+    finally:
+        renewer.cancel()
+
+
+async def _apply_payment_event(gateway: str, event: PaymentWebhook, trace_id: str) -> Dict[str, Any]:
+    # events handled before processed_events existed only carry the mark on the payment
     existing = await Payment.find(Payment.webhook_event_id == event.event_id).first_or_none()
     if existing:
-        return make_response(True, "WEBHOOK_ALREADY_PROCESSED", "Event already processed", data={"payment_id": str(existing.id)}, trace_id=trace_id)
+        await finish_webhook_event(event.event_id, str(existing.id), "WEBHOOK_ALREADY_PROCESSED")
+        return _webhook_result(True, "WEBHOOK_ALREADY_PROCESSED", "Event already processed", data={"payment_id": str(existing.id)})
 
     # Lookup payment by reference if provided
     pay = None
@@ -800,54 +3041,243 @@ async def _process_payment_event(gateway: str, event: PaymentWebhook, request: R
             .sort("-created_at").first_or_none()
     if not pay:
         await FraudLog(action="payment_webhook", reason="payment_not_found", user_id=event.user_id).insert()
-        return make_response(False, "PAYMENT_NOT_FOUND", "Payment not found", http_status=404, trace_id=trace_id)
+        await release_webhook_event(event.event_id)
+        return _webhook_result(False, "PAYMENT_NOT_FOUND", "Payment not found", http_status=404)
 
+    # The payment is stamped with the event (and its new status) only after the
+    # side effects below succeed: a failed attempt releases the claim and the
+    # retry must find the payment in its original state and run them again.
     pay.webhook_event_id = event.event_id
     pay.status = event.status
     if event.amount_usd is not None:
         pay.amount_usd = event.amount_usd
-    await pay.save()
 
     user = await User.get(pay.user_id)
     if not user:
-        return make_response(False, "USER_NOT_FOUND", "User not found", http_status=404, trace_id=trace_id)
+        await pay.save()
+        await finish_webhook_event(event.event_id, str(pay.id), "USER_NOT_FOUND")
+        return _webhook_result(False, "USER_NOT_FOUND", "User not found", http_status=404)
 
     if event.status == "confirmed":
         user.status = "active"
         user.activation_expires_at = datetime.now(timezone.utc) + timedelta(days=30 * 5)
         await user.save()
+        events.publish(USER_CHANGED, str(user.id))
+        invalidate_user_summary(user.parent_referrer)
         await create_notification(str(user.id), "payment", "Payment confirmed", f"Your {gateway} payment is confirmed. Account activated.")
         # Email confirmation
-        await send_email_stub(EmailMessage(to=user.email, subject="Payment confirmed", body="Your payment was confirmed and your account is now active."))
+        await enqueue_email("Payment confirmed", "Your payment was confirmed and your account is now active.", to=user.email)
         # Commission distribution to uplines when activation happens
         if user.parent_referrer:
-            parent = await User.get(user.parent_referrer)
-            if parent:
-                await record_commissions_for_referral(user, parent, trace_id)
+            await record_commissions_for_referral(user, event.event_id)
         code = "PAYMENT_CONFIRMED"
         msg = "Payment confirmed"
     elif event.status == "failed":
         await create_notification(str(user.id), "payment", "Payment failed", f"Your {gateway} payment failed.")
-        await send_email_stub(EmailMessage(to=user.email, subject="Payment failed", body="Your payment failed. Please try again."))
+        await enqueue_email("Payment failed", "Your payment failed. Please try again.", to=user.email)
         code = "PAYMENT_FAILED"
         msg = "Payment failed"
     else:  # reversed
         await create_notification(str(user.id), "payment", "Payment reversed", f"Your {gateway} payment was reversed.")
-        await send_email_stub(EmailMessage(to=user.email, subject="Payment reversed", body="Your payment was reversed. If this wasn't expected, contact support."))
+        await enqueue_email("Payment reversed", "Your payment was reversed. If this wasn't expected, contact support.", to=user.email)
         code = "PAYMENT_REVERSED"
         msg = "Payment reversed"
 
-    return make_response(True, code, msg, data={"payment_id": str(pay.id)}, trace_id=trace_id)
+    await pay.save()
+    await finish_webhook_event(event.event_id, str(pay.id), code)
+    return _webhook_result(True, code, msg, data={"payment_id": str(pay.id)})
+
+
+# Gateways time out and retry on slow handlers; in "queue" mode the raw event is
+# persisted and acknowledged, and WebhookWorker applies it in per-user order.
+# Gateways often send only the reference, so the owning user is resolved from
+# the payment; keying on the reference itself would split one user's events.
+async def _webhook_partition_key(event: PaymentWebhook) -> str:
+    if event.reference:
+        pay = await Payment.get_motor_collection().find_one({"reference": event.reference}, {"user_id": 1})
+        if pay and pay.get("user_id"):
+            return pay["user_id"]
+    return event.user_id or event.reference or event.event_id
+
+
+async def ingest_payment_event(gateway: str, event: PaymentWebhook) -> Dict[str, Any]:
+    if _recent_webhook_events.get(event.event_id) is not None:
+        return _webhook_result(True, "WEBHOOK_ALREADY_PROCESSED", "Event already processed")
+    key = await _webhook_partition_key(event)
+    row = WebhookEvent(
+        event_id=event.event_id,
+        gateway=gateway,
+        payload=event.dict(),
+        partition_key=key,
+        partition=zlib.crc32(key.encode("utf-8")) % max(1, settings.webhook_partitions),
+    )
+    try:
+        await row.insert()
+    except DuplicateKeyError:
+        return _webhook_result(True, "WEBHOOK_ALREADY_RECEIVED", "Event already received")
+    webhook_worker.notify()
+    return _webhook_result(True, "WEBHOOK_ACCEPTED", "Event accepted", data={"event_id": event.event_id})
+
+
+async def _receive_payment_event(gateway: str, event: PaymentWebhook, request: Request) -> JSONResponse:
+    trace_id = request.state.trace_id
+    if settings.webhook_ingest_mode == "queue":
+        res = await ingest_payment_event(gateway, event)
+    else:
+        res = await process_payment_event(gateway, event, trace_id)
+    return make_response(res["success"], res["code"], res["message"], data=res["data"], http_status=res["http_status"], trace_id=trace_id)
 
 
 @app.post("/payments/webhook/pesapal")
 async def pesapal_webhook(event: PaymentWebhook, request: Request):
-    return await _process_payment_event("pesapal", event, request)
+    return await _receive_payment_event("pesapal", event, request)
 
 
 @app.post("/payments/webhook/paypal")
 async def paypal_webhook(event: PaymentWebhook, request: Request):
-    return await _process_payment_event("paypal", event, request)
+    return await _receive_payment_event("paypal", event, request)
+
+
+class WebhookWorker:
+    # Lanes lease one partition at a time and apply its events oldest first. A key
+    # whose head event is backing off is skipped, so other users in the partition
+    # keep flowing while that user's later events wait behind it.
+    def __init__(self) -> None:
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._wake = asyncio.Event()
+        self._tasks: List[asyncio.Task] = []
+
+    def notify(self) -> None:
+        self._wake.set()
+
+    def start(self) -> None:
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._lane()) for _ in range(max(1, settings.webhook_worker_concurrency))]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _acquire(self, partition: int) -> bool:
+        now = datetime.now(timezone.utc)
+        try:
+            res = await WebhookPartitionLease.get_motor_collection().update_one(
+                {"partition": partition, "$or": [{"locked_until": None}, {"locked_until": {"$lt": now}}]},
+                {"$set": {"owner": self.owner, "locked_until": now + timedelta(seconds=settings.webhook_partition_lease_seconds)}},
+                upsert=True,
+            )
+        except DuplicateKeyError:
+            return False  # held by another lane
+        return bool(res.modified_count or res.upserted_id)
+
+    async def _release(self, partition: int) -> None:
+        await WebhookPartitionLease.get_motor_collection().update_one(
+            {"partition": partition, "owner": self.owner}, {"$set": {"owner": None, "locked_until": None}}
+        )
+
+    async def _next(self, partition: int) -> Optional[Dict[str, Any]]:
+        coll = WebhookEvent.get_motor_collection()
+        now = datetime.now(timezone.utc)
+        blocked = await coll.distinct("partition_key", {"partition": partition, "status": "retry", "next_attempt_at": {"$gt": now}})
+        query: Dict[str, Any] = {"partition": partition, "status": {"$in": ["pending", "retry"]}, "next_attempt_at": {"$lte": now}}
+        if blocked:
+            query["partition_key"] = {"$nin": blocked}
+        return await coll.find_one(query, sort=[("created_at", ASCENDING), ("_id", ASCENDING)])
+
+    async def _apply(self, doc: Dict[str, Any]) -> None:
+        coll = WebhookEvent.get_motor_collection()
+        attempts = doc.get("attempts", 0) + 1
+        now = datetime.now(timezone.utc)
+        try:
+            res = await process_payment_event(doc["gateway"], PaymentWebhook(**doc["payload"]), str(uuid.uuid4()))
+            # the payment row may not be visible yet, or another node holds the claim
+            error = None if res["code"] not in ("PAYMENT_NOT_FOUND", "WEBHOOK_IN_PROGRESS") else res["code"]
+        except Exception as e:  # noqa: BLE001
+            logger.exception("webhook event %s failed", doc["event_id"])
+            res, error = None, repr(e)
+        if error is None:
+            update = {"status": "done", "result_code": res["code"], "processed_at": now, "last_error": None}
+        elif attempts >= settings.webhook_max_attempts:
+            update = {"status": "dead", "last_error": error}
+        else:
+            delay = min(settings.webhook_backoff_max_seconds, settings.webhook_backoff_base_seconds * (2 ** (attempts - 1)))
+            update = {"status": "retry", "last_error": error, "next_attempt_at": now + timedelta(seconds=delay)}
+        update["attempts"] = attempts
+        await coll.update_one({"_id": doc["_id"]}, {"$set": update})
+
+    async def drain_partition(self, partition: int) -> int:
+        if not await self._acquire(partition):
+            return 0
+        applied = 0
+        deadline = time.monotonic() + settings.webhook_partition_lease_seconds / 2
+        try:
+            # stop well inside the lease so another lane can never overlap
+            while time.monotonic() < deadline:
+                doc = await self._next(partition)
+                if doc is None:
+                    break
+                await self._apply(doc)
+                applied += 1
+        finally:
+            await self._release(partition)
+        return applied
+
+    async def _due_partitions(self) -> List[int]:
+        partitions = await WebhookEvent.get_motor_collection().distinct(
+            "partition", {"status": {"$in": ["pending", "retry"]}, "next_attempt_at": {"$lte": datetime.now(timezone.utc)}}
+        )
+        random.shuffle(partitions)
+        return partitions
+
+    async def drain(self) -> int:
+        # Apply everything currently due, then return (CLI / tests)
+        total = 0
+        while True:
+            applied = 0
+            for partition in await self._due_partitions():
+                applied += await self.drain_partition(partition)
+            total += applied
+            if not applied:
+                return total
+
+    async def _lane(self) -> None:
+        while True:
+            self._wake.clear()
+            try:
+                partitions = await self._due_partitions()
+            except Exception:  # noqa: BLE001
+                logger.exception("webhook partition scan failed")
+                partitions = []
+            applied = 0
+            for partition in partitions:
+                try:
+                    applied += await self.drain_partition(partition)
+                except Exception:  # noqa: BLE001
+                    logger.exception("webhook partition %s failed", partition)
+            if not applied:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout=settings.webhook_poll_interval_seconds)
+                except asyncio.TimeoutError:
+                    pass
+
+
+webhook_worker = WebhookWorker()
+
+
+async def replay_webhook_events(event_ids: Optional[List[str]] = None) -> int:
+    # Requeue dead events (optionally only the listed ids); the processed_events
+    # claim still guards against double application.
+    query: Dict[str, Any] = {"status": "dead"}
+    if event_ids:
+        query["event_id"] = {"$in": event_ids}
+    res = await WebhookEvent.get_motor_collection().update_many(
+        query, {"$set": {"status": "pending", "attempts": 0, "next_attempt_at": datetime.now(timezone.utc)}}
+    )
+    webhook_worker.notify()
+    return res.modified_count
+
 
 
 # ----------------------------------------------------------------------------
@@ -856,9 +3286,9 @@ async def paypal_webhook(event: PaymentWebhook, request: Request):
 
 
 @app.get("/commissions")
-async def list_commissions(user: User = Depends(get_active_user), request: Request = None, skip: int = 0, limit: int = 50):
+async def list_commissions(user: Principal = Depends(get_active_user), request: Request = None, skip: int = 0, limit: int = Query(50, ge=1, le=200), cursor: Optional[str] = None):
     trace_id = request.state.trace_id if request else str(uuid.uuid4())
-    items = await Commission.find(Commission.user_id == str(user.id)).sort("-created_at").skip(skip).limit(limit).to_list()
+    items, next_cursor = await keyset_page(Commission, {"user_id": str(user.id)}, cursor, skip, limit)
     data = [{
         "id": str(c.id),
         "source_user_id": c.source_user_id,
@@ -868,21 +3298,22 @@ async def list_commissions(user: User = Depends(get_active_user), request: Reque
         "description": c.description,
         "created_at": c.created_at,
     } for c in items]
-    return make_response(True, "COMMISSIONS", "Commissions list", data=data, trace_id=trace_id)
+    return with_next_cursor(make_response(True, "COMMISSIONS", "Commissions list", data=data, trace_id=trace_id), next_cursor)
 
 
 @app.get("/balance")
-async def balance(user: User = Depends(get_active_user), request: Request = None):
+async def balance(user: Principal = Depends(get_active_user), request: Request = None):
     trace_id = request.state.trace_id if request else str(uuid.uuid4())
-    commissions = await Commission.find(Commission.user_id == str(user.id)).to_list()
-    total_earned = round(sum(c.amount_usd for c in commissions), 2)
-    # Sum approved payout amounts
-    payouts = await PayoutRequest.find(PayoutRequest.user_id == str(user.id), PayoutRequest.status.in_(["sent"]))\
-        .to_list()
-    total_withdrawn = round(sum(p.amount_usd for p in payouts), 2)
-    wallet_usd = round(total_earned - total_withdrawn, 2)
+    view = wallet_view(await get_wallet(str(user.id)))
+    wallet_usd = view["balance_usd"]
     wallet_local = await usd_to_local(wallet_usd, user.currency)
-    data = {"wallet_usd": wallet_usd, "wallet_local": wallet_local, "currency": user.currency}
+    data = {
+        "wallet_usd": wallet_usd,
+        "wallet_local": wallet_local,
+        "currency": user.currency,
+        "reserved_usd": view["reserved_usd"],
+        "available_usd": view["available_usd"],
+    }
     return make_response(True, "BALANCE", "Wallet balance", data=data, trace_id=trace_id)
 
 
@@ -891,61 +3322,80 @@ async def balance(user: User = Depends(get_active_user), request: Request = None
 # ----------------------------------------------------------------------------
 
 
-@app.get("/transactions")
-async def transactions(user: User = Depends(get_active_user), request: Request = None, skip: int = 0, limit: int = 50, include_payments: bool = False):
-    trace_id = request.state.trace_id if request else str(uuid.uuid4())
-    user_id = str(user.id)
-
-    # Gather commissions (credits)
-    comms = await Commission.find(Commission.user_id == user_id).to_list()
-    comm_items = [{
-        "id": str(c.id),
+def _commission_entry(c: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "id": str(c["_id"]),
         "type": "commission",
         "direction": "credit",
-        "amount_usd": round(c.amount_usd, 2),
-        "description": c.description or f"Level {c.level} commission",
-        "created_at": c.created_at,
-    } for c in comms]
+        "amount_usd": round(c["amount_usd"], 2),
+        "description": c.get("description") or f"Level {c['level']} commission",
+        "created_at": c["created_at"],
+    }
 
-    # Gather payouts (debits) — only sent affect balance
-    payouts = await PayoutRequest.find(PayoutRequest.user_id == user_id, PayoutRequest.status == "sent").to_list()
-    payout_items = [{
-        "id": str(p.id),
+
+def _payout_entry(p: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "id": str(p["_id"]),
         "type": "payout",
         "direction": "debit",
-        "amount_usd": -round(p.amount_usd, 2),
-        "description": f"Payout via {p.gateway} to {p.destination}",
-        "created_at": p.created_at,
-    } for p in payouts]
+        "amount_usd": -round(p["amount_usd"], 2),
+        "description": f"Payout via {p['gateway']} to {p['destination']}",
+        "created_at": p["created_at"],
+    }
+
+
+def _payment_entry(pay: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "id": str(pay["_id"]),
+        "type": "payment",
+        "direction": "info",
+        "amount_usd": round(pay.get("amount_usd") or 0.0, 2),
+        "status": pay["status"],
+        "gateway": pay["gateway"],
+        "description": f"{pay['gateway'].capitalize()} payment {pay['status']}",
+        "created_at": pay["created_at"],
+    }
+
 
-    entries = comm_items + payout_items
+async def _keyset_stream(model, query: Dict[str, Any], cursor: Optional[str], n: int, to_entry) -> List[tuple]:
+    rows = await model.get_motor_collection().find(keyset_query(query, cursor)).sort(KEYSET_SORT).limit(n).to_list(n)
+    return [((r["created_at"], r["_id"]), to_entry(r)) for r in rows]
 
-    # Optionally include payments (informational)
+
+@app.get("/transactions")
+async def transactions(user: Principal = Depends(get_active_user), request: Request = None, skip: int = Query(0, ge=0, le=1000), limit: int = Query(50, ge=1, le=200), include_payments: bool = False, cursor: Optional[str] = None):
+    trace_id = request.state.trace_id if request else str(uuid.uuid4())
+    user_id = str(user.id)
+    if cursor:
+        skip = 0
+
+    # k-way merge of three sorted, limited streams: commissions (credits),
+    # sent payouts (debits — only sent affect balance) and, optionally,
+    # payments (informational). Each stream is an index range scan.
+    n = skip + limit + 1
+    streams = [
+        _keyset_stream(Commission, {"user_id": user_id}, cursor, n, _commission_entry),
+        _keyset_stream(PayoutRequest, {"user_id": user_id, "status": "sent"}, cursor, n, _payout_entry),
+    ]
     if include_payments:
-        pays = await Payment.find(Payment.user_id == user_id).to_list()
-        pay_items = [{
-            "id": str(pay.id),
-            "type": "payment",
-            "direction": "info",
-            "amount_usd": round(pay.amount_usd or 0.0, 2),
-            "status": pay.status,
-            "gateway": pay.gateway,
-            "description": f"{pay.gateway.capitalize()} payment {pay.status}",
-            "created_at": pay.created_at,
-        } for pay in pays]
-        entries += pay_items
-
-    # Sort by created_at desc
-    entries.sort(key=lambda x: x.get("created_at") or datetime.now(timezone.utc), reverse=True)
-
-    # Pagination (in-memory for simplicity)
-    sliced = entries[skip: skip + limit]
+        streams.append(_keyset_stream(Payment, {"user_id": user_id}, cursor, n, _payment_entry))
+    results = await asyncio.gather(*streams, get_wallet(user_id))
+    wallet = results[-1]
+    merged = list(heapq.merge(*results[:-1], key=lambda item: item[0], reverse=True))
+
+    page = merged[skip: skip + limit]
+    next_cursor = encode_cursor(*page[-1][0]) if len(merged) > skip + limit and page else None
+    sliced = [entry for _, entry in page]
     # Coerce datetime to isoformat for JSONResponse if needed (FastAPI will handle, but be explicit)
     for e in sliced:
         if isinstance(e.get("created_at"), datetime):
             e["created_at"] = e["created_at"].isoformat()
 
-    data = {"items": sliced, "total": len(entries), "skip": skip, "limit": limit}
+    # Totals come from the wallet counters rather than counting the history
+    total = wallet.commission_count + wallet.payout_sent_count
+    if include_payments:
+        total += await Payment.get_motor_collection().count_documents({"user_id": user_id})
+    data = {"items": sliced, "total": total, "skip": skip, "limit": limit, "next_cursor": next_cursor}
     return make_response(True, "TRANSACTIONS", "Transaction history", data=data, trace_id=trace_id)
 
 
@@ -955,20 +3405,22 @@ async def transactions(user: User = Depends(get_active_user), request: Request =
 
 
 @app.post("/tasks")
-async def create_task(req: TaskCreateRequest, admin: User = Depends(get_admin_user), request: Request = None):
+async def create_task(req: TaskCreateRequest, admin: Principal = Depends(get_admin_user), request: Request = None):
     trace_id = request.state.trace_id if request else str(uuid.uuid4())
     t = Task(**req.dict())
     await t.insert()
+    _summary_shared_cache.clear()
     await create_notification(None, "task", "New task posted", t.title, data={"task_id": str(t.id)})
     # Optional: email all users about the task (lightweight stub - only notifies via notification email channel when users are targeted individually)
     return make_response(True, "TASK_CREATED", "Task created", data={"task_id": str(t.id)}, trace_id=trace_id, http_status=201)
 
 
 @app.get("/tasks")
-async def list_tasks(user: User = Depends(get_active_user), request: Request = None, skip: int = 0, limit: int = 50):
+async def list_tasks(user: Principal = Depends(get_active_user), request: Request = None, skip: int = 0, limit: int = Query(50, ge=1, le=200), cursor: Optional[str] = None):
     trace_id = request.state.trace_id if request else str(uuid.uuid4())
     now = datetime.now(timezone.utc)
-    items = await Task.find((Task.expires_at == None) | (Task.expires_at > now)).sort("-created_at").skip(skip).limit(limit).to_list()  # noqa: E711
+    query = {"$or": [{"expires_at": None}, {"expires_at": {"$gt": now}}]}
+    items, next_cursor = await keyset_page(Task, query, cursor, skip, limit)
     data = [{
         "id": str(t.id),
         "title": t.title,
@@ -977,34 +3429,39 @@ async def list_tasks(user: User = Depends(get_active_user), request: Request = N
         "expires_at": t.expires_at,
         "status": t.status,
     } for t in items]
-    return make_response(True, "TASKS", "Tasks list", data=data, trace_id=trace_id)
+    return with_next_cursor(make_response(True, "TASKS", "Tasks list", data=data, trace_id=trace_id), next_cursor)
 
 
 @app.post("/tasks/{task_id}/submit")
-async def submit_task(task_id: str = Path(...), req: TaskSubmitRequest = Body(...), user: User = Depends(get_active_user), request: Request = None):
+async def submit_task(task_id: str = Path(...), req: TaskSubmitRequest = Body(...), user: Principal = Depends(get_active_user), request: Request = None):
     trace_id = request.state.trace_id if request else str(uuid.uuid4())
     task = await Task.get(task_id)
     if not task:
         return make_response(False, "TASK_NOT_FOUND", "Task not found", http_status=404, trace_id=trace_id)
     sub = TaskSubmission(task_id=task_id, user_id=str(user.id), payload=req.payload)
     await sub.insert()
-    await create_notification(None, "task", "Task submitted", f"User {user.email} submitted a task.", data={"task_id": task_id, "submission_id": str(sub.id)})
+    invalidate_user_summary(sub.user_id)
+    await rollup_inc(sub.user_id, sub.created_at, {"tasks_submitted": 1})
+    await create_notification(None, "task", "Task submitted", f"User {user.email} submitted a task.", data={"task_id": task_id, "submission_id": str(sub.id)}, audience="admins")
     # Confirmation to submitting user
     await create_notification(str(user.id), "task", "We received your submission", "Thanks! We'll review and notify you soon.", data={"task_id": task_id, "submission_id": str(sub.id)})
     return make_response(True, "TASK_SUBMITTED", "Task submitted", data={"submission_id": str(sub.id)}, trace_id=trace_id, http_status=201)
 
 
 @app.post("/tasks/{task_id}/approve")
-async def approve_task_submission(task_id: str, submission_id: str = Query(...), admin: User = Depends(get_admin_user), request: Request = None):
+async def approve_task_submission(task_id: str, submission_id: str = Query(...), admin: Principal = Depends(get_admin_user), request: Request = None):
     trace_id = request.state.trace_id if request else str(uuid.uuid4())
     sub = await TaskSubmission.get(submission_id)
     if not sub or sub.task_id != task_id:
         return make_response(False, "SUBMISSION_NOT_FOUND", "Submission not found", http_status=404, trace_id=trace_id)
     if sub.status == "approved":
         return make_response(True, "ALREADY_APPROVED", "Already approved", data={"submission_id": submission_id}, trace_id=trace_id)
+    old_status = sub.status
     sub.status = "approved"
     sub.reward_granted = True
     await sub.save()
+    invalidate_user_summary(sub.user_id)
+    await rollup_inc(sub.user_id, sub.created_at, {f"tasks_{old_status}": -1, "tasks_approved": 1})
     task = await Task.get(task_id)
     # Record commission-like reward as commission to user's own wallet
     comm = Commission(
@@ -1015,19 +3472,23 @@ async def approve_task_submission(task_id: str, submission_id: str = Query(...),
         percent=0,
         description=f"Reward for task {task.title if task else task_id}",
     )
-    await comm.insert()
+    await insert_commission(comm)
     await create_notification(sub.user_id, "task", "Task approved", f"Your task submission was approved. Reward ${comm.amount_usd} granted.")
     return make_response(True, "TASK_APPROVED", "Submission approved", data={"submission_id": submission_id}, trace_id=trace_id)
 
 
 @app.post("/tasks/{task_id}/reject")
-async def reject_task_submission(task_id: str, submission_id: str = Query(...), reason: Optional[str] = Query(None), admin: User = Depends(get_admin_user), request: Request = None):
+async def reject_task_submission(task_id: str, submission_id: str = Query(...), reason: Optional[str] = Query(None), admin: Principal = Depends(get_admin_user), request: Request = None):
     trace_id = request.state.trace_id if request else str(uuid.uuid4())
     sub = await TaskSubmission.get(submission_id)
     if not sub or sub.task_id != task_id:
         return make_response(False, "SUBMISSION_NOT_FOUND", "Submission not found", http_status=404, trace_id=trace_id)
+    old_status = sub.status
     sub.status = "rejected"
     await sub.save()
+    invalidate_user_summary(sub.user_id)
+    if old_status != "rejected":
+        await rollup_inc(sub.user_id, sub.created_at, {f"tasks_{old_status}": -1, "tasks_rejected": 1})
     await create_notification(sub.user_id, "task", "Task rejected", f"Your task submission was rejected. {reason or ''}")
     return make_response(True, "TASK_REJECTED", "Submission rejected", data={"submission_id": submission_id}, trace_id=trace_id)
 
@@ -1038,38 +3499,40 @@ async def reject_task_submission(task_id: str, submission_id: str = Query(...),
 
 
 @app.post("/payouts/request")
-async def request_payout(req: PayoutRequestCreate, user: User = Depends(get_active_user), request: Request = None):
+async def request_payout(req: PayoutRequestCreate, user: Principal = Depends(get_active_user), request: Request = None):
     trace_id = request.state.trace_id if request else str(uuid.uuid4())
-    # Check balance
-    commissions = await Commission.find(Commission.user_id == str(user.id)).to_list()
-    payouts = await PayoutRequest.find(PayoutRequest.user_id == str(user.id), PayoutRequest.status.in_(["sent"]))\
-        .to_list()
-    wallet_usd = round(sum(c.amount_usd for c in commissions) - sum(p.amount_usd for p in payouts), 2)
+    # Check balance (available = earned - withdrawn - reserved by open requests)
+    available_usd = wallet_view(await get_wallet(str(user.id)))["available_usd"]
     if req.amount_usd < settings.min_withdraw_usd:
         return make_response(False, "WITHDRAW_MINIMUM", f"Minimum withdrawal is ${settings.min_withdraw_usd}", http_status=400, trace_id=trace_id)
-    if req.amount_usd <= 0 or req.amount_usd > wallet_usd:
+    if req.amount_usd <= 0 or req.amount_usd > available_usd:
         return make_response(False, "INSUFFICIENT_BALANCE", "Insufficient balance", http_status=400, trace_id=trace_id)
     # Rate limit: only one payout request per 7 days
     seven_days_ago = datetime.now(timezone.utc) - timedelta(days=7)
     recent = await PayoutRequest.find(PayoutRequest.user_id == str(user.id), PayoutRequest.created_at > seven_days_ago).sort("-created_at").first_or_none()
     if recent:
         return make_response(False, "PAYOUT_RATE_LIMIT", "Only one payout request is allowed per 7 days", http_status=429, trace_id=trace_id)
+    # Reserve atomically; a concurrent request may have consumed the balance
+    if not await wallet_reserve(str(user.id), req.amount_usd):
+        return make_response(False, "INSUFFICIENT_BALANCE", "Insufficient balance", http_status=400, trace_id=trace_id)
     pr = PayoutRequest(user_id=str(user.id), amount_usd=req.amount_usd, gateway=req.gateway, destination=req.destination)
-    await pr.insert()
-    await create_notification(None, "system", "Payout requested", f"User {user.email} requested payout ${req.amount_usd}.")
+    try:
+        await pr.insert()
+    except Exception:
+        await wallet_inc(str(user.id), reserved=-req.amount_usd)
+        raise
+    invalidate_user_summary(str(user.id))
+    await create_notification(None, "system", "Payout requested", f"User {user.email} requested payout ${req.amount_usd}.", audience="admins")
     # Confirmation to requester
     await create_notification(str(user.id), "system", "We received your payout request", f"Your payout request of ${req.amount_usd} is under review.")
     return make_response(True, "PAYOUT_REQUESTED", "Payout requested", data={"payout_id": str(pr.id)}, trace_id=trace_id, http_status=201)
 
 
 @app.get("/payouts")
-async def list_payouts(user: User = Depends(get_active_user), request: Request = None, skip: int = 0, limit: int = 50):
+async def list_payouts(user: Principal = Depends(get_active_user), request: Request = None, skip: int = 0, limit: int = Query(50, ge=1, le=200), cursor: Optional[str] = None):
     trace_id = request.state.trace_id if request else str(uuid.uuid4())
-    query = {}
-    if user.is_admin:
-        items = await PayoutRequest.find_all().sort("-created_at").skip(skip).limit(limit).to_list()
-    else:
-        items = await PayoutRequest.find(PayoutRequest.user_id == str(user.id)).sort("-created_at").skip(skip).limit(limit).to_list()
+    query = {} if user.is_admin else {"user_id": str(user.id)}
+    items, next_cursor = await keyset_page(PayoutRequest, query, cursor, skip, limit)
     data = [{
         "id": str(p.id),
         "user_id": p.user_id,
@@ -1079,41 +3542,38 @@ async def list_payouts(user: User = Depends(get_active_user), request: Request =
         "status": p.status,
         "created_at": p.created_at,
     } for p in items]
-    return make_response(True, "PAYOUTS", "Payouts list", data=data, trace_id=trace_id)
+    return with_next_cursor(make_response(True, "PAYOUTS", "Payouts list", data=data, trace_id=trace_id), next_cursor)
 
 
 @app.post("/payouts/{payout_id}/approve")
-async def approve_payout(payout_id: str, admin: User = Depends(get_admin_user), request: Request = None):
+async def approve_payout(payout_id: str, admin: Principal = Depends(get_admin_user), request: Request = None):
     trace_id = request.state.trace_id if request else str(uuid.uuid4())
     pr = await PayoutRequest.get(payout_id)
     if not pr:
         return make_response(False, "PAYOUT_NOT_FOUND", "Payout not found", http_status=404, trace_id=trace_id)
-    pr.status = "sent"
-    await pr.save()
+    if pr.status == "sent":
+        return make_response(True, "PAYOUT_APPROVED", "Payout approved", data={"payout_id": payout_id}, trace_id=trace_id)
+    if not await set_payout_status(pr, "sent"):
+        return make_response(False, "PAYOUT_CONFLICT", "Payout was modified concurrently", http_status=409, trace_id=trace_id)
     await create_notification(pr.user_id, "system", "Payout approved", f"Your payout of ${pr.amount_usd} has been approved and sent.")
     # Email user
     if pr.user_id:
-        u = await User.get(pr.user_id)
-        if u:
-            await send_email_stub(EmailMessage(to=u.email, subject="Payout approved", body=f"Your payout of ${pr.amount_usd} has been sent."))
+        await enqueue_email("Payout approved", f"Your payout of ${pr.amount_usd} has been sent.", user_id=pr.user_id)
     return make_response(True, "PAYOUT_APPROVED", "Payout approved", data={"payout_id": payout_id}, trace_id=trace_id)
 
 
 @app.post("/payouts/{payout_id}/reject")
-async def reject_payout(payout_id: str, reason: Optional[str] = Query(None), admin: User = Depends(get_admin_user), request: Request = None):
+async def reject_payout(payout_id: str, reason: Optional[str] = Query(None), admin: Principal = Depends(get_admin_user), request: Request = None):
     trace_id = request.state.trace_id if request else str(uuid.uuid4())
     pr = await PayoutRequest.get(payout_id)
     if not pr:
         return make_response(False, "PAYOUT_NOT_FOUND", "Payout not found", http_status=404, trace_id=trace_id)
-    pr.status = "rejected"
-    pr.admin_note = reason
-    await pr.save()
+    if not await set_payout_status(pr, "rejected", admin_note=reason):
+        return make_response(False, "PAYOUT_CONFLICT", "Payout was modified concurrently", http_status=409, trace_id=trace_id)
     await create_notification(pr.user_id, "system", "Payout rejected", f"Your payout was rejected. {reason or ''}")
     # Email user
     if pr.user_id:
-        u = await User.get(pr.user_id)
-        if u:
-            await send_email_stub(EmailMessage(to=u.email, subject="Payout rejected", body=f"Your payout request was rejected. {reason or ''}"))
+        await enqueue_email("Payout rejected", f"Your payout request was rejected. {reason or ''}", user_id=pr.user_id)
     return make_response(True, "PAYOUT_REJECTED", "Payout rejected", data={"payout_id": payout_id}, trace_id=trace_id)
 
 
@@ -1123,64 +3583,104 @@ async def reject_payout(payout_id: str, reason: Optional[str] = Query(None), adm
 
 
 @app.get("/notifications")
-async def list_notifications(user: User = Depends(get_active_user), request: Request = None, skip: int = 0, limit: int = 50):
+async def list_notifications(user: Principal = Depends(get_active_user), request: Request = None, skip: int = 0, limit: int = Query(50, ge=1, le=200), cursor: Optional[str] = None):
     trace_id = request.state.trace_id if request else str(uuid.uuid4())
-    items = await Notification.find(Notification.user_id == str(user.id)).sort("-created_at").skip(skip).limit(limit).to_list()
+    items, next_cursor = await keyset_page(Notification, notification_feed_query(user), cursor, skip, limit)
+    read_seq: Dict[str, int] = {}
+    read: Dict[str, set] = {}
+    if any(n.bseq is not None for n in items):
+        state = await get_notification_state(str(user.id))
+        read_seq = await broadcast_read_state(user, state)
+        read = {a: set(v) for a, v in state.broadcast_read.items()}
+
+    def is_read(n: Notification) -> bool:
+        if n.bseq is None:
+            return n.is_read
+        return n.bseq <= read_seq.get(n.audience, 0) or n.bseq in read.get(n.audience, ())
+
     data = [{
         "id": str(n.id),
         "type": n.type,
         "title": n.title,
         "body": n.body,
         "data": n.data,
-        "is_read": n.is_read,
+        "is_read": is_read(n),
+        "seq": n.seq,
+        "audience": n.audience,
         "created_at": n.created_at,
     } for n in items]
-    return make_response(True, "NOTIFICATIONS", "Notifications list", data=data, trace_id=trace_id)
+    return with_next_cursor(make_response(True, "NOTIFICATIONS", "Notifications list", data=data, trace_id=trace_id), next_cursor)
 
 
 @app.get("/notifications/unread_count")
-async def unread_count(user: User = Depends(get_active_user), request: Request = None):
+async def unread_count(user: Principal = Depends(get_active_user), request: Request = None):
     trace_id = request.state.trace_id if request else str(uuid.uuid4())
-    count = await Notification.find(Notification.user_id == str(user.id), Notification.is_read == False).count()  # noqa: E712
+    count = await notification_unread_total(user)
     return make_response(True, "UNREAD_COUNT", "Unread notifications count", data={"count": count}, trace_id=trace_id)
 
 
 @app.post("/notifications/mark_read")
-async def mark_read(req: MarkReadRequest, user: User = Depends(get_active_user), request: Request = None):
+async def mark_read(req: MarkReadRequest, user: Principal = Depends(get_active_user), request: Request = None):
     trace_id = request.state.trace_id if request else str(uuid.uuid4())
-    n = await Notification.get(req.notification_id)
-    if not n or n.user_id != str(user.id):
+    if not ObjectId.is_valid(req.notification_id):
         return make_response(False, "NOTIF_NOT_FOUND", "Notification not found", http_status=404, trace_id=trace_id)
-    n.is_read = True
-    await n.save()
+    coll = Notification.get_motor_collection()
+    query = {"_id": ObjectId(req.notification_id), "user_id": str(user.id)}
+    res = await coll.update_one({**query, "is_read": False}, {"$set": {"is_read": True}})
+    if res.modified_count:
+        # only the request that actually flipped the flag moves the counter
+        await notification_unread_inc({str(user.id): -1})
+    elif await coll.count_documents(query, limit=1) == 0:
+        # not one of the user's rows: maybe a broadcast in their feed
+        doc = await coll.find_one(
+            {"_id": ObjectId(req.notification_id), "user_id": None, "audience": {"$in": notification_audiences(user)}, "bseq": {"$ne": None}},
+            projection={"audience": 1, "bseq": 1},
+        )
+        if doc is None:
+            return make_response(False, "NOTIF_NOT_FOUND", "Notification not found", http_status=404, trace_id=trace_id)
+        await mark_broadcast_read(user, doc["audience"], doc["bseq"])
     return make_response(True, "NOTIF_READ", "Notification marked read", data={"id": req.notification_id}, trace_id=trace_id)
 
 
 @app.post("/notifications/mark_all_read")
-async def mark_all_read(user: User = Depends(get_active_user), request: Request = None):
+async def mark_all_read(user: Principal = Depends(get_active_user), request: Request = None):
     trace_id = request.state.trace_id if request else str(uuid.uuid4())
-    items = await Notification.find(Notification.user_id == str(user.id), Notification.is_read == False).to_list()  # noqa: E712
-    for n in items:
-        n.is_read = True
-        await n.save()
-    return make_response(True, "NOTIF_ALL_READ", "All notifications marked read", data={"updated": len(items)}, trace_id=trace_id)
+    res = await Notification.get_motor_collection().update_many({"user_id": str(user.id), "is_read": False}, {"$set": {"is_read": True}})
+    # decrement by what was flipped rather than zeroing, so inserts racing this stay counted
+    await notification_unread_inc({str(user.id): -res.modified_count})
+    await mark_all_broadcasts_read(user)
+    return make_response(True, "NOTIF_ALL_READ", "All notifications marked read", data={"updated": res.modified_count}, trace_id=trace_id)
 
 
 @app.websocket("/ws/notifications")
-async def websocket_notifications(websocket: WebSocket, token: str = Query(...)):
+async def websocket_notifications(websocket: WebSocket, token: str = Query(...), since: Optional[int] = Query(None), since_all: Optional[int] = Query(None), since_admins: Optional[int] = Query(None), heartbeat: bool = Query(False)):
     # Authenticate via token query param
     payload = decode_jwt(token)
     if payload.get("type") != "access":
         await websocket.close(code=4401)
         return
     user_id = payload.get("sub")
-    await ws_manager.connect(user_id, websocket)
+    principal = await load_principal(user_id)
+    if principal is None:
+        await websocket.close(code=4401)
+        return
+    conn = await ws_manager.connect(user_id, websocket, tuple(notification_audiences(principal)), heartbeat)
     try:
+        # catch up from the client's last seen seq / per-audience bseq, then continue live
+        broadcast_since = {a: v for a, v in (("all", since_all), ("admins", since_admins)) if v is not None}
+        if since is not None or broadcast_since:
+            await ws_manager.replay(conn, since, broadcast_since)
         while True:
-            # keep connection alive; ignore incoming messages
-            await websocket.receive_text()
-    except WebSocketDisconnect:
-        ws_manager.disconnect(user_id, websocket)
+            # any inbound frame (the pong to our ping, for heartbeat sockets) proves the client is alive
+            text = await websocket.receive_text()
+            ws_manager.touch(conn)
+            if text == "ping":
+                ws_manager.send(conn, {"type": "pong", "ts": int(time.time())})
+    except (WebSocketDisconnect, RuntimeError):
+        # RuntimeError: the server side already closed it (evicted or reaped)
+        pass
+    finally:
+        await ws_manager.drop(conn)
 
 
 # ----------------------------------------------------------------------------
@@ -1188,30 +3688,88 @@ async def websocket_notifications(websocket: WebSocket, token: str = Query(...))
 # ----------------------------------------------------------------------------
 
 
+def _broadcast_query(job: BroadcastJob) -> Dict[str, Any]:
+    if job.to_all:
+        return {}
+    ids = [ObjectId(uid) for uid in (job.user_ids or []) if ObjectId.is_valid(uid)]
+    return {"_id": {"$in": ids}}
+
+
+async def run_broadcast_job(job_id: PydanticObjectId) -> None:
+    # Streams recipients through a projected cursor (only _id/email) and feeds
+    # the SMTP pool one chunk at a time, so memory stays flat.
+    jobs = BroadcastJob.get_motor_collection()
+    job = await BroadcastJob.get(job_id)
+    if job is None:
+        return
+    await jobs.update_one({"_id": job.id}, {"$set": {"status": "running"}})
+    chunk_size = max(1, settings.smtp_batch_size * settings.smtp_pool_size)
+    chunk: List[EmailMessage] = []
+
+    async def flush() -> None:
+        results = await send_email_batch(chunk)
+        failed = sum(1 for r in results if r is not None)
+        await jobs.update_one({"_id": job.id}, {"$inc": {"sent": len(results) - failed, "failed": failed}})
+        chunk.clear()
+
+    try:
+        cursor = User.get_motor_collection().find(_broadcast_query(job), projection={"email": 1}, batch_size=chunk_size)
+        async for doc in cursor:
+            chunk.append(EmailMessage(to=doc["email"], subject=job.subject, body=job.body))
+            if len(chunk) >= chunk_size:
+                await flush()
+        if chunk:
+            await flush()
+    except Exception as e:  # noqa: BLE001
+        logger.exception("broadcast job %s failed", job.id)
+        await jobs.update_one({"_id": job.id}, {"$set": {"status": "failed", "error": repr(e), "finished_at": datetime.now(timezone.utc)}})
+        return
+    await jobs.update_one({"_id": job.id}, {"$set": {"status": "completed", "finished_at": datetime.now(timezone.utc)}})
+
+
+def _broadcast_job_view(job: BroadcastJob) -> Dict[str, Any]:
+    return {
+        "job_id": str(job.id),
+        "status": job.status,
+        "total": job.total,
+        "sent": job.sent,
+        "failed": job.failed,
+        "error": job.error,
+        "created_at": job.created_at,
+        "finished_at": job.finished_at,
+    }
+
+
 @app.post("/admin/emails/send")
-async def broadcast_email(req: BroadcastEmailRequest, admin: User = Depends(get_admin_user), request: Request = None, background: BackgroundTasks = None):
+async def broadcast_email(req: BroadcastEmailRequest, admin: Principal = Depends(get_admin_user), request: Request = None, background: BackgroundTasks = None):
     trace_id = request.state.trace_id if request else str(uuid.uuid4())
-    targets: List[User]
-    if req.to_all:
-        targets = await User.find_all().to_list()
+    job = BroadcastJob(subject=req.subject, body=req.body, to_all=req.to_all, user_ids=None if req.to_all else (req.user_ids or []), created_by=str(admin.id))
+    users = User.get_motor_collection()
+    job.total = await users.estimated_document_count() if job.to_all else await users.count_documents(_broadcast_query(job))
+    await job.insert()
+    if job.total:
+        background.add_task(run_broadcast_job, job.id)
     else:
-        targets = []
-        if req.user_ids:
-            for uid in req.user_ids:
-                u = await User.get(uid)
-                if u:
-                    targets.append(u)
-    for u in targets:
-        if background:
-            background.add_task(send_email_stub, EmailMessage(to=u.email, subject=req.subject, body=req.body))
-    await create_notification(None, "system", "Broadcast email", f"Broadcast email sent to {len(targets)} users.")
-    return make_response(True, "EMAILS_SENT", "Broadcast email queued", data={"count": len(targets)}, trace_id=trace_id)
+        job.status = "completed"
+        job.finished_at = datetime.now(timezone.utc)
+        await job.save()
+    await create_notification(None, "system", "Broadcast email", f"Broadcast email sent to {job.total} users.", audience="admins")
+    return make_response(True, "EMAILS_SENT", "Broadcast email queued", data={"count": job.total, **_broadcast_job_view(job)}, trace_id=trace_id)
+
+
+@app.get("/admin/emails/jobs/{job_id}")
+async def broadcast_email_job(job_id: str, admin: Principal = Depends(get_admin_user), request: Request = None):
+    trace_id = request.state.trace_id if request else str(uuid.uuid4())
+    job = await BroadcastJob.get(job_id) if ObjectId.is_valid(job_id) else None
+    if not job:
+        return make_response(False, "JOB_NOT_FOUND", "Broadcast job not found", http_status=404, trace_id=trace_id)
+    return make_response(True, "EMAIL_JOB", "Broadcast job progress", data=_broadcast_job_view(job), trace_id=trace_id)
 
 
 @app.get("/admin/fraud_logs")
-async def get_fraud_logs(admin: User = Depends(get_admin_user), request: Request = None, skip: int = 0, limit: int = 50):
+async def get_fraud_logs(admin: Principal = Depends(get_admin_user), request: Request = None, skip: int = 0, limit: int = Query(50, ge=1, le=200), cursor: Optional[str] = None):
     trace_id = request.state.trace_id if request else str(uuid.uuid4())
-    items = await FraudLog.find_all().sort("-created_at").skip(skip).limit(limit).to_list()
+    items, next_cursor = await keyset_page(FraudLog, {}, cursor, skip, limit)
     data = [{
         "id": str(f.id),
         "user_id": f.user_id,
@@ -1219,36 +3777,197 @@ async def get_fraud_logs(admin: User = Depends(get_admin_user), request: Request
         "reason": f.reason,
         "created_at": f.created_at,
     } for f in items]
-    return make_response(True, "FRAUD_LOGS", "Fraud logs", data=data, trace_id=trace_id)
+    return with_next_cursor(make_response(True, "FRAUD_LOGS", "Fraud logs", data=data, trace_id=trace_id), next_cursor)
 
 
 @app.patch("/admin/users/{user_id}/suspend")
-async def suspend_user(user_id: str, suspend: bool = Query(True), admin: User = Depends(get_admin_user), request: Request = None):
+async def suspend_user(user_id: str, suspend: bool = Query(True), admin: Principal = Depends(get_admin_user), request: Request = None):
     trace_id = request.state.trace_id if request else str(uuid.uuid4())
     u = await User.get(user_id)
     if not u:
         return make_response(False, "USER_NOT_FOUND", "User not found", http_status=404, trace_id=trace_id)
     u.status = "suspended" if suspend else "active"
     await u.save()
+    events.publish(USER_CHANGED, user_id)
     await create_notification(user_id, "system", "Account status changed", f"Your account status is now {u.status}.")
     return make_response(True, "USER_STATUS_UPDATED", "User status updated", data={"user_id": user_id, "status": u.status}, trace_id=trace_id)
 
 
-@app.get("/admin/analytics")
-async def analytics(admin: User = Depends(get_admin_user), request: Request = None):
+def _query_shapes() -> List[Dict[str, Any]]:
+    # Representative filter/sort shapes for the hot queries in this module;
+    # explain_query_shapes() checks each one is served by an index.
+    uid = str(ObjectId())
+    now = datetime.now(timezone.utc)
+    keyset = keyset_query({"user_id": uid}, encode_cursor(now, ObjectId()))
+    return [
+        {"name": "users.by_email", "model": User, "filter": {"email": "someone@example.com"}},
+        {"name": "users.by_referral_code", "model": User, "filter": {"referral_code": "user-0000"}},
+        {"name": "users.by_phone", "model": User, "filter": {"phone": "+0000"}},
+        {"name": "users.direct_referrals", "model": User, "filter": {"parent_referrer": uid, "status": "active"}},
+        {"name": "users.binary_subtree", "model": User, "filter": {"binary_ancestors": uid, "binary_depth": {"$lte": 5}}},
+        {"name": "users.binary_children", "model": User, "filter": {"binary_parent": {"$in": [uid]}}},
+        {"name": "users.expired_active", "model": User, "filter": {"status": "active", "activation_expires_at": {"$ne": None, "$lt": now}}},
+        {"name": "payments.by_reference", "model": Payment, "filter": {"reference": "ref"}},
+        {"name": "payments.by_webhook_event", "model": Payment, "filter": {"webhook_event_id": "evt"}},
+        {"name": "payments.open_for_user", "model": Payment, "filter": {"user_id": uid, "status": {"$in": ["initiated", "pending"]}}, "sort": [("created_at", DESCENDING)]},
+        {"name": "payments.by_user", "model": Payment, "filter": {"user_id": uid}, "sort": KEYSET_SORT},
+        {"name": "commissions.by_user", "model": Commission, "filter": {"user_id": uid}, "sort": KEYSET_SORT},
+        {"name": "commissions.by_user_page", "model": Commission, "filter": keyset, "sort": KEYSET_SORT},
+        {"name": "notifications.by_user", "model": Notification, "filter": {"user_id": uid}, "sort": KEYSET_SORT},
+        {"name": "notifications.unread", "model": Notification, "filter": {"user_id": uid, "is_read": False}},
+        {"name": "notifications.since_seq", "model": Notification, "filter": {"user_id": uid, "seq": {"$gt": 0}}, "sort": [("seq", ASCENDING)]},
+        {"name": "notifications.broadcast_feed", "model": Notification, "filter": {"user_id": None, "audience": {"$in": ["all"]}, "created_at": {"$gte": now - timedelta(days=30)}}, "sort": KEYSET_SORT},
+        {"name": "tasks.open", "model": Task, "filter": {"$or": [{"expires_at": None}, {"expires_at": {"$gt": now}}]}, "sort": KEYSET_SORT},
+        {"name": "task_submissions.by_user_status", "model": TaskSubmission, "filter": {"user_id": uid, "status": "approved"}},
+        {"name": "payout_requests.by_user", "model": PayoutRequest, "filter": {"user_id": uid}, "sort": KEYSET_SORT},
+        {"name": "payout_requests.sent_by_user", "model": PayoutRequest, "filter": {"user_id": uid, "status": "sent"}, "sort": KEYSET_SORT},
+        {"name": "payout_requests.recent_for_user", "model": PayoutRequest, "filter": {"user_id": uid, "created_at": {"$gt": now - timedelta(days=7)}}, "sort": [("created_at", DESCENDING)]},
+        {"name": "payout_requests.admin_list", "model": PayoutRequest, "filter": {}, "sort": KEYSET_SORT},
+        {"name": "payout_requests.sent", "model": PayoutRequest, "filter": {"status": "sent"}},
+        {"name": "fraud_logs.admin_list", "model": FraudLog, "filter": {}, "sort": KEYSET_SORT},
+        {"name": "wallets.by_user", "model": Wallet, "filter": {"user_id": uid}},
+        {"name": "binary_slots.claim", "model": BinarySlot, "filter": {"ancestors": uid}, "sort": [("depth", ASCENDING), ("path", ASCENDING)]},
+        {"name": "outbox.claim", "model": OutboxMessage, "filter": {"$or": [
+            {"status": "pending", "next_attempt_at": {"$lte": now}},
+            {"status": "processing", "locked_until": {"$lt": now}},
+        ]}, "sort": [("next_attempt_at", ASCENDING)]},
+        {"name": "daily_rollups.range", "model": DailyRollup, "filter": {"user_id": uid, "date": {"$gte": "2000-01-01", "$lte": "2000-06-30"}}},
+    ]
+
+
+def _plan_stages(plan: Any) -> List[str]:
+    stages: List[str] = []
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            stages.append(plan["stage"])
+        for value in plan.values():
+            stages += _plan_stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            stages += _plan_stages(value)
+    return stages
+
+
+async def explain_query_shapes() -> List[Dict[str, Any]]:
+    report = []
+    for shape in _query_shapes():
+        cursor = shape["model"].get_motor_collection().find(shape["filter"])
+        if shape.get("sort"):
+            cursor = cursor.sort(shape["sort"])
+        explain = await cursor.limit(50).explain()
+        stages = _plan_stages(explain.get("queryPlanner", {}).get("winningPlan", {}))
+        report.append({
+            "name": shape["name"],
+            "collection": shape["model"].get_motor_collection().name,
+            "stages": stages,
+            "collscan": "COLLSCAN" in stages,
+            "in_memory_sort": "SORT" in stages,
+        })
+    return report
+
+
+@app.get("/admin/diagnostics/query_plans")
+async def query_plans(admin: Principal = Depends(get_admin_user), request: Request = None):
+    trace_id = request.state.trace_id if request else str(uuid.uuid4())
+    report = await explain_query_shapes()
+    data = {"collscans": [r["name"] for r in report if r["collscan"]], "shapes": report}
+    return make_response(True, "QUERY_PLANS", "Query plan diagnostics", data=data, trace_id=trace_id)
+
+
+@app.get("/admin/metrics")
+async def metrics(admin: Principal = Depends(get_admin_user), request: Request = None):
     trace_id = request.state.trace_id if request else str(uuid.uuid4())
-    total_users = await User.find_all().count()
-    active_users = await User.find(User.status == "active").count()
-    total_commissions = await Commission.find_all().to_list()
-    total_commissions_usd = round(sum(c.amount_usd for c in total_commissions), 2)
-    total_payouts = await PayoutRequest.find(PayoutRequest.status == "sent").to_list()
-    total_payouts_usd = round(sum(p.amount_usd for p in total_payouts), 2)
     data = {
-        "total_users": total_users,
-        "active_users": active_users,
-        "total_commissions_usd": total_commissions_usd,
-        "total_payouts_usd": total_payouts_usd,
+        "password_hasher": password_hasher.stats(),
+        "websocket": ws_manager.stats(),
+    }
+    return make_response(True, "METRICS", "Worker metrics", data=data, trace_id=trace_id)
+
+
+class WebhookReplayRequest(BaseModel):
+    event_ids: Optional[List[str]] = None
+
+
+@app.post("/admin/webhooks/replay")
+async def replay_webhooks_endpoint(req: WebhookReplayRequest, admin: Principal = Depends(get_admin_user), request: Request = None):
+    trace_id = request.state.trace_id if request else str(uuid.uuid4())
+    count = await replay_webhook_events(req.event_ids)
+    return make_response(True, "WEBHOOKS_REQUEUED", "Webhook events requeued", data={"requeued": count}, trace_id=trace_id)
+
+
+@app.post("/admin/wallets/verify")
+async def verify_wallets_endpoint(fix: bool = Query(False), admin: Principal = Depends(get_admin_user), request: Request = None):
+    trace_id = request.state.trace_id if request else str(uuid.uuid4())
+    report = await verify_wallets(fix=fix)
+    return make_response(True, "WALLETS_VERIFIED", "Wallet ledger verified", data=report, trace_id=trace_id)
+
+
+_analytics_cache = TTLCache(maxsize=32, ttl_seconds=settings.analytics_cache_ttl_seconds)
+
+
+def _amount_group(key: Any) -> Dict[str, Any]:
+    return {"$group": {"_id": key, "usd": {"$sum": "$amount_usd"}, "count": {"$sum": 1}}}
+
+
+def _amount_rows(rows: List[Dict[str, Any]], key_name: str) -> List[Dict[str, Any]]:
+    return [{key_name: r["_id"], "usd": round(r["usd"], 2), "count": r["count"]} for r in rows]
+
+
+async def compute_platform_analytics(days: int = 30) -> Dict[str, Any]:
+    # Every KPI is a server-side $group; only the grouped rows come back.
+    since = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=days - 1)
+    by_day_key = {"$dateToString": {"format": "%Y-%m-%d", "date": "$created_at"}}
+
+    users_q = User.aggregate([{"$group": {"_id": "$status", "count": {"$sum": 1}}}]).to_list()
+    commissions_q = Commission.aggregate([{"$facet": {
+        "totals": [_amount_group(None)],
+        "by_level": [_amount_group("$level"), {"$sort": {"_id": 1}}],
+        "by_day": [{"$match": {"created_at": {"$gte": since}}}, _amount_group(by_day_key), {"$sort": {"_id": 1}}],
+    }}]).to_list()
+    payouts_q = PayoutRequest.aggregate([{"$match": {"status": "sent"}}, {"$facet": {
+        "totals": [_amount_group(None)],
+        "by_gateway": [_amount_group("$gateway"), {"$sort": {"_id": 1}}],
+        "by_day": [{"$match": {"created_at": {"$gte": since}}}, _amount_group(by_day_key), {"$sort": {"_id": 1}}],
+    }}]).to_list()
+    payments_q = Payment.aggregate([
+        {"$match": {"status": "confirmed"}},
+        _amount_group("$gateway"),
+        {"$sort": {"_id": 1}},
+    ]).to_list()
+    users_rows, comm_facet, payout_facet, payment_rows = await asyncio.gather(users_q, commissions_q, payouts_q, payments_q)
+
+    users_by_status = {r["_id"]: r["count"] for r in users_rows}
+    comm = comm_facet[0] if comm_facet else {}
+    payout = payout_facet[0] if payout_facet else {}
+    comm_totals = (comm.get("totals") or [{"usd": 0.0, "count": 0}])[0]
+    payout_totals = (payout.get("totals") or [{"usd": 0.0, "count": 0}])[0]
+    return {
+        "total_users": sum(users_by_status.values()),
+        "active_users": users_by_status.get("active", 0),
+        "total_commissions_usd": round(comm_totals["usd"], 2),
+        "total_payouts_usd": round(payout_totals["usd"], 2),
+        "users_by_status": users_by_status,
+        "commissions_count": comm_totals["count"],
+        "payouts_count": payout_totals["count"],
+        "breakdowns": {
+            "days": days,
+            "commissions_by_level": _amount_rows(comm.get("by_level", []), "level"),
+            "commissions_by_day": _amount_rows(comm.get("by_day", []), "date"),
+            "payouts_by_gateway": _amount_rows(payout.get("by_gateway", []), "gateway"),
+            "payouts_by_day": _amount_rows(payout.get("by_day", []), "date"),
+            "payments_by_gateway": _amount_rows(payment_rows, "gateway"),
+        },
+        "generated_at": datetime.now(timezone.utc).isoformat(),
     }
+
+
+@app.get("/admin/analytics")
+async def analytics(days: int = Query(30, ge=1, le=180), fresh: bool = Query(False), admin: Principal = Depends(get_admin_user), request: Request = None):
+    trace_id = request.state.trace_id if request else str(uuid.uuid4())
+    data = None if fresh else _analytics_cache.get(days)
+    if data is None:
+        data = await compute_platform_analytics(days)
+        _analytics_cache.set(days, data)
     return make_response(True, "ANALYTICS", "Platform KPIs", data=data, trace_id=trace_id)
 
 
@@ -1257,18 +3976,155 @@ async def analytics(admin: User = Depends(get_admin_user), request: Request = No
 # ----------------------------------------------------------------------------
 
 
+EXPIRE_ACCOUNTS_JOB = "expire_accounts"
+
+
+async def acquire_job(name: str, owner: str) -> Optional[Dict[str, Any]]:
+    now = datetime.now(timezone.utc)
+    try:
+        return await JobCheckpoint.get_motor_collection().find_one_and_update(
+            {"name": name, "$or": [{"locked_until": None}, {"locked_until": {"$lt": now}}]},
+            {"$set": {"owner": owner, "locked_until": now + timedelta(seconds=settings.job_lease_seconds)}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+    except DuplicateKeyError:
+        return None  # another runner holds the lease
+
+
+async def _checkpoint(name: str, owner: str, update: Dict[str, Any], inc: Optional[Dict[str, int]] = None) -> bool:
+    # every checkpoint also renews the lease; False means another runner took it over
+    update = {**update, "locked_until": datetime.now(timezone.utc) + timedelta(seconds=settings.job_lease_seconds)}
+    ops: Dict[str, Any] = {"$set": update}
+    if inc:
+        ops["$inc"] = inc
+    res = await JobCheckpoint.get_motor_collection().update_one({"name": name, "owner": owner}, ops)
+    return res.matched_count > 0
+
+
+async def _expire_batch(ids: List[ObjectId], cutoff: datetime, run_id: str, resumed: bool) -> List[ObjectId]:
+    # Flips one recorded chunk and notifies the users it flipped. Safe to run
+    # again for the same chunk: the status guard skips users already flipped,
+    # and on resume users already notified by this run are skipped too.
+    coll = User.get_motor_collection()
+    match: Dict[str, Any] = {"status": "active", "activation_expires_at": {"$ne": None, "$lt": cutoff}}
+    res = await coll.update_many({**match, "_id": {"$in": ids}}, {"$set": {"status": "pending"}})
+    expired = ids
+    if resumed or res.modified_count < len(ids):
+        # some renewed between the read and the write; notify only the ones flipped
+        flipped = await coll.find({"_id": {"$in": ids}, "status": "pending", "activation_expires_at": {"$lt": cutoff}}, projection={"_id": 1}).to_list(None)
+        expired = [d["_id"] for d in flipped]
+    if resumed and expired:
+        done = set(await Notification.get_motor_collection().distinct(
+            "user_id", {"user_id": {"$in": [str(uid) for uid in expired]}, "data.expiry_run": run_id}
+        ))
+        expired = [uid for uid in expired if str(uid) not in done]
+    await create_notifications_bulk([
+        Notification(user_id=str(uid), type="system", title="Activation expired", body="Your account activation has expired. Please renew.", data={"expiry_run": run_id})
+        for uid in expired
+    ])
+    for uid in expired:
+        events.publish(USER_CHANGED, str(uid))
+    return expired
+
+
+async def expire_accounts_job(chunk_size: Optional[int] = None, restart: bool = False) -> Dict[str, Any]:
+    # Walks expired active users in _id order, one update_many per chunk. Each
+    # chunk's ids are checkpointed before the flip and cleared once its users
+    # are notified, so an interrupted run finishes that chunk on resume and then
+    # carries on from last_id with the same cutoff.
+    chunk_size = max(1, chunk_size or settings.expire_accounts_chunk_size)
+    owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+    job = await acquire_job(EXPIRE_ACCOUNTS_JOB, owner)
+    if job is None:
+        return {"status": "locked", "processed": 0}
+    coll = User.get_motor_collection()
+    cutoff, processed = job.get("cutoff"), job.get("processed", 0)
+    try:
+        if job.get("batch"):
+            ids = [ObjectId(i) for i in job["batch"]]
+            expired = await _expire_batch(ids, cutoff, job.get("run_id") or "", resumed=True)
+            invalidate_user_summary(*[r for r in await coll.distinct("parent_referrer", {"_id": {"$in": ids}}) if r])
+            processed += len(expired)
+            if not await _checkpoint(EXPIRE_ACCOUNTS_JOB, owner, {"last_id": job["batch"][-1], "batch": []}, inc={"processed": len(expired)}):
+                return {"status": "lost_lease", "processed": processed, "cutoff": cutoff}
+            job["last_id"] = job["batch"][-1]
+        if restart or job.get("status") != "running":
+            cutoff, last_id, processed, run_id = datetime.now(timezone.utc), None, 0, uuid.uuid4().hex
+            if not await _checkpoint(EXPIRE_ACCOUNTS_JOB, owner, {
+                "status": "running", "cutoff": cutoff, "last_id": None, "batch": [], "run_id": run_id, "processed": 0,
+                "started_at": cutoff, "finished_at": None,
+            }):
+                return {"status": "lost_lease", "processed": 0, "cutoff": cutoff}
+        else:
+            last_id, run_id = job.get("last_id"), job.get("run_id") or ""
+        match: Dict[str, Any] = {"status": "active", "activation_expires_at": {"$ne": None, "$lt": cutoff}}
+        while True:
+            query = dict(match)
+            if last_id:
+                query["_id"] = {"$gt": ObjectId(last_id)}
+            docs = await coll.find(query, projection={"parent_referrer": 1}).sort("_id", ASCENDING).limit(chunk_size).to_list(None)
+            if not docs:
+                break
+            ids = [d["_id"] for d in docs]
+            if not await _checkpoint(EXPIRE_ACCOUNTS_JOB, owner, {"batch": [str(i) for i in ids]}):
+                return {"status": "lost_lease", "processed": processed, "cutoff": cutoff}
+            expired = await _expire_batch(ids, cutoff, run_id, resumed=False)
+            invalidate_user_summary(*{d.get("parent_referrer") for d in docs if d.get("parent_referrer")})
+            last_id = str(ids[-1])
+            processed += len(expired)
+            if not await _checkpoint(EXPIRE_ACCOUNTS_JOB, owner, {"last_id": last_id, "batch": []}, inc={"processed": len(expired)}):
+                return {"status": "lost_lease", "processed": processed, "cutoff": cutoff}
+        if not await _checkpoint(EXPIRE_ACCOUNTS_JOB, owner, {"status": "completed", "finished_at": datetime.now(timezone.utc)}):
+            return {"status": "lost_lease", "processed": processed, "cutoff": cutoff}
+    finally:
+        await JobCheckpoint.get_motor_collection().update_one(
+            {"name": EXPIRE_ACCOUNTS_JOB, "owner": owner}, {"$set": {"owner": None, "locked_until": None}}
+        )
+    return {"status": "completed", "processed": processed, "cutoff": cutoff}
+
+
+class PeriodicJob:
+    # Minimal in-process scheduler; the job's own lease keeps workers from overlapping
+    def __init__(self, name: str, fn: Callable[[], Any], interval: Callable[[], float]) -> None:
+        self.name = name
+        self.fn = fn
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            # jitter so workers started together don't all race for the lease
+            await asyncio.sleep(self.interval() * random.uniform(0.9, 1.1))
+            try:
+                result = await self.fn()
+                logger.info("scheduled job %s: %s", self.name, result)
+            except Exception:  # noqa: BLE001
+                logger.exception("scheduled job %s failed", self.name)
+
+
+expire_accounts_scheduler = PeriodicJob(EXPIRE_ACCOUNTS_JOB, expire_accounts_job, lambda: settings.expire_accounts_interval_seconds)
+
+
 @app.post("/admin/cron/expire_accounts")
-async def cron_expire_accounts(admin: User = Depends(get_admin_user), request: Request = None):
+async def cron_expire_accounts(restart: bool = Query(False), admin: Principal = Depends(get_admin_user), request: Request = None):
     trace_id = request.state.trace_id if request else str(uuid.uuid4())
-    now = datetime.now(timezone.utc)
-    users = await User.find(User.activation_expires_at != None, User.activation_expires_at < now, User.status == "active").to_list()  # noqa: E711
-    updated = 0
-    for u in users:
-        u.status = "pending"
-        await u.save()
-        await create_notification(str(u.id), "system", "Activation expired", "Your account activation has expired. Please renew.")
-        updated += 1
-    return make_response(True, "ACTIVATIONS_EXPIRED", "Processed expirations", data={"updated": updated}, trace_id=trace_id)
+    result = await expire_accounts_job(restart=restart)
+    if result["status"] == "locked":
+        return make_response(False, "JOB_RUNNING", "Expiry job is already running", http_status=409, trace_id=trace_id)
+    if result["status"] == "lost_lease":
+        return make_response(False, "JOB_LEASE_LOST", "Expiry job lost its lease to another runner", data={"updated": result["processed"]}, http_status=409, trace_id=trace_id)
+    return make_response(True, "ACTIVATIONS_EXPIRED", "Processed expirations", data={"updated": result["processed"]}, trace_id=trace_id)
 
 
 # ----------------------------------------------------------------------------
@@ -1276,70 +4132,82 @@ async def cron_expire_accounts(admin: User = Depends(get_admin_user), request: R
 # ----------------------------------------------------------------------------
 
 
-@app.get("/dashboard/summary")
-async def dashboard_summary(user: User = Depends(get_active_user), request: Request = None):
-    trace_id = request.state.trace_id if request else str(uuid.uuid4())
-    user_id = str(user.id)
+async def _count_by_status(model, match: Dict[str, Any], amount_field: Optional[str] = None) -> Dict[str, Dict[str, float]]:
+    group: Dict[str, Any] = {"_id": "$status", "count": {"$sum": 1}}
+    if amount_field:
+        group["usd"] = {"$sum": f"${amount_field}"}
+    rows = await model.aggregate([{"$match": match}, {"$group": group}]).to_list()
+    return {r["_id"]: r for r in rows}
 
-    # Referrals (direct)
-    total_referrals = await User.find(User.parent_referrer == user_id).count()
-    active_referrals = await User.find(User.parent_referrer == user_id, User.status == "active").count()
 
-    # Tasks available
-    now = datetime.now(timezone.utc)
-    tasks_available = await Task.find((Task.expires_at == None) | (Task.expires_at > now)).count()  # noqa: E711
-
-    # Task submissions breakdown
-    submissions_total = await TaskSubmission.find(TaskSubmission.user_id == user_id).count()
-    submitted_count = await TaskSubmission.find(TaskSubmission.user_id == user_id, TaskSubmission.status == "submitted").count()
-    approved_count = await TaskSubmission.find(TaskSubmission.user_id == user_id, TaskSubmission.status == "approved").count()
-    rejected_count = await TaskSubmission.find(TaskSubmission.user_id == user_id, TaskSubmission.status == "rejected").count()
-
-    # Payouts breakdown
-    payouts_total = await PayoutRequest.find(PayoutRequest.user_id == user_id).count()
-    payouts_pending = await PayoutRequest.find(PayoutRequest.user_id == user_id, PayoutRequest.status == "pending").count()
-    payouts_sent = await PayoutRequest.find(PayoutRequest.user_id == user_id, PayoutRequest.status == "sent").count()
-    payouts_rejected = await PayoutRequest.find(PayoutRequest.user_id == user_id, PayoutRequest.status == "rejected").count()
-
-    # Totals
-    total_commission_usd = 0.0
-    for c in await Commission.find(Commission.user_id == user_id).to_list():
-        total_commission_usd += c.amount_usd
-    total_payouts_usd = 0.0
-    for p in await PayoutRequest.find(PayoutRequest.user_id == user_id, PayoutRequest.status == "sent").to_list():
-        total_payouts_usd += p.amount_usd
-    wallet_usd = round(total_commission_usd - total_payouts_usd, 2)
-    wallet_local = await usd_to_local(wallet_usd, user.currency)
+async def _tasks_available_count() -> int:
+    count = _summary_shared_cache.get("tasks_available")
+    if count is None:
+        now = datetime.now(timezone.utc)
+        count = await Task.find((Task.expires_at == None) | (Task.expires_at > now)).count()  # noqa: E711
+        _summary_shared_cache.set("tasks_available", count)
+    return count
 
-    data = {
+
+async def compute_dashboard_summary(user_id: str) -> Dict[str, Any]:
+    # One grouped aggregation per collection, issued concurrently
+    referrals, submissions, payouts, tasks_available, wallet = await asyncio.gather(
+        _count_by_status(User, {"parent_referrer": user_id}),
+        _count_by_status(TaskSubmission, {"user_id": user_id}),
+        _count_by_status(PayoutRequest, {"user_id": user_id}),
+        _tasks_available_count(),
+        get_wallet(user_id),
+    )
+
+    def count(rows: Dict[str, Dict[str, float]], status_: Optional[str] = None) -> int:
+        if status_ is None:
+            return sum(r["count"] for r in rows.values())
+        return rows.get(status_, {}).get("count", 0)
+
+    view = wallet_view(wallet)
+    submitted_count = count(submissions, "submitted")
+    approved_count = count(submissions, "approved")
+    return {
         "referrals": {
-            "total": total_referrals,
-            "active": active_referrals,
+            "total": count(referrals),
+            "active": count(referrals, "active"),
         },
         "tasks": {
             "available": tasks_available,
             "submissions": {
-                "total": submissions_total,
+                "total": count(submissions),
                 "submitted": submitted_count,
                 "approved": approved_count,
-                "rejected": rejected_count,
+                "rejected": count(submissions, "rejected"),
                 "completed": approved_count,  # completed interpreted as approved
                 "pending_review": submitted_count,
             },
         },
         "payouts": {
-            "total": payouts_total,
-            "pending": payouts_pending,
-            "sent": payouts_sent,
-            "rejected": payouts_rejected,
-            "total_sent_usd": round(total_payouts_usd, 2),
+            "total": count(payouts),
+            "pending": count(payouts, "pending"),
+            "sent": count(payouts, "sent"),
+            "rejected": count(payouts, "rejected"),
+            "total_sent_usd": view["withdrawn_usd"],
         },
         "wallet": {
-            "usd": wallet_usd,
-            "local": wallet_local,
-            "currency": user.currency,
+            "usd": view["balance_usd"],
         },
     }
+
+
+@app.get("/dashboard/summary")
+async def dashboard_summary(user: Principal = Depends(get_active_user), request: Request = None):
+    trace_id = request.state.trace_id if request else str(uuid.uuid4())
+    user_id = str(user.id)
+    summary = _summary_cache.get(user_id)
+    if summary is None:
+        summary = await compute_dashboard_summary(user_id)
+        _summary_cache.set(user_id, summary)
+    # local conversion uses the live rates, so it is applied per request
+    wallet_usd = summary["wallet"]["usd"]
+    wallet = {"usd": wallet_usd, "local": await usd_to_local(wallet_usd, user.currency), "currency": user.currency}
+    data = {**summary, "wallet": wallet}
     return make_response(True, "DASHBOARD_SUMMARY", "Dashboard summary", data=data, trace_id=trace_id)
 
 
@@ -1348,34 +4216,74 @@ async def dashboard_summary(user: User = Depends(get_active_user), request: Requ
 # ----------------------------------------------------------------------------
 
 
-async def _collect_downline_by_level(root_user_id: str, max_levels: int = 10) -> Dict[int, int]:
+async def _collect_downline_by_level(root: User, max_levels: int = 10) -> Dict[int, int]:
+    rows = await User.aggregate([
+        {"$match": {"binary_ancestors": str(root.id), "binary_depth": {"$lte": root.binary_depth + max_levels}}},
+        {"$group": {"_id": "$binary_depth", "count": {"$sum": 1}}},
+    ]).to_list()
+    by_depth = {r["_id"]: r["count"] for r in rows}
     counts: Dict[int, int] = {}
-    current_level_ids: List[str] = [root_user_id]
-    visited: set[str] = set([root_user_id])
     for level in range(1, max_levels + 1):
-        next_level_ids: List[str] = []
-        for uid in current_level_ids:
-            u = await User.get(uid)
-            if not u:
-                continue
-            for child_id in [u.left_child, u.right_child]:
-                if child_id and child_id not in visited:
-                    visited.add(child_id)
-                    next_level_ids.append(child_id)
-        counts[level] = len(next_level_ids)
-        current_level_ids = next_level_ids
-        if not current_level_ids:
+        counts[level] = by_depth.get(root.binary_depth + level, 0)
+        if not counts[level]:
             break
     return counts
 
 
-def _date_key(dt: datetime) -> str:
-    d = dt.astimezone(timezone.utc).date()
-    return d.isoformat()
+async def _migrate_binary_trees(roots: List[Dict[str, Any]], chunk_size: int = 1000) -> Dict[str, int]:
+    # Backfill binary_ancestors/binary_depth/binary_path top-down from the given
+    # root docs, one tree level at a time, and open their frontier slots.
+    # Shallow slots land first, so concurrent claims still go breadth-first.
+    users = User.get_motor_collection()
+    projection = {"_id": 1, "binary_parent": 1, "left_child": 1, "right_child": 1}
+    # frontier entries: (id, ancestors, path, left_child, right_child)
+    frontier: List[tuple] = [(str(doc["_id"]), [], "", doc.get("left_child"), doc.get("right_child")) for doc in roots]
+    updated = 0
+    opened = 0
+    level_docs = [(uid, anc, path) for uid, anc, path, _, _ in frontier]
+    while frontier:
+        for i in range(0, len(level_docs), chunk_size):
+            ops = [UpdateOne({"_id": ObjectId(uid)}, {"$set": {"binary_ancestors": anc, "binary_depth": len(anc), "binary_path": path}})
+                   for uid, anc, path in level_docs[i:i + chunk_size]]
+            res = await users.bulk_write(ops, ordered=False)
+            updated += res.modified_count
+        next_frontier: List[tuple] = []
+        next_docs: List[tuple] = []
+        for i in range(0, len(frontier), chunk_size):
+            chunk = {entry[0]: entry for entry in frontier[i:i + chunk_size]}
+            slot_rows: List[Dict[str, Any]] = []
+            for uid, anc, path, left, right in chunk.values():
+                sides = [side for side, child in (("left", left), ("right", right)) if child is None]
+                slot_rows += _binary_slot_rows(uid, anc, len(anc), path, sides)
+            if slot_rows:
+                await _insert_binary_slots(slot_rows)
+                opened += len(slot_rows)
+            async for child in users.find({"binary_parent": {"$in": list(chunk)}}, projection=projection):
+                pid, anc, path, left, right = chunk[child["binary_parent"]]
+                cid = str(child["_id"])
+                if cid not in (left, right):
+                    continue  # dangling binary_parent; the parent does not link back
+                child_anc = anc + [pid]
+                child_path = path + ("L" if cid == left else "R")
+                next_frontier.append((cid, child_anc, child_path, child.get("left_child"), child.get("right_child")))
+                next_docs.append((cid, child_anc, child_path))
+        frontier = next_frontier
+        level_docs = next_docs
+    return {"updated": updated, "slots_opened": opened}
+
+
+async def migrate_binary_tree_paths(chunk_size: int = 1000) -> Dict[str, int]:
+    # Every tree at once; run while registrations are paused: the frontier is
+    # dropped and recreated. Registrations backfill a single legacy tree lazily.
+    await BinarySlot.get_motor_collection().delete_many({})
+    roots = await User.get_motor_collection().find(
+        {"binary_parent": None}, projection={"_id": 1, "left_child": 1, "right_child": 1}
+    ).to_list(None)
+    return {"roots": len(roots), **await _migrate_binary_trees(roots, chunk_size)}
 
 
 @app.get("/dashboard/charts")
-async def dashboard_charts(days: int = Query(30, ge=1, le=180), user: User = Depends(get_active_user), request: Request = None):
+async def dashboard_charts(days: int = Query(30, ge=1, le=180), user: Principal = Depends(get_active_user), request: Request = None):
     trace_id = request.state.trace_id if request else str(uuid.uuid4())
     user_id = str(user.id)
     end = datetime.now(timezone.utc)
@@ -1383,54 +4291,35 @@ async def dashboard_charts(days: int = Query(30, ge=1, le=180), user: User = Dep
 
     # Prepare date buckets
     date_buckets = [(start + timedelta(days=i)).date().isoformat() for i in range(days)]
-    zeros = {d: 0 for d in date_buckets}
-
-    # Referrals over time (direct)
-    referrals = await User.find(User.parent_referrer == user_id).to_list()
-    ref_series = zeros.copy()
-    for r in referrals:
-        dk = _date_key(r.created_at)
-        if dk in ref_series:
-            ref_series[dk] += 1
-
-    # Commissions over time (sum USD)
-    comms = await Commission.find(Commission.user_id == user_id).to_list()
-    comm_series = {d: 0.0 for d in date_buckets}
-    for c in comms:
-        dk = _date_key(c.created_at)
-        if dk in comm_series:
-            comm_series[dk] += float(c.amount_usd)
-
-    # Tasks submissions over time broken down
-    subs = await TaskSubmission.find(TaskSubmission.user_id == user_id).to_list()
-    task_series = {
-        "submitted": zeros.copy(),
-        "approved": zeros.copy(),
-        "rejected": zeros.copy(),
-    }
-    for s in subs:
-        dk = _date_key(s.created_at)
-        if dk in task_series.get(s.status, {}):
-            task_series[s.status][dk] += 1
+
+    # Referrals, commissions and task submissions over time: at most `days`
+    # pre-bucketed rollup rows, whatever the account age
+    series: Dict[str, Dict[str, float]] = {m: {} for m in ROLLUP_METRICS}
+    async for row in DailyRollup.get_motor_collection().find(
+        {"user_id": user_id, "date": {"$gte": date_buckets[0], "$lte": date_buckets[-1]}},
+        projection={"date": 1, "metrics": 1},
+    ):
+        for metric, value in (row.get("metrics") or {}).items():
+            if metric in series:
+                series[metric][row["date"]] = value
+
+    def points(metric: str) -> List[int]:
+        return [int(series[metric].get(d, 0)) for d in date_buckets]
 
     # Downline by level (binary tree breadth)
-    downline = await _collect_downline_by_level(user_id, max_levels=10)
+    downline = await _collect_downline_by_level(user, max_levels=10)
 
     # Binary position metrics
-    depth_from_root = 0
-    cursor = await User.get(user.binary_parent) if user.binary_parent else None
-    while cursor is not None and depth_from_root < 1000:
-        depth_from_root += 1
-        cursor = await User.get(cursor.binary_parent) if cursor.binary_parent else None
+    depth_from_root = user.binary_depth
 
     data = {
         "dates": date_buckets,
-        "referrals_over_time": [ref_series[d] for d in date_buckets],
-        "commissions_over_time_usd": [round(comm_series[d], 2) for d in date_buckets],
+        "referrals_over_time": points("referrals"),
+        "commissions_over_time_usd": [round(series["commissions_usd"].get(d, 0.0), 2) for d in date_buckets],
         "tasks_over_time": {
-            "submitted": [task_series["submitted"][d] for d in date_buckets],
-            "approved": [task_series["approved"][d] for d in date_buckets],
-            "rejected": [task_series["rejected"][d] for d in date_buckets],
+            "submitted": points("tasks_submitted"),
+            "approved": points("tasks_approved"),
+            "rejected": points("tasks_rejected"),
         },
         "downline_by_level": downline,  # {level: count}
         "binary_position": {
@@ -1451,3 +4340,259 @@ async def root(request: Request):
     return make_response(True, "OK", "Service is up", data={"name": settings.app_name}, trace_id=trace_id)
 
 
+# ----------------------------------------------------------------------------
+# CLI (maintenance commands): python server.py <command> ...
+# ----------------------------------------------------------------------------
+
+
+async def _cli_wallets(args) -> int:
+    report = await verify_wallets(fix=args.action == "rebuild")
+    print(json.dumps(report, indent=2, default=str))
+    return 1 if args.action == "verify" and report["drifted"] else 0
+
+
+async def _cli_migrate_tree(args) -> int:
+    print(json.dumps(await migrate_binary_tree_paths(chunk_size=args.chunk_size), indent=2))
+    return 0
+
+
+async def _cli_migrate_referrals(args) -> int:
+    print(json.dumps(await migrate_referral_ancestors(chunk_size=args.chunk_size), indent=2))
+    return 0
+
+
+async def _cli_outbox(args) -> int:
+    coll = OutboxMessage.get_motor_collection()
+    if args.action == "retry-failed":
+        res = await coll.update_many({"status": "failed"}, {"$set": {"status": "pending", "attempts": 0, "next_attempt_at": datetime.now(timezone.utc)}})
+        print(json.dumps({"requeued": res.modified_count}))
+    elif args.action == "drain":
+        print(json.dumps({"delivered": await outbox.drain()}))
+    else:
+        outbox.start()
+        await asyncio.Event().wait()  # run until interrupted
+    return 0
+
+
+async def _cli_webhooks(args) -> int:
+    if args.action == "replay":
+        print(json.dumps({"requeued": await replay_webhook_events(args.event_id or None)}))
+    elif args.action == "drain":
+        print(json.dumps({"applied": await webhook_worker.drain()}))
+    else:
+        webhook_worker.start()
+        await asyncio.Event().wait()  # run until interrupted
+    return 0
+
+
+async def _cli_expire_accounts(args) -> int:
+    result = await expire_accounts_job(chunk_size=args.chunk_size, restart=args.restart)
+    print(json.dumps(result, default=str))
+    return 0 if result["status"] == "completed" else 1
+
+
+class _BenchSocket:
+    # Stand-in for a Starlette WebSocket: fast clients take `latency` per send,
+    # stalled ones never complete a send.
+    def __init__(self, latency: float, stalled: bool, on_receive: Callable[[], None]) -> None:
+        self.client_state = WebSocketState.CONNECTED
+        self.latency = latency
+        self.stalled = stalled
+        self.on_receive = on_receive
+
+    async def accept(self) -> None:
+        return None
+
+    async def send_text(self, text: str) -> None:
+        if self.stalled:
+            await asyncio.Event().wait()
+        await asyncio.sleep(self.latency)
+        self.on_receive()
+
+    async def close(self, code: int = 1000) -> None:
+        self.client_state = WebSocketState.DISCONNECTED
+
+
+async def bench_broadcast(connections: int, slow: int, rounds: int, latency: float) -> Dict[str, Any]:
+    # Broadcast latency at N simulated sockets on an isolated manager (no DB, no real backplane)
+    manager = ConnectionManager(InMemoryBackplane())
+    received = 0
+    done = asyncio.Event()
+    target = 0
+
+    def on_receive() -> None:
+        nonlocal received
+        received += 1
+        if received >= target:
+            done.set()
+
+    for i in range(connections):
+        await manager.connect(f"bench-{i}", _BenchSocket(latency, i < slow, on_receive))
+    fast = connections - slow
+    results = []
+    message = {"type": "task", "title": "New task posted", "body": "bench", "data": {"task_id": "x" * 24}}
+    for r in range(rounds):
+        received, target = 0, fast
+        done.clear()
+        t0 = time.perf_counter()
+        await manager.broadcast(message)
+        enqueued = time.perf_counter()
+        await asyncio.wait_for(done.wait(), timeout=60)
+        delivered = time.perf_counter()
+        results.append({
+            "round": r + 1,
+            "enqueue_ms": round((enqueued - t0) * 1000, 2),
+            "all_fast_delivered_ms": round((delivered - t0) * 1000, 2),
+            "live_connections": manager.connection_count(),
+        })
+    await asyncio.sleep(0)
+    report = {"connections": connections, "slow": slow, "queue_size": settings.ws_send_queue_size,
+              "evicted_slow": manager.evicted_slow, "rounds": results}
+    for conns in list(manager.user_connections.values()):
+        for conn in list(conns):
+            await manager.drop(conn)
+    return report
+
+
+async def _cli_bench_broadcast(args) -> int:
+    if args.queue_size:
+        settings.ws_send_queue_size = args.queue_size
+    report = await bench_broadcast(args.connections, args.slow, args.rounds, args.latency)
+    print(json.dumps(report, indent=2))
+    return 0
+
+
+class _SMTPSink:
+    # aiosmtpd handler that counts messages and the SMTP sessions carrying them
+    def __init__(self) -> None:
+        self.messages = 0
+        self.sessions: set = set()
+
+    async def handle_DATA(self, server, session, envelope) -> str:
+        self.messages += 1
+        self.sessions.add(session)
+        return "250 OK"
+
+
+async def smtp_selftest(count: int) -> Dict[str, Any]:
+    # Sends `count` messages through a fresh SMTPPool to a local aiosmtpd
+    # stand-in; with pooling the session count stays near SMTP_POOL_SIZE.
+    if SMTPController is None:
+        raise RuntimeError("smtp-selftest requires the 'aiosmtpd' package")
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    sink = _SMTPSink()
+    controller = SMTPController(sink, hostname="127.0.0.1", port=port)
+    controller.start()
+    saved = {k: getattr(settings, k) for k in ("smtp_host", "smtp_port", "smtp_starttls", "smtp_user", "smtp_password")}
+    settings.smtp_host, settings.smtp_port, settings.smtp_starttls = "127.0.0.1", port, False
+    settings.smtp_user = settings.smtp_password = None
+    pool = SMTPPool(settings.smtp_pool_size)
+    try:
+        messages = [EmailMessage(to=f"user{i}@example.com", subject="selftest", body=f"message {i}") for i in range(count)]
+        t0 = time.perf_counter()
+        errors = await pool.send_batch(messages)
+        elapsed = time.perf_counter() - t0
+    finally:
+        await pool.close()
+        controller.stop()
+        for k, v in saved.items():
+            setattr(settings, k, v)
+    return {
+        "messages": count,
+        "delivered": sink.messages,
+        "failed": sum(1 for e in errors if e is not None),
+        "smtp_sessions": len(sink.sessions),
+        "pool_size": settings.smtp_pool_size,
+        "batch_size": settings.smtp_batch_size,
+        "rate_per_connection": settings.smtp_rate_per_connection,
+        "elapsed_ms": round(elapsed * 1000, 2),
+    }
+
+
+async def _cli_smtp_selftest(args) -> int:
+    if args.rate is not None:
+        settings.smtp_rate_per_connection = args.rate
+    report = await smtp_selftest(args.messages)
+    print(json.dumps(report, indent=2))
+    return 0 if report["delivered"] == report["messages"] and not report["failed"] else 1
+
+
+async def _cli_rollups(args) -> int:
+    print(json.dumps(await rebuild_daily_rollups(chunk_size=args.chunk_size), indent=2))
+    return 0
+
+
+async def _cli_explain(args) -> int:
+    report = await explain_query_shapes()
+    for r in report:
+        flag = "COLLSCAN" if r["collscan"] else ("SORT" if r["in_memory_sort"] else "ok")
+        print(f"{flag:9} {r['name']:40} {' > '.join(r['stages'])}")
+    return 1 if any(r["collscan"] for r in report) else 0
+
+
+def _cli_main(argv: Optional[List[str]] = None) -> int:
+    import argparse
+
+    parser = argparse.ArgumentParser(description=f"{settings.app_name} maintenance commands")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("wallets", help="Verify or rebuild materialized wallets from commissions/payouts; rebuild also creates missing wallets (run once when upgrading)")
+    p.add_argument("action", choices=["verify", "rebuild"])
+    p.set_defaults(handler=_cli_wallets)
+
+    p = sub.add_parser("migrate-tree", help="Backfill binary tree paths and rebuild the open-slot frontier")
+    p.add_argument("--chunk-size", type=int, default=1000)
+    p.set_defaults(handler=_cli_migrate_tree)
+
+    p = sub.add_parser("migrate-referrals", help="Backfill referral_ancestors (sponsor chains) for existing users")
+    p.add_argument("--chunk-size", type=int, default=1000)
+    p.set_defaults(handler=_cli_migrate_referrals)
+
+    p = sub.add_parser("rebuild-rollups", help="Recompute daily chart rollups from the raw collections")
+    p.add_argument("--chunk-size", type=int, default=1000)
+    p.set_defaults(handler=_cli_rollups)
+
+    p = sub.add_parser("explain-queries", help="Explain each hot query shape; exits 1 if any is a COLLSCAN")
+    p.set_defaults(handler=_cli_explain)
+
+    p = sub.add_parser("outbox", help="Run the outbox dispatcher standalone, drain it once, or requeue failed messages")
+    p.add_argument("action", choices=["run", "drain", "retry-failed"])
+    p.set_defaults(handler=_cli_outbox)
+
+    p = sub.add_parser("webhooks", help="Run the webhook ingestion workers standalone, drain once, or replay dead events")
+    p.add_argument("action", choices=["run", "drain", "replay"])
+    p.add_argument("--event-id", action="append", help="Replay only these event ids (repeatable)")
+    p.set_defaults(handler=_cli_webhooks)
+
+    p = sub.add_parser("expire-accounts", help="Expire lapsed activations in checkpointed chunks (resumes an interrupted run)")
+    p.add_argument("--chunk-size", type=int, default=None)
+    p.add_argument("--restart", action="store_true", help="Ignore the checkpoint and start a new run")
+    p.set_defaults(handler=_cli_expire_accounts)
+
+    p = sub.add_parser("bench-broadcast", help="Measure websocket broadcast latency against simulated connections")
+    p.add_argument("--connections", type=int, default=10000)
+    p.add_argument("--slow", type=int, default=100, help="Simulated clients that never finish a send")
+    p.add_argument("--rounds", type=int, default=5)
+    p.add_argument("--latency", type=float, default=0.001, help="Per-send latency of healthy clients (seconds)")
+    p.add_argument("--queue-size", type=int, default=None, help="Override WS_SEND_QUEUE_SIZE (small values show eviction)")
+    p.set_defaults(handler=_cli_bench_broadcast, needs_db=False)
+
+    p = sub.add_parser("smtp-selftest", help="Send through the SMTP pool to a local aiosmtpd stand-in and count sessions")
+    p.add_argument("--messages", type=int, default=200)
+    p.add_argument("--rate", type=float, default=None, help="Override SMTP_RATE_PER_CONNECTION (0 = unlimited)")
+    p.set_defaults(handler=_cli_smtp_selftest, needs_db=False)
+
+    args = parser.parse_args(argv)
+
+    async def run() -> int:
+        if getattr(args, "needs_db", True):
+            await init_db()
+        return await args.handler(args)
+
+    return asyncio.run(run())
+
+
+if __name__ == "__main__":
+    raise SystemExit(_cli_main())